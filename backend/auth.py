@@ -1,13 +1,33 @@
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from passlib.context import CryptContext
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+import asyncio
+import time
+import uuid
 import jwt
-from typing import List
-from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from typing import Dict, List, Optional, Set, Tuple
+from config import (
+    SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS,
+    PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
+)
+from database import db
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# min/max = coût courant: tout hachage d'un autre coût est signalé à recalculer
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+# bcrypt (~250 ms par appel) s'exécute hors de la boucle d'événements, dans un pool
+# dédié: au plus PASSWORD_HASH_WORKERS hachages simultanés, les autres attendent
+# leur tour sans bloquer les autres requêtes (ni le pool par défaut d'asyncio)
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 security = HTTPBearer()
 
 # Role hierarchy for RBAC
@@ -17,43 +37,95 @@ ROLE_HIERARCHY = {
     "caissier": 1
 }
 
-def hash_password(password: str) -> str:
-    """Hash a password"""
-    return pwd_context.hash(password)
+async def _run_password_task(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_password_executor, func, *args)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a password against its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+async def hash_password(password: str) -> str:
+    """Hash a password (in the password hashing pool)"""
+    return await _run_password_task(pwd_context.hash, password)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against its hash (in the password hashing pool)"""
+    return await _run_password_task(pwd_context.verify, plain_password, hashed_password)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password; also return a new hash if the stored one uses outdated parameters"""
+    return await _run_password_task(pwd_context.verify_and_update, plain_password, hashed_password)
 
 def create_access_token(data: dict) -> str:
-    """Create a JWT access token"""
+    """Create a JWT access token (data["ver"]: token_version of the user)"""
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": str(uuid.uuid4())})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Cache des utilisateurs authentifiés (LRU): jeton -> (utilisateur, expiration du cache,
+# expiration du jeton). Évite le décodage JWT et la lecture de l'utilisateur à chaque
+# requête; l'état du compte (actif, rôle, révocation) est relu au plus tous les
+# PRINCIPAL_CACHE_TTL secondes, et immédiatement après une modification locale
+# (invalidate_user_sessions).
+_principals: "OrderedDict[str, Tuple[dict, float, float]]" = OrderedDict()
+_principal_tokens: Dict[str, Set[str]] = {}  # user_id -> jetons en cache
+
+def _cache_principal(token: str, principal: dict, token_exp: float):
+    _principals[token] = (principal, time.monotonic() + PRINCIPAL_CACHE_TTL, token_exp)
+    _principal_tokens.setdefault(principal['user_id'], set()).add(token)
+    while len(_principals) > PRINCIPAL_CACHE_SIZE:
+        evicted, (evicted_principal, _, _) = _principals.popitem(last=False)
+        tokens = _principal_tokens.get(evicted_principal['user_id'])
+        if tokens is not None:
+            tokens.discard(evicted)
+            if not tokens:
+                del _principal_tokens[evicted_principal['user_id']]
+
+def invalidate_user_sessions(user_id: str):
+    """Retirer du cache les jetons d'un utilisateur (modification, suppression, mot de passe)"""
+    for token in _principal_tokens.pop(user_id, ()):
+        _principals.pop(token, None)
+
+async def _load_principal(payload: dict) -> dict:
+    """Construire l'utilisateur authentifié à partir du jeton et de l'état du compte en base"""
+    user_id: str = payload.get("sub")
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    user = await db.users.find_one(
+        {"id": user_id},
+        {"_id": 0, "tenant_id": 1, "role": 1, "employee_code": 1, "is_active": 1, "token_version": 1}
+    )
+    if not user:
+        raise HTTPException(status_code=401, detail="Utilisateur introuvable")
+    if user.get("is_active") is False:
+        raise HTTPException(status_code=401, detail="Compte désactivé")
+    # Mot de passe changé depuis l'émission du jeton
+    if payload.get("ver", 0) != user.get("token_version", 0):
+        raise HTTPException(status_code=401, detail="Session révoquée, veuillez vous reconnecter")
+    return {
+        "user_id": user_id,
+        "tenant_id": user.get("tenant_id", payload.get("tenant_id")),
+        "role": user.get("role", payload.get("role")),
+        "employee_code": payload.get("employee_code") or user.get("employee_code")
+    }
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get the current authenticated user from JWT token"""
+    """Get the current authenticated user from JWT token (cached, see _principals)"""
+    token = credentials.credentials
+    cached = _principals.get(token)
+    if cached is not None:
+        principal, cached_until, token_exp = cached
+        if time.monotonic() < cached_until and time.time() < token_exp:
+            _principals.move_to_end(token)
+            return dict(principal)
+        _principals.pop(token, None)
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        tenant_id: str = payload.get("tenant_id")
-        role: str = payload.get("role")
-        employee_code: str = payload.get("employee_code")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-        return {
-            "user_id": user_id, 
-            "tenant_id": tenant_id, 
-            "role": role,
-            "employee_code": employee_code
-        }
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    principal = await _load_principal(payload)
+    _cache_principal(token, principal, payload.get("exp", 0))
+    return dict(principal)
 
 def require_role(allowed_roles: List[str]):
     """Dependency to check if user has required role"""
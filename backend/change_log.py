@@ -0,0 +1,388 @@
+"""
+Journal des modifications par tenant pour la synchronisation différentielle.
+
+Chaque écriture sur une collection synchronisée (SYNCED_COLLECTIONS) ajoute une
+entrée {tenant_id, seq, collection, doc_id, op} dans change_log. Le numéro de
+séquence est strictement croissant par tenant (compteur $inc dans counters), ce
+qui donne aux clients hors ligne un point de reprise exact (checkpoint) au lieu
+d'une comparaison de dates.
+
+read_delta() renvoie les modifications postérieures à un checkpoint, compactées
+(dernier état de chaque document), par pages. Un numéro alloué mais pas encore
+écrit (écriture concurrente en cours) interrompt la page: le client le reçoit
+au prochain appel, rien n'est sauté. Un trou plus ancien que GAP_GRACE est
+bouché par une entrée "skip" (index unique tenant_id/seq) avant d'être franchi:
+un écrivain lent qui arrive ensuite reçoit une erreur de doublon et réinscrit
+ses modifications sous de nouveaux numéros, sa modification n'est jamais perdue.
+
+Rétention: compact_change_log() (tâche périodique) ne garde, au-delà de
+CHANGE_LOG_RETENTION, que la dernière entrée de chaque document et retire les
+suppressions et entrées "skip" anciennes. Un client dont le checkpoint précède
+une suppression purgée reçoit reset_required: il repart du checkpoint 0.
+
+Durabilité: une mutation et son inscription au journal sont deux écritures
+distinctes. tracked_changes() encadre la mutation d'une intention (change_intents)
+écrite avant elle et retirée une fois les entrées inscrites; si le processus
+s'arrête entre les deux, recover_pending_changes() (reprise périodique) inscrit
+les documents de l'intention: upsert s'ils existent, suppression sinon.
+
+Les documents antérieurs au journal y sont inscrits une fois par
+seed_change_log() (migration reprenable, lancée en tâche de fond au démarrage,
+exécutée par un seul worker grâce à un verrou à expiration):
+un client qui part du checkpoint 0 reçoit ainsi l'état complet.
+"""
+import asyncio
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from database import db
+from dates import as_datetime
+
+logger = logging.getLogger(__name__)
+
+SYNCED_COLLECTIONS = ("products", "sales", "customers")
+
+UPSERT = "upsert"
+DELETE = "delete"
+# Numéro abandonné, bouché par un lecteur (aucun document associé)
+SKIP = "skip"
+
+# Au-delà, un numéro de séquence alloué mais jamais écrit est bouché par une entrée SKIP
+GAP_GRACE = timedelta(seconds=30)
+# Historique complet conservé; au-delà, seule la dernière entrée de chaque document reste
+CHANGE_LOG_RETENTION = timedelta(days=30)
+# Intervalle de la compaction périodique (secondes)
+COMPACTION_INTERVAL = 60 * 60
+COMPACTION_BATCH_SIZE = 1000
+
+SEED_MIGRATION_ID = "change_log_seed"
+# Verrou de l'initialisation (un seul worker), prolongé à chaque lot
+SEED_LOCK_TTL = timedelta(minutes=5)
+
+# Champs internes jamais envoyés aux clients (marqueurs de compensation)
+_PRIVATE_FIELDS = ("pending_sales", "pending_returns", "pending_supplies", "pending_sync", "sync_stock_before")
+
+
+async def allocate_sequence(tenant_id: str, count: int = 1) -> int:
+    """Réserver `count` numéros consécutifs; retourne le premier"""
+    counter = await db.counters.find_one_and_update(
+        {"_id": f"change_seq:{tenant_id}"},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"] - count + 1
+
+
+async def record_changes(tenant_id: str, collection: str, doc_ids: Iterable[str], op: str = UPSERT) -> None:
+    """Inscrire au journal les documents modifiés (ou supprimés) d'une collection synchronisée.
+    Les numéros bouchés entre-temps par un lecteur (doublon) sont réalloués.
+    """
+    doc_ids = list(dict.fromkeys(i for i in doc_ids if i))
+    while doc_ids:
+        first = await allocate_sequence(tenant_id, len(doc_ids))
+        now = datetime.now(timezone.utc)
+        try:
+            await db.change_log.insert_many([
+                {"tenant_id": tenant_id, "seq": first + i, "collection": collection, "doc_id": doc_id, "op": op, "at": now}
+                for i, doc_id in enumerate(doc_ids)
+            ], ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error.get('code') != 11000 for error in errors):
+                raise
+            logger.warning(f"Journal {tenant_id}: {len(errors)} numéro(s) bouché(s) avant écriture, réallocation")
+            doc_ids = [doc_ids[error['index']] for error in errors]
+
+
+async def write_intent(tenant_id: str, changes: Dict[str, Iterable[str]]) -> Optional[str]:
+    """Annoncer, avant une mutation, les documents qu'elle modifie ({collection: doc_ids}).
+    Retourne l'identifiant à passer à clear_intent() une fois les entrées inscrites.
+    """
+    changes = {collection: list(dict.fromkeys(i for i in doc_ids if i)) for collection, doc_ids in changes.items()}
+    if not any(changes.values()):
+        return None
+    intent_id = str(uuid.uuid4())
+    await db.change_intents.insert_one({
+        "_id": intent_id, "tenant_id": tenant_id, "changes": changes, "at": datetime.now(timezone.utc)
+    })
+    return intent_id
+
+
+async def clear_intent(intent_id: Optional[str]) -> None:
+    if intent_id:
+        await db.change_intents.delete_one({"_id": intent_id})
+
+
+@asynccontextmanager
+async def tracked_changes(tenant_id: str, changes: Dict[str, Iterable[str]], op: str = UPSERT):
+    """Encadrer une mutation des collections synchronisées ({collection: doc_ids}).
+    L'intention est écrite avant la mutation; à la sortie du bloc les documents sont
+    inscrits au journal puis l'intention retirée. Le bloc peut restreindre le dict
+    produit aux documents effectivement modifiés. Un refus (HTTPException 4xx) retire
+    l'intention sans rien inscrire; toute autre erreur la laisse à recover_pending_changes.
+    """
+    changes = {collection: list(doc_ids) for collection, doc_ids in changes.items()}
+    intent_id = await write_intent(tenant_id, changes)
+    try:
+        yield changes
+    except HTTPException as e:
+        if e.status_code < 500:
+            await clear_intent(intent_id)
+        raise
+    for collection, doc_ids in changes.items():
+        await record_changes(tenant_id, collection, doc_ids, op=op)
+    await clear_intent(intent_id)
+
+
+async def recover_pending_changes(max_age_minutes: int = 5) -> int:
+    """Inscrire au journal les mutations dont l'inscription a été interrompue.
+    L'opération est déduite de l'état courant: upsert si le document existe, suppression
+    sinon (une entrée en trop est sans effet pour les clients). Exécutée périodiquement
+    (server.recover_pending_operations): une intention récente peut être en cours.
+    """
+    threshold = datetime.now(timezone.utc) - timedelta(minutes=max_age_minutes)
+    resolved = 0
+    async for intent in db.change_intents.find({"at": {"$lt": threshold}}):
+        tenant_id = intent["tenant_id"]
+        for collection, doc_ids in intent.get("changes", {}).items():
+            existing = set(await db[collection].distinct("id", {"tenant_id": tenant_id, "id": {"$in": doc_ids}}))
+            await record_changes(tenant_id, collection, [i for i in doc_ids if i in existing])
+            await record_changes(tenant_id, collection, [i for i in doc_ids if i not in existing], op=DELETE)
+        await db.change_intents.delete_one({"_id": intent["_id"]})
+        resolved += 1
+    return resolved
+
+
+def _stale_gaps(entries: List[dict], checkpoint: int, compacted_through: int) -> List[int]:
+    """Numéros manquants suivis d'une entrée plus ancienne que GAP_GRACE (hors plage compactée)"""
+    now = datetime.now(timezone.utc)
+    expected = checkpoint + 1
+    missing = []
+    for entry in entries:
+        if entry["seq"] != expected and entry["seq"] > compacted_through:
+            if now - as_datetime(entry["at"]) < GAP_GRACE:
+                break
+            missing.extend(range(max(expected, compacted_through + 1), entry["seq"]))
+        expected = entry["seq"] + 1
+    return missing
+
+
+async def _fence(tenant_id: str, missing: List[int]):
+    """Boucher des numéros abandonnés; un doublon signifie que l'écrivain a fini entre-temps"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.change_log.insert_many([
+            {"tenant_id": tenant_id, "seq": seq, "op": SKIP, "at": now} for seq in missing
+        ], ordered=False)
+    except BulkWriteError as e:
+        if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+            raise
+
+
+def _contiguous(entries: List[dict], checkpoint: int, compacted_through: int = 0) -> List[dict]:
+    """Entrées lisibles sans risque: on s'arrête au premier trou de la séquence.
+    Dans la plage compactée, les trous sont des entrées retirées par la compaction.
+    """
+    expected = checkpoint + 1
+    safe = []
+    for entry in entries:
+        if entry["seq"] != expected and entry["seq"] > compacted_through:
+            break
+        safe.append(entry)
+        expected = entry["seq"] + 1
+    return safe
+
+
+async def _read_entries(tenant_id: str, checkpoint: int, limit: int) -> List[dict]:
+    return await db.change_log.find(
+        {"tenant_id": tenant_id, "seq": {"$gt": checkpoint}},
+        {"_id": 0, "seq": 1, "collection": 1, "doc_id": 1, "op": 1, "at": 1}
+    ).sort("seq", 1).limit(limit).to_list(limit)
+
+
+async def read_delta(tenant_id: str, checkpoint: int, limit: int) -> dict:
+    """Modifications après `checkpoint`: {upserts, deletes, next_checkpoint, has_more, reset_required}"""
+    upserts: Dict[str, List[dict]] = {c: [] for c in SYNCED_COLLECTIONS}
+    deletes: Dict[str, List[str]] = {c: [] for c in SYNCED_COLLECTIONS}
+    state = await db.counters.find_one(
+        {"_id": f"change_seq:{tenant_id}"}, {"_id": 0, "compacted_through": 1, "reset_before": 1}
+    ) or {}
+    if 0 < checkpoint < state.get("reset_before", 0):
+        # Des suppressions postérieures au checkpoint ont été purgées: resynchronisation complète
+        return {"upserts": upserts, "deletes": deletes, "next_checkpoint": 0, "has_more": True, "reset_required": True}
+    compacted_through = state.get("compacted_through", 0)
+
+    entries = await _read_entries(tenant_id, checkpoint, limit)
+    missing = _stale_gaps(entries, checkpoint, compacted_through)
+    if missing:
+        await _fence(tenant_id, missing)
+        entries = await _read_entries(tenant_id, checkpoint, limit)
+    safe = _contiguous(entries, checkpoint, compacted_through)
+
+    # Compactage: seule la dernière opération de chaque document compte
+    latest: Dict[tuple, str] = {}
+    for entry in safe:
+        if entry["op"] != SKIP:
+            latest[(entry["collection"], entry["doc_id"])] = entry["op"]
+
+    upsert_ids: Dict[str, List[str]] = {c: [] for c in SYNCED_COLLECTIONS}
+    for (collection, doc_id), op in latest.items():
+        (deletes if op == DELETE else upsert_ids)[collection].append(doc_id)
+
+    projection = {"_id": 0, **{f: 0 for f in _PRIVATE_FIELDS}}
+    for collection, ids in upsert_ids.items():
+        if ids:
+            # État courant des documents (une requête par collection); un document absent
+            # a été supprimé depuis: sa suppression figure plus loin dans le journal
+            upserts[collection] = await db[collection].find(
+                {"tenant_id": tenant_id, "id": {"$in": ids}}, projection
+            ).to_list(None)
+
+    return {
+        "upserts": upserts,
+        "deletes": deletes,
+        "next_checkpoint": safe[-1]["seq"] if safe else checkpoint,
+        "has_more": len(entries) == limit or len(safe) < len(entries),
+        "reset_required": False,
+    }
+
+
+def _obsolete_entries(seqs: List[int], op: str) -> Tuple[List[int], int]:
+    """Entrées retirables d'un document (numéros croissants, `op` = dernière opération)
+    et seuil de resynchronisation (0 si aucune suppression n'est purgée).
+    Un document existant garde sa dernière entrée; une suppression ou un "skip" disparaît entièrement.
+    """
+    if op == UPSERT:
+        return seqs[:-1], 0
+    return seqs, seqs[-1] + 1 if op == DELETE else 0
+
+
+async def compact_change_log(retention: timedelta = CHANGE_LOG_RETENTION) -> int:
+    """Compacter les entrées plus anciennes que `retention`: seule la dernière entrée
+    (non supprimée) de chaque document est conservée. Retourne le nombre d'entrées retirées.
+    """
+    cutoff = datetime.now(timezone.utc) - retention
+    removed = 0
+    for tenant_id in await db.change_log.distinct("tenant_id", {"at": {"$lt": cutoff}}):
+        last = await db.change_log.find_one(
+            {"tenant_id": tenant_id, "at": {"$lt": cutoff}}, {"_id": 0, "seq": 1}, sort=[("seq", -1)]
+        )
+        through = last["seq"]
+        # Les trous de la plage sont désormais attendus (voir _contiguous)
+        await db.counters.update_one({"_id": f"change_seq:{tenant_id}"}, {"$max": {"compacted_through": through}})
+        groups = db.change_log.aggregate([
+            {"$match": {"tenant_id": tenant_id, "seq": {"$lte": through}}},
+            {"$sort": {"seq": 1}},
+            {"$group": {
+                "_id": {"collection": "$collection", "doc_id": "$doc_id"},
+                "seqs": {"$push": "$seq"},
+                "op": {"$last": "$op"},
+            }},
+            {"$match": {"$or": [{"seqs.1": {"$exists": True}}, {"op": {"$in": [DELETE, SKIP]}}]}},
+        ], allowDiskUse=True)
+        obsolete, reset_before = [], 0
+        async for group in groups:
+            seqs, reset = _obsolete_entries(group["seqs"], group["op"])
+            obsolete.extend(seqs)
+            reset_before = max(reset_before, reset)
+            if len(obsolete) >= COMPACTION_BATCH_SIZE:
+                removed += await _purge(tenant_id, obsolete, reset_before)
+                obsolete = []
+        removed += await _purge(tenant_id, obsolete, reset_before)
+    return removed
+
+
+async def _purge(tenant_id: str, seqs: List[int], reset_before: int) -> int:
+    if not seqs:
+        return 0
+    # Le seuil de resynchronisation est posé avant la suppression des entrées
+    if reset_before:
+        await db.counters.update_one({"_id": f"change_seq:{tenant_id}"}, {"$max": {"reset_before": reset_before}})
+    result = await db.change_log.delete_many({"tenant_id": tenant_id, "seq": {"$in": seqs}})
+    return result.deleted_count
+
+
+async def compact_change_log_periodically():
+    """Compaction du journal toutes les COMPACTION_INTERVAL secondes"""
+    while True:
+        try:
+            removed = await compact_change_log()
+            if removed:
+                logger.info(f"Journal de synchronisation compacté: {removed} entrée(s) retirée(s)")
+        except Exception as e:
+            logger.error(f"Compaction du journal en échec: {e!r}")
+        await asyncio.sleep(COMPACTION_INTERVAL)
+
+
+async def _claim_seed(owner: str) -> bool:
+    """Prendre (ou prolonger) le verrou d'initialisation; False si un autre worker le détient"""
+    now = datetime.now(timezone.utc)
+    try:
+        state = await db.migrations.find_one_and_update(
+            {
+                "_id": SEED_MIGRATION_ID,
+                "completed": {"$ne": True},
+                "$or": [{"locked_by": owner}, {"locked_until": {"$exists": False}}, {"locked_until": {"$lt": now}}],
+            },
+            {"$set": {"locked_by": owner, "locked_until": now + SEED_LOCK_TTL}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Document existant mais verrouillé (ou terminé): l'upsert se heurte à _id
+        return False
+    return state is not None
+
+
+async def _seed_collection(collection_name: str, checkpoint, batch_size: int, owner: str):
+    collection = db[collection_name]
+    while True:
+        query = {"_id": {"$gt": checkpoint}} if checkpoint is not None else {}
+        batch = await collection.find(query, {"_id": 1, "id": 1, "tenant_id": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return
+        if not await _claim_seed(owner):
+            raise RuntimeError("verrou d'initialisation du journal perdu")
+        by_tenant: Dict[str, List[str]] = {}
+        for doc in batch:
+            if doc.get("tenant_id") and doc.get("id"):
+                by_tenant.setdefault(doc["tenant_id"], []).append(doc["id"])
+        for tenant_id, doc_ids in by_tenant.items():
+            await record_changes(tenant_id, collection_name, doc_ids)
+        checkpoint = batch[-1]["_id"]
+        await db.migrations.update_one(
+            {"_id": SEED_MIGRATION_ID},
+            {"$set": {f"checkpoints.{collection_name}": checkpoint, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        await asyncio.sleep(0.05)
+
+
+async def seed_change_log(batch_size: int = 500) -> None:
+    """Inscrire au journal les documents existants (une seule fois, reprenable).
+    Un seul worker à la fois: les autres trouvent le verrou pris et n'inscrivent rien.
+    """
+    owner = str(uuid.uuid4())
+    if not await _claim_seed(owner):
+        return
+    state = await db.migrations.find_one({"_id": SEED_MIGRATION_ID}) or {}
+    done = set(state.get("done", []))
+    checkpoints: Dict[str, Optional[object]] = state.get("checkpoints", {})
+    for collection_name in SYNCED_COLLECTIONS:
+        if collection_name in done:
+            continue
+        await _seed_collection(collection_name, checkpoints.get(collection_name), batch_size, owner)
+        await db.migrations.update_one({"_id": SEED_MIGRATION_ID}, {"$addToSet": {"done": collection_name}}, upsert=True)
+    await db.migrations.update_one(
+        {"_id": SEED_MIGRATION_ID},
+        {"$set": {"completed": True, "completed_at": datetime.now(timezone.utc)}, "$unset": {"locked_by": "", "locked_until": ""}},
+        upsert=True
+    )
+    logger.info("Journal de synchronisation initialisé")
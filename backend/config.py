@@ -10,9 +10,21 @@ SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'your-secret-key-change-in-product
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 hours
 
+# Hachage des mots de passe: coût bcrypt (les hachages d'un autre coût sont
+# recalculés à la connexion) et nombre de hachages simultanés (threads dédiés)
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# Cache des utilisateurs authentifiés: nombre de jetons et durée (secondes) avant
+# relecture de l'état du compte (actif, rôle, révocation) par les autres workers
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', '10000'))
+PRINCIPAL_CACHE_TTL = float(os.environ.get('PRINCIPAL_CACHE_TTL', '30'))
+
 # MongoDB configuration
 MONGO_URL = os.environ['MONGO_URL']
 DB_NAME = os.environ['DB_NAME']
+# Transactions: auto (détection replica set), on, off
+MONGO_TRANSACTIONS = os.environ.get('MONGO_TRANSACTIONS', 'auto').lower()
 
 # CORS configuration
 CORS_ORIGINS = os.environ.get('CORS_ORIGINS', '*').split(',')
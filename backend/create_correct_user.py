@@ -36,7 +36,7 @@ def generate_id():
     return str(uuid4())
 
 def get_timestamp(days_ago=0):
-    return (datetime.now(timezone.utc) - timedelta(days=days_ago)).isoformat()
+    return datetime.now(timezone.utc) - timedelta(days=days_ago)
 
 async def create_demo_data():
     """Créer toutes les données de démonstration"""
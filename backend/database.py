@@ -1,10 +1,23 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from config import MONGO_URL, DB_NAME
+from config import MONGO_URL, DB_NAME, MONGO_TRANSACTIONS
 
 # MongoDB connection
-client = AsyncIOMotorClient(MONGO_URL)
+# tz_aware: les datetime BSON sont relus en UTC avec fuseau
+client = AsyncIOMotorClient(MONGO_URL, tz_aware=True)
 db = client[DB_NAME]
 
+_transactions_supported = None
+
+async def supports_transactions() -> bool:
+    """Détecter si le déploiement supporte les transactions (replica set ou mongos)"""
+    global _transactions_supported
+    if MONGO_TRANSACTIONS in ("on", "off"):
+        return MONGO_TRANSACTIONS == "on"
+    if _transactions_supported is None:
+        hello = await client.admin.command("hello")
+        _transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+    return _transactions_supported
+
 async def close_db_connection():
     """Close database connection"""
     client.close()
@@ -0,0 +1,149 @@
+"""
+Dates stockées en datetime BSON natif.
+
+Les routes écrivent désormais des datetime (et non plus des chaînes ISO), ce qui
+permet les requêtes de plage indexées. Les anciens documents sont convertis par
+migrate_string_dates(), une migration par lots, reprenable, lancée en tâche de
+fond au démarrage. Tant qu'elle n'est pas terminée, date_range_query() couvre
+aussi les chaînes ISO restantes.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from pymongo import UpdateOne
+from database import db
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_ID = "bson_dates"
+
+# Champs date par collection ("items.<champ>" pour les tableaux de lignes)
+DATE_FIELDS: Dict[str, List[str]] = {
+    "products": ["created_at", "updated_at", "expiration_date"],
+    "sales": ["created_at"],
+    "returns": ["created_at"],
+    "customers": ["created_at"],
+    "categories": ["created_at"],
+    "units": ["created_at"],
+    "prescriptions": ["created_at"],
+    "users": ["created_at"],
+    "suppliers": ["created_at", "updated_at"],
+    "supplies": ["supply_date", "created_at", "updated_at", "validated_at", "items.date_peremption"],
+    "stock_movements": ["created_at"],
+    "price_history": ["created_at", "date_maj_prix", "date_appro", "date_peremption", "modified_at"],
+    "settings": ["created_at", "updated_at"],
+    "stock_layers": ["updated_at"],
+    "tenant_stats": ["updated_at"],
+    "sync_logs": ["timestamp"],
+}
+
+# Faux dès que la migration est terminée: les requêtes de plage ignorent alors les chaînes
+legacy_string_dates = True
+
+
+def as_datetime(value: Any) -> Optional[datetime]:
+    """Convertir une date stockée (datetime BSON ou ancienne chaîne ISO) en datetime UTC"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def date_range_query(field: str, **bounds: Optional[datetime]) -> dict:
+    """Condition de plage ($gte, $gt, $lt, $lte) sur un champ date.
+    Pendant la migration, les documents encore en chaîne ISO sont aussi couverts.
+    """
+    operators = {f"${op}": value for op, value in bounds.items() if value is not None}
+    if not legacy_string_dates:
+        return {field: operators}
+    # Les chaînes héritées sont en UTC ("...+00:00"): une borne avec un autre décalage
+    # est ramenée en UTC avant la comparaison lexicale
+    legacy = {op: as_datetime(value).astimezone(timezone.utc).isoformat() for op, value in operators.items()}
+    return {"$or": [{field: operators}, {field: legacy}]}
+
+
+def _convert(value: Any) -> Any:
+    try:
+        return as_datetime(value)
+    except ValueError:
+        # Chaîne non interprétable: laissée telle quelle
+        return value
+
+
+async def _migrate_collection(collection_name: str, fields: List[str], checkpoint, batch_size: int):
+    collection = db[collection_name]
+    top_fields = [f for f in fields if not f.startswith("items.")]
+    item_fields = [f.split(".", 1)[1] for f in fields if f.startswith("items.")]
+
+    query = {"$or": [{f: {"$type": "string"}} for f in fields]}
+    projection = {f: 1 for f in top_fields}
+    if item_fields:
+        projection["items"] = 1
+
+    while True:
+        batch_query = dict(query)
+        if checkpoint is not None:
+            batch_query["_id"] = {"$gt": checkpoint}
+        batch = await collection.find(batch_query, projection).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return
+
+        operations = []
+        for doc in batch:
+            for field in top_fields:
+                if isinstance(doc.get(field), str):
+                    converted = _convert(doc[field])
+                    if converted is not doc[field]:
+                        # Conditionné sur l'ancienne valeur: une écriture concurrente n'est jamais écrasée
+                        operations.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: converted}}))
+            if item_fields and doc.get("items"):
+                items = [dict(item) for item in doc["items"]]
+                for item in items:
+                    for field in item_fields:
+                        if isinstance(item.get(field), str):
+                            item[field] = _convert(item[field])
+                if items != doc["items"]:
+                    operations.append(UpdateOne({"_id": doc["_id"], "items": doc["items"]}, {"$set": {"items": items}}))
+        if operations:
+            await collection.bulk_write(operations, ordered=False)
+
+        checkpoint = batch[-1]["_id"]
+        await db.migrations.update_one(
+            {"_id": MIGRATION_ID},
+            {"$set": {f"checkpoints.{collection_name}": checkpoint, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        # Laisser la main aux requêtes en cours entre deux lots
+        await asyncio.sleep(0.05)
+
+
+async def migrate_string_dates(batch_size: int = 500) -> None:
+    """Convertir les dates ISO stockées en chaînes vers des datetime BSON.
+    Reprend au dernier _id traité de chaque collection (collection migrations).
+    """
+    global legacy_string_dates
+    state = await db.migrations.find_one({"_id": MIGRATION_ID}) or {}
+    if state.get("completed"):
+        legacy_string_dates = False
+        return
+
+    done = set(state.get("done", []))
+    checkpoints = state.get("checkpoints", {})
+    for collection_name, fields in DATE_FIELDS.items():
+        if collection_name in done:
+            continue
+        await _migrate_collection(collection_name, fields, checkpoints.get(collection_name), batch_size)
+        await db.migrations.update_one({"_id": MIGRATION_ID}, {"$addToSet": {"done": collection_name}}, upsert=True)
+        logger.info(f"Migration des dates terminée pour {collection_name}")
+
+    await db.migrations.update_one(
+        {"_id": MIGRATION_ID},
+        {"$set": {"completed": True, "completed_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    legacy_string_dates = False
+    logger.info("Migration des dates ISO vers datetime BSON terminée")
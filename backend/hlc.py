@@ -0,0 +1,93 @@
+"""
+Horloge logique hybride (HLC) pour la résolution des conflits de synchronisation.
+
+Un horodatage HLC combine l'heure physique (ms) et un compteur logique, suivis
+de l'identifiant du nœud qui l'a produit. Il est encodé en chaîne de largeur
+fixe, "000001718000000000:000003:till-2": l'ordre lexicographique est l'ordre
+causal, ce qui permet de comparer et stocker les versions telles quelles.
+
+Chaque champ synchronisé d'un produit ou d'un client porte sa version dans
+field_versions.<champ>. Une modification n'est appliquée que si son horodatage
+est plus récent que la version du champ (le plus récent l'emporte, champ par
+champ): deux caisses qui modifient hors ligne l'une le prix, l'autre le nom
+d'un même produit ne s'écrasent plus.
+"""
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+# Avance maximale acceptée pour l'horloge d'un client (ms)
+MAX_CLOCK_DRIFT_MS = 60 * 60 * 1000
+
+_PHYSICAL_WIDTH = 18
+_COUNTER_WIDTH = 6
+
+
+def encode(physical_ms: int, counter: int, node: str) -> str:
+    return f"{physical_ms:0{_PHYSICAL_WIDTH}d}:{counter:0{_COUNTER_WIDTH}d}:{node}"
+
+
+def parse(timestamp: str) -> Optional[Tuple[int, int, str]]:
+    """(ms, compteur, nœud), ou None si la chaîne n'est pas un horodatage HLC"""
+    if not isinstance(timestamp, str):
+        return None
+    parts = timestamp.split(":", 2)
+    if len(parts) != 3 or len(parts[0]) != _PHYSICAL_WIDTH or len(parts[1]) != _COUNTER_WIDTH:
+        return None
+    if not (parts[0].isdigit() and parts[1].isdigit() and parts[2]):
+        return None
+    return int(parts[0]), int(parts[1]), parts[2]
+
+
+class HybridLogicalClock:
+    """Horloge HLC d'un nœud (ici: un processus serveur)"""
+
+    def __init__(self, node: str):
+        self.node = node
+        self.physical = 0
+        self.counter = 0
+        self._lock = threading.Lock()
+
+    def now(self) -> str:
+        """Horodatage local, strictement croissant"""
+        with self._lock:
+            wall = int(time.time() * 1000)
+            if wall > self.physical:
+                self.physical, self.counter = wall, 0
+            else:
+                self.counter += 1
+            return encode(self.physical, self.counter, self.node)
+
+    def observe(self, remote: str) -> str:
+        """Intégrer un horodatage reçu: l'horloge locale reste au-delà de tout ce qu'elle a vu.
+        ValueError si l'horodatage est invalide ou trop en avance sur l'heure du serveur.
+        """
+        parsed = parse(remote)
+        if parsed is None:
+            raise ValueError(f"horodatage HLC invalide: {remote!r}")
+        remote_physical, remote_counter, _ = parsed
+        with self._lock:
+            wall = int(time.time() * 1000)
+            if remote_physical > wall + MAX_CLOCK_DRIFT_MS:
+                raise ValueError("horloge du client trop en avance sur le serveur")
+            physical = max(wall, self.physical, remote_physical)
+            if physical == self.physical == remote_physical:
+                counter = max(self.counter, remote_counter) + 1
+            elif physical == self.physical:
+                counter = self.counter + 1
+            elif physical == remote_physical:
+                counter = remote_counter + 1
+            else:
+                counter = 0
+            self.physical, self.counter = physical, counter
+            return encode(physical, counter, self.node)
+
+
+# Horloge du processus serveur (le pid départage deux workers à la même milliseconde)
+server_clock = HybridLogicalClock(f"server-{os.getpid()}")
+
+
+def field_version_updates(fields, stamp: str) -> dict:
+    """$set des versions de champs: {"field_versions.<champ>": stamp}"""
+    return {f"field_versions.{field}": stamp for field in fields}
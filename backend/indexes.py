@@ -0,0 +1,263 @@
+"""
+Déclaration et réconciliation des index MongoDB.
+
+Chaque collection déclare ses index dans INDEXES. Au démarrage du serveur,
+ensure_indexes() compare ces déclarations avec les index existants:
+- les index manquants sont créés,
+- les index dont la définition a changé (même nom, clés/options différentes)
+  sont recréés; l'ancien n'est supprimé qu'une fois la nouvelle définition
+  vérifiée, et il est restauré si la création échoue malgré tout,
+- les index présents en base mais non déclarés sont signalés (jamais supprimés).
+Un index unique est vérifié avant création (recherche des doublons): s'il ne
+peut pas être créé, ensure_indexes() lève IndexReconciliationError après avoir
+traité toutes les collections, avec les doublons trouvés. Le démarrage échoue
+plutôt que de servir sans contrainte d'unicité.
+L'opération est idempotente: un second appel ne modifie rien.
+"""
+import logging
+from typing import Dict, List, Tuple, Any
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Options d'index prises en compte pour la détection de dérive
+_COMPARED_OPTIONS = ("unique", "sparse", "partialFilterExpression", "collation", "expireAfterSeconds")
+# Nombre de groupes de doublons rapportés par index
+DUPLICATE_REPORT_LIMIT = 20
+
+# Index effectivement présents (collection -> noms), renseigné par ensure_indexes()
+_ready: Dict[str, set] = {}
+
+
+class IndexReconciliationError(RuntimeError):
+    """Un ou plusieurs index uniques n'ont pas pu être créés"""
+
+    def __init__(self, message: str, report: Dict[str, Dict[str, List[str]]]):
+        super().__init__(message)
+        self.report = report
+
+
+def _index(name: str, keys: List[Tuple[str, int]], **options) -> Dict[str, Any]:
+    return {"name": name, "keys": keys, "options": options}
+
+
+# Index déclarés par collection
+INDEXES: Dict[str, List[Dict[str, Any]]] = {
+    "products": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_id_id", [("tenant_id", ASCENDING), ("id", ASCENDING)]),
+        # Unicité par tenant; les produits sans code-barres / sans clé sont hors index
+        _index("tenant_barcode", [("tenant_id", ASCENDING), ("barcode", ASCENDING)],
+               unique=True, partialFilterExpression={"barcode": {"$type": "string"}}),
+        _index("tenant_name_key_unique", [("tenant_id", ASCENDING), ("name_key", ASCENDING)],
+               unique=True, partialFilterExpression={"name_key": {"$type": "string"}}),
+        _index("tenant_name", [("tenant_id", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)]),
+        # Rafraîchissement incrémental de l'index de recherche (product_search)
+        _index("tenant_updated_at", [("tenant_id", ASCENDING), ("updated_at", ASCENDING)]),
+    ],
+    "sales": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_id_id", [("tenant_id", ASCENDING), ("id", ASCENDING)]),
+        _index("tenant_created_at", [("tenant_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        # Retours interrompus à reprendre (routes.returns.recover_pending_returns)
+        _index("pending_returns", [("pending_returns", ASCENDING)], sparse=True),
+    ],
+    "returns": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_sale", [("tenant_id", ASCENDING), ("sale_id", ASCENDING)]),
+        _index("tenant_created_at", [("tenant_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "stock_movements": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_product_created_at", [("tenant_id", ASCENDING), ("product_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        _index("tenant_created_at", [("tenant_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        _index("tenant_reference", [("tenant_id", ASCENDING), ("reference_type", ASCENDING), ("reference_id", ASCENDING)]),
+    ],
+    "stock_layers": [
+        _index("tenant_product_unique", [("tenant_id", ASCENDING), ("product_id", ASCENDING)], unique=True),
+        # Couches à reconstruire (routes.stock.rebuild_stale_stock_layers)
+        _index("stale_at", [("stale_at", ASCENDING)], sparse=True),
+    ],
+    "price_history": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_product_created_at", [("tenant_id", ASCENDING), ("product_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        _index("tenant_created_at", [("tenant_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "supplies": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_id_id", [("tenant_id", ASCENDING), ("id", ASCENDING)]),
+        _index("tenant_validated_created_at", [("tenant_id", ASCENDING), ("is_validated", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        _index("tenant_supplier", [("tenant_id", ASCENDING), ("supplier_id", ASCENDING)]),
+    ],
+    "suppliers": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_id_id", [("tenant_id", ASCENDING), ("id", ASCENDING)]),
+        _index("tenant_name", [("tenant_id", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "customers": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_id_id", [("tenant_id", ASCENDING), ("id", ASCENDING)]),
+        _index("tenant_name", [("tenant_id", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "categories": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_id_id", [("tenant_id", ASCENDING), ("id", ASCENDING)]),
+        _index("tenant_name", [("tenant_id", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "units": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_id_id", [("tenant_id", ASCENDING), ("id", ASCENDING)]),
+        _index("tenant_name", [("tenant_id", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)]),
+    ],
+    "prescriptions": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_status", [("tenant_id", ASCENDING), ("status", ASCENDING)]),
+        _index("tenant_created_at", [("tenant_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "users": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("email", [("email", ASCENDING)]),
+        _index("tenant_employee_code", [("tenant_id", ASCENDING), ("employee_code", ASCENDING)]),
+        _index("tenant_created_at", [("tenant_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "settings": [
+        _index("tenant_unique", [("tenant_id", ASCENDING)], unique=True),
+    ],
+    "tenant_stats": [
+        _index("tenant_day_unique", [("tenant_id", ASCENDING), ("day", ASCENDING)], unique=True),
+    ],
+    "import_jobs": [
+        _index("id_unique", [("id", ASCENDING)], unique=True),
+        _index("tenant_started_at", [("tenant_id", ASCENDING), ("started_at", DESCENDING)]),
+    ],
+    "change_log": [
+        _index("tenant_seq_unique", [("tenant_id", ASCENDING), ("seq", ASCENDING)], unique=True),
+        # Compaction des entrées anciennes (change_log.compact_change_log)
+        _index("at", [("at", ASCENDING)]),
+    ],
+    "change_intents": [
+        # Intentions interrompues (change_log.recover_pending_changes)
+        _index("at", [("at", ASCENDING)]),
+    ],
+    "sync_logs": [
+        _index("tenant_timestamp", [("tenant_id", ASCENDING), ("timestamp", DESCENDING)]),
+        _index("tenant_change_id_unique", [("tenant_id", ASCENDING), ("change_id", ASCENDING)],
+               unique=True, partialFilterExpression={"change_id": {"$type": "string"}}),
+    ],
+}
+
+
+def _normalize_keys(keys) -> List[Tuple[str, int]]:
+    return [(field, int(direction)) for field, direction in keys]
+
+
+def _spec_differs(declared: Dict[str, Any], existing: Dict[str, Any]) -> bool:
+    """Comparer une déclaration avec l'index existant (clés + options significatives)"""
+    if _normalize_keys(declared["keys"]) != _normalize_keys(existing.get("key", [])):
+        return True
+    for option in _COMPARED_OPTIONS:
+        if declared["options"].get(option) != existing.get(option):
+            # unique/sparse absents équivalent à False
+            if option in ("unique", "sparse") and not declared["options"].get(option) and not existing.get(option):
+                continue
+            return True
+    return False
+
+
+def index_ready(collection_name: str, name: str) -> bool:
+    """L'index déclaré existe-t-il (réconcilié avec succès au démarrage)?"""
+    return name in _ready.get(collection_name, set())
+
+
+async def find_duplicates(collection, declared: Dict[str, Any], limit: int = DUPLICATE_REPORT_LIMIT) -> List[dict]:
+    """Groupes de documents qui violeraient un index unique: [{key, count, ids}]"""
+    fields = [field for field, _ in declared["keys"]]
+    pipeline = []
+    partial = declared["options"].get("partialFilterExpression")
+    if partial:
+        pipeline.append({"$match": partial})
+    pipeline += [
+        {"$group": {
+            "_id": {field.replace(".", "_"): f"${field}" for field in fields},
+            "count": {"$sum": 1},
+            "ids": {"$push": {"$ifNull": ["$id", "$_id"]}},
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "key": "$_id", "count": 1, "ids": {"$slice": ["$ids", 10]}}},
+    ]
+    return await collection.aggregate(pipeline, allowDiskUse=True).to_list(limit)
+
+
+async def _rebuild_index(collection, declared: Dict[str, Any], current: Dict[str, Any]):
+    """Remplacer un index dont la définition a changé; l'ancien est restauré si la création échoue"""
+    name = declared["name"]
+    await collection.drop_index(name)
+    try:
+        await collection.create_index(declared["keys"], name=name, **declared["options"])
+    except OperationFailure:
+        previous = {option: current[option] for option in _COMPARED_OPTIONS if option in current}
+        try:
+            await collection.create_index(list(current["key"]), name=name, **previous)
+        except OperationFailure as e:
+            logger.error(f"Index {collection.name}.{name}: restauration de l'ancienne définition impossible: {e}")
+        raise
+
+
+async def ensure_indexes(database, declarations: Dict[str, List[Dict[str, Any]]] = None) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Réconcilier les index déclarés avec ceux présents en base.
+    Retourne un rapport par collection: created, rebuilt, unchanged, undeclared, failed.
+    Lève IndexReconciliationError si un index unique n'a pas pu être créé.
+    """
+    declarations = declarations or INDEXES
+    report = {}
+    fatal = []
+
+    for collection_name, declared_indexes in declarations.items():
+        collection = database[collection_name]
+        existing = await collection.index_information()
+        entry = {"created": [], "rebuilt": [], "unchanged": [], "undeclared": [], "failed": []}
+
+        for declared in declared_indexes:
+            name = declared["name"]
+            current = existing.get(name)
+            unique = declared["options"].get("unique", False)
+            try:
+                if current is not None and not _spec_differs(declared, current):
+                    entry["unchanged"].append(name)
+                    continue
+                if unique:
+                    # Vérifier avant de toucher à l'index existant
+                    duplicates = await find_duplicates(collection, declared)
+                    if duplicates:
+                        raise OperationFailure(f"doublons existants: {duplicates}")
+                if current is None:
+                    await collection.create_index(declared["keys"], name=name, **declared["options"])
+                    entry["created"].append(name)
+                else:
+                    await _rebuild_index(collection, declared, current)
+                    entry["rebuilt"].append(name)
+            except OperationFailure as e:
+                # Ex: doublons existants empêchant un index unique
+                logger.error(f"Index {collection_name}.{name} non créé: {e}")
+                entry["failed"].append(name)
+                if unique:
+                    fatal.append(f"{collection_name}.{name}: {e}")
+
+        declared_names = {d["name"] for d in declared_indexes} | {"_id_"}
+        entry["undeclared"] = sorted(n for n in existing if n not in declared_names)
+        report[collection_name] = entry
+        _ready[collection_name] = (
+            {n for n in existing if n not in entry["failed"]} | set(entry["created"]) | set(entry["rebuilt"])
+        )
+
+        if entry["created"] or entry["rebuilt"]:
+            logger.info(f"Index {collection_name}: créés={entry['created']} recréés={entry['rebuilt']}")
+        if entry["undeclared"]:
+            logger.warning(f"Dérive d'index sur {collection_name}: index non déclarés {entry['undeclared']}")
+
+    if fatal:
+        raise IndexReconciliationError("Index uniques non créés:\n" + "\n".join(fatal), report)
+    return report
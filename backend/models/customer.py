@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional
+from typing import Dict, Optional
 from datetime import datetime, timezone
 import uuid
 
@@ -10,6 +10,7 @@ class Customer(BaseModel):
     phone: Optional[str] = None
     email: Optional[str] = None
     address: Optional[str] = None
+    field_versions: Dict[str, str] = Field(default_factory=dict)  # Horodatage HLC de chaque champ (synchronisation)
     tenant_id: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
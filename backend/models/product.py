@@ -1,12 +1,14 @@
-from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional
+from pydantic import BaseModel, Field, ConfigDict, field_validator, model_validator
+from typing import Dict, Optional
 from datetime import datetime, timezone
 import uuid
+from names import name_key, clean_barcode
 
 class Product(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     name: str
+    name_key: Optional[str] = None  # Nom normalisé (unique par tenant)
     internal_reference: Optional[str] = None  # Référence interne
     barcode: Optional[str] = None
     description: Optional[str] = None
@@ -18,10 +20,23 @@ class Product(BaseModel):
     unit_id: Optional[str] = None  # Unité de produit (Boîte, Flacon...)
     expiration_date: Optional[datetime] = None  # Date de péremption
     is_active: bool = True
+    field_versions: Dict[str, str] = Field(default_factory=dict)  # Horodatage HLC de chaque champ (synchronisation)
     tenant_id: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+    @field_validator('barcode')
+    @classmethod
+    def normalize_barcode(cls, v: Optional[str]) -> Optional[str]:
+        """Code-barres vide -> None (hors index unique)"""
+        return clean_barcode(v)
+
+    @model_validator(mode='after')
+    def compute_name_key(self):
+        """Clé de nom normalisée, toujours dérivée du nom"""
+        self.name_key = name_key(self.name)
+        return self
+
 class ProductCreate(BaseModel):
     name: str
     internal_reference: Optional[str] = None
@@ -35,3 +50,8 @@ class ProductCreate(BaseModel):
     unit_id: Optional[str] = None
     expiration_date: Optional[datetime] = None  # Date de péremption
     is_active: bool = True
+
+    @field_validator('barcode')
+    @classmethod
+    def normalize_barcode(cls, v: Optional[str]) -> Optional[str]:
+        return clean_barcode(v)
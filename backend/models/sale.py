@@ -14,6 +14,8 @@ class Sale(BaseModel):
     tenant_id: str
     user_id: Optional[str] = None
     employee_code: Optional[str] = None  # Code employé du vendeur
+    client_employee_code: Optional[str] = None  # Vente hors ligne: code déclaré par le poste, non vérifié
+    returned_quantities: Dict[str, int] = Field(default_factory=dict)  # Quantités déjà retournées par produit
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class SaleCreate(BaseModel):
@@ -13,6 +13,7 @@ class Settings(BaseModel):
     low_stock_threshold: int = 10  # Seuil de stock bas
     return_delay_days: int = 3  # Délai maximum pour les retours (en jours)
     expiration_alert_days: int = 30  # Délai pour alerter sur les produits à péremption proche (en jours)
+    version: int = 0  # Incrémenté à chaque modification (cohérence des caches entre workers)
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
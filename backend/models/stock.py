@@ -24,6 +24,7 @@ class StockMovement(BaseModel):
     stock_after: int   # Stock après le mouvement
     reference_type: Optional[str] = None  # supply, sale, return, adjustment
     reference_id: Optional[str] = None    # ID de la référence
+    unit_cost: Optional[float] = None     # Coût unitaire des entrées (couches de valorisation)
     notes: Optional[str] = None
     tenant_id: str
     
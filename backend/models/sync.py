@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from datetime import datetime, timezone
 import uuid
 
@@ -13,6 +13,13 @@ class SyncLog(BaseModel):
     user_id: str
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     synced: bool = False
+    change_id: Optional[str] = None  # Identifiant généré par le client (déduplication des rejeux)
+    status: Optional[str] = None  # pending (réservée, en cours), applied, duplicate, not_found, rejected, conflict
+    error: Optional[str] = None
+    conflicts: List[Dict[str, Any]] = Field(default_factory=list)  # Champs refusés (version serveur plus récente)
+    claim_token: Optional[str] = None  # Envoi qui détient la réservation (status pending)
 
 class SyncData(BaseModel):
+    # {id, type, action, payload, hlc?, base?}: validées une à une pour qu'une modification
+    # invalide n'empêche pas l'envoi des autres
     changes: List[Dict[str, Any]]
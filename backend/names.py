@@ -0,0 +1,27 @@
+"""
+Clés de noms normalisées.
+
+name_key() réduit un libellé à une forme comparable (casse et accents ignorés,
+espaces réduits): "  Doliprane  1000 mg" et "doliprane 1000 MG" donnent la même
+clé. Elle est stockée sur les produits (name_key) et couverte par un index
+unique (tenant_id, name_key): la détection des doublons est faite par la base.
+"""
+import unicodedata
+from typing import Optional
+
+
+def name_key(value: Optional[str]) -> Optional[str]:
+    """Clé de comparaison d'un nom: sans accents, casefold, espaces réduits"""
+    if value is None:
+        return None
+    decomposed = unicodedata.normalize("NFKD", value)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+def clean_barcode(value: Optional[str]) -> Optional[str]:
+    """Code-barres sans espaces; None si vide (hors index unique)"""
+    if value is None:
+        return None
+    value = value.strip()
+    return value or None
@@ -0,0 +1,111 @@
+"""
+Pagination par clé (keyset) des routes de liste.
+
+Une page est lue avec un tri stable terminé par "id" et une borne dérivée du
+dernier document de la page précédente (curseur opaque), au lieu d'un skip ou
+d'un plafond to_list(1000). La mémoire par requête est bornée par `limit` et
+un client peut parcourir un tenant de taille arbitraire.
+
+Le curseur suivant est renvoyé dans l'en-tête X-Next-Cursor (absent sur la
+dernière page): le corps des réponses reste une liste, comme auparavant.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import HTTPException, Response
+import dates
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MAX_PAGE_SIZE = 1000
+
+# Tris usuels (le champ "id" est ajouté automatiquement comme départage)
+NEWEST_FIRST = [("created_at", -1)]
+BY_NAME = [("name", 1)]
+
+
+def _key_fields(sort: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    if sort[-1][0] == "id":
+        return sort
+    return sort + [("id", sort[-1][1])]
+
+
+def _get_path(doc: dict, field: str) -> Any:
+    value = doc
+    for part in field.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """Encoder les valeurs de tri du dernier document en curseur opaque"""
+    payload = [{"$dt": v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    """Décoder un curseur; 400 s'il est illisible ou ne correspond pas au tri"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        if not isinstance(payload, list) or len(payload) != size:
+            raise ValueError
+        return [dates.as_datetime(v["$dt"]) if isinstance(v, dict) and "$dt" in v else v for v in payload]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Curseur de pagination invalide")
+
+
+def cursor_values(doc: dict, sort: List[Tuple[str, int]]) -> List[Any]:
+    return [_get_path(doc, field) for field, _ in _key_fields(sort)]
+
+
+def keyset_filter(sort: List[Tuple[str, int]], values: List[Any]) -> Dict[str, Any]:
+    """Condition "après le curseur" pour un tri multi-champs:
+    (a > va) OU (a = va ET b > vb) OU ... (sens inversé pour un tri décroissant)
+    """
+    fields = _key_fields(sort)
+    clauses = []
+    for i, (field, direction) in enumerate(fields):
+        prefix = {f: v for (f, _), v in zip(fields[:i], values[:i])}
+        clauses.append({**prefix, field: {"$gt" if direction > 0 else "$lt": values[i]}})
+        # Pendant la migration des dates, les chaînes ISO sont triées après les
+        # datetime en ordre décroissant: elles restent toutes à parcourir
+        if direction < 0 and isinstance(values[i], datetime) and dates.legacy_string_dates:
+            clauses.append({**prefix, field: {"$type": "string"}})
+    return {"$or": clauses}
+
+
+def after_cursor(query: Dict[str, Any], sort: List[Tuple[str, int]], cursor: Optional[str]) -> Dict[str, Any]:
+    """Restreindre une requête aux documents situés après le curseur"""
+    if not cursor:
+        return query
+    return {"$and": [query, keyset_filter(sort, decode_cursor(cursor, len(_key_fields(sort))))]}
+
+
+def sort_spec(sort: List[Tuple[str, int]]) -> Dict[str, int]:
+    """Tri (départage par id inclus) au format $sort d'un pipeline d'agrégation"""
+    return dict(_key_fields(sort))
+
+
+async def fetch_page(
+    collection,
+    query: Dict[str, Any],
+    sort: List[Tuple[str, int]],
+    limit: int,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    """Lire une page triée; retourne (documents, curseur suivant ou None)"""
+    fields = _key_fields(sort)
+    query = after_cursor(query, sort, cursor)
+    docs = await collection.find(query, projection or {"_id": 0}).sort(fields).limit(limit + 1).to_list(limit + 1)
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    return docs, encode_cursor(cursor_values(docs[-1], sort))
+
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]) -> None:
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
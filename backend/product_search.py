@@ -0,0 +1,293 @@
+"""
+Recherche produits du point de vente (GET /products/search).
+
+Un index mémoire par tenant, construit au premier appel puis tenu à jour:
+- code-barres exact: dictionnaire, réponse immédiate pour une douchette,
+- préfixe: tableau trié des clés de nom normalisées (names.name_key), de
+  leurs suffixes à chaque début de mot et des codes-barres, parcouru par
+  dichotomie ("para" trouve "Doliprane paracetamol 500"),
+- approché: index inversé de trigrammes, classé par similarité (Jaccard), pour
+  les fautes de frappe sur les noms de médicaments ("amoxiciline").
+
+Les écritures de ce processus mettent l'index à jour immédiatement
+(upsert_product / remove_product). Les écritures des autres workers sont
+rattrapées au plus toutes les REFRESH_INTERVAL secondes par une relecture des
+produits modifiés depuis le dernier rafraîchissement (updated_at). Les
+documents renvoyés sont relus en base par id: stock et prix sont toujours à jour
+et un produit supprimé ailleurs disparaît des résultats.
+
+La mémoire est bornée: au plus MAX_TENANT_INDEXES index sont conservés (le
+moins récemment utilisé est évincé) et un index inutilisé depuis
+INDEX_IDLE_TTL secondes est libéré; il sera reconstruit au besoin.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from database import db
+from dates import as_datetime, date_range_query
+from names import name_key, clean_barcode
+
+# Délai maximal (secondes) avant prise en compte des écritures d'un autre worker
+REFRESH_INTERVAL = 2.0
+# Recouvrement de la relecture incrémentale (horloges et écritures concurrentes)
+REFRESH_OVERLAP = timedelta(seconds=5)
+# Nombre maximal d'entrées parcourues pour une recherche par préfixe (requêtes très courtes)
+PREFIX_SCAN_LIMIT = 2000
+# Similarité minimale (trigrammes communs / trigrammes distincts) d'un résultat approché
+FUZZY_MIN_SIMILARITY = 0.3
+# Longueur minimale de requête pour la recherche approchée
+FUZZY_MIN_LENGTH = 3
+# Nombre maximal de candidats évalués par la recherche approchée
+FUZZY_MAX_CANDIDATES = 3000
+# Nombre maximal d'index de tenants conservés en mémoire (LRU)
+MAX_TENANT_INDEXES = 50
+# Durée (secondes) sans recherche au-delà de laquelle un index est libéré
+INDEX_IDLE_TTL = 30 * 60
+
+_PROJECTION = {"_id": 0, "id": 1, "name": 1, "name_key": 1, "barcode": 1, "updated_at": 1}
+
+
+def trigrams(key: str) -> Set[str]:
+    """Trigrammes d'une clé de nom, bornés par des espaces ("  do", " do", "dol", ...)"""
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _prefix_entries(product_id: str, key: Optional[str], barcode: Optional[str]) -> List[Tuple[str, int, str]]:
+    """Entrées du tableau des préfixes: (texte, rang, id).
+    Rang 0: nom complet, 1: nom à partir d'un mot suivant, 2: code-barres (saisie partielle).
+    """
+    entries = []
+    if key:
+        entries.append((key, 0, product_id))
+        entries.extend((key[position + 1:], 1, product_id) for position, char in enumerate(key) if char == " ")
+    if barcode:
+        entries.append((name_key(barcode), 2, product_id))
+    return entries
+
+
+class TenantSearchIndex:
+    """Index de recherche des produits d'un tenant"""
+
+    def __init__(self):
+        self.keys: Dict[str, str] = {}                 # id -> name_key
+        self.barcodes: Dict[str, str] = {}             # code-barres -> id
+        self.barcode_of: Dict[str, str] = {}           # id -> code-barres
+        self.prefixes: List[Tuple[str, int, str]] = [] # (texte, rang, id), trié
+        self.postings: Dict[str, Set[str]] = {}        # trigramme -> ids
+        self.watermark: Optional[datetime] = None      # updated_at max relu en base
+        self.refreshed_at = 0.0
+        self.used_at = 0.0
+
+    def upsert(self, product: dict, _sorted: bool = True):
+        product_id = product['id']
+        key = product.get('name_key') or name_key(product.get('name'))
+        barcode = clean_barcode(product.get('barcode'))
+        # Cas courant du rafraîchissement: seul le stock ou le prix a changé
+        if self.keys.get(product_id) == key and self.barcode_of.get(product_id) == barcode:
+            return
+        self.remove(product_id)
+        for entry in _prefix_entries(product_id, key, barcode):
+            if _sorted:
+                insort(self.prefixes, entry)
+            else:
+                self.prefixes.append(entry)
+        if key:
+            self.keys[product_id] = key
+            for trigram in trigrams(key):
+                self.postings.setdefault(trigram, set()).add(product_id)
+        if barcode:
+            self.barcodes[barcode] = product_id
+            self.barcode_of[product_id] = barcode
+
+    def load(self, products: Iterable[dict]):
+        """Chargement initial: un seul tri au lieu d'une insertion triée par produit"""
+        for product in products:
+            self.upsert(product, _sorted=False)
+        self.prefixes.sort()
+
+    def remove(self, product_id: str):
+        key = self.keys.pop(product_id, None)
+        barcode = self.barcode_of.pop(product_id, None)
+        for entry in _prefix_entries(product_id, key, barcode):
+            position = bisect_left(self.prefixes, entry)
+            if position < len(self.prefixes) and self.prefixes[position] == entry:
+                del self.prefixes[position]
+        if key:
+            for trigram in trigrams(key):
+                ids = self.postings.get(trigram)
+                if ids is not None:
+                    ids.discard(product_id)
+                    if not ids:
+                        del self.postings[trigram]
+        if barcode and self.barcodes.get(barcode) == product_id:
+            del self.barcodes[barcode]
+
+    def search(self, q: str, limit: int) -> List[str]:
+        """Ids classés: code-barres exact, puis préfixe du nom, préfixe d'un mot, puis approché"""
+        barcode = clean_barcode(q)
+        if barcode and barcode in self.barcodes:
+            return [self.barcodes[barcode]]
+        key = name_key(q)
+        if not key:
+            return []
+
+        # Préfixes, par rang (début du nom, début d'un mot, code-barres) puis alphabétique.
+        # Le parcours s'arrête dès que le premier rang suffit, ou après PREFIX_SCAN_LIMIT entrées.
+        by_rank: Dict[int, List[str]] = {0: [], 1: [], 2: []}
+        position = bisect_left(self.prefixes, (key,))
+        end = min(len(self.prefixes), position + PREFIX_SCAN_LIMIT)
+        while position < end and len(by_rank[0]) < limit:
+            text, rank, product_id = self.prefixes[position]
+            if not text.startswith(key):
+                break
+            by_rank[rank].append(product_id)
+            position += 1
+        results, seen = [], set()
+        for rank in (0, 1, 2):
+            for product_id in by_rank[rank]:
+                if product_id not in seen:
+                    seen.add(product_id)
+                    results.append(product_id)
+        if len(results) >= limit or len(key) < FUZZY_MIN_LENGTH:
+            return results[:limit]
+
+        for product_id in self.fuzzy(key):
+            if product_id not in seen:
+                results.append(product_id)
+                if len(results) >= limit:
+                    break
+        return results
+
+    def fuzzy(self, key: str) -> List[str]:
+        """Ids dont la clé partage assez de trigrammes avec la requête, du plus proche au moins proche"""
+        query_trigrams = sorted(trigrams(key), key=lambda t: len(self.postings.get(t, ())))
+        postings = [self.postings.get(t, set()) for t in query_trigrams]
+        # Similarité >= seuil => au moins min_shared trigrammes communs: un candidat figure
+        # forcément dans l'un des (n - min_shared + 1) trigrammes les plus rares.
+        # Au-delà de FUZZY_MAX_CANDIDATES, la recherche s'arrête (latence bornée).
+        min_shared = max(1, math.ceil(FUZZY_MIN_SIMILARITY * len(query_trigrams)))
+        candidates = set()
+        for ids in postings[:len(postings) - min_shared + 1]:
+            if candidates and len(candidates) + len(ids) > FUZZY_MAX_CANDIDATES:
+                break
+            candidates.update(ids)
+        scored = []
+        for product_id in candidates:
+            shared = sum(1 for ids in postings if product_id in ids)
+            candidate = self.keys[product_id]
+            # Majorant du nombre de trigrammes de la candidate (sans les recalculer)
+            similarity = shared / (len(query_trigrams) + len(candidate) + 1 - shared)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                scored.append((-similarity, candidate, product_id))
+        scored.sort()
+        return [product_id for _, _, product_id in scored]
+
+
+# Du moins récemment au plus récemment utilisé
+_indexes: "OrderedDict[str, TenantSearchIndex]" = OrderedDict()
+_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _touch(tenant_id: str, index: TenantSearchIndex):
+    index.used_at = time.monotonic()
+    _indexes.move_to_end(tenant_id)
+
+
+def _evict():
+    """Libérer les index inutilisés depuis INDEX_IDLE_TTL et ceux au-delà de MAX_TENANT_INDEXES"""
+    now = time.monotonic()
+    while _indexes:
+        tenant_id, index = next(iter(_indexes.items()))
+        if len(_indexes) <= MAX_TENANT_INDEXES and now - index.used_at < INDEX_IDLE_TTL:
+            break
+        del _indexes[tenant_id]
+        lock = _locks.get(tenant_id)
+        if lock is not None and not lock.locked():
+            del _locks[tenant_id]
+
+
+def _advance_watermark(index: TenantSearchIndex, products: List[dict]):
+    for product in products:
+        updated_at = as_datetime(product.get('updated_at'))
+        if updated_at and (index.watermark is None or updated_at > index.watermark):
+            index.watermark = updated_at
+
+
+async def _build(tenant_id: str) -> TenantSearchIndex:
+    index = TenantSearchIndex()
+    index.refreshed_at = time.monotonic()
+    products = await db.products.find({"tenant_id": tenant_id}, _PROJECTION).to_list(None)
+    # Construction hors de la boucle d'événements (quelques secondes pour 100k produits)
+    await asyncio.to_thread(index.load, products)
+    _advance_watermark(index, products)
+    return index
+
+
+async def _refresh(tenant_id: str, index: TenantSearchIndex):
+    """Relire les produits modifiés depuis le dernier rafraîchissement (autres workers)"""
+    index.refreshed_at = time.monotonic()
+    query = {"tenant_id": tenant_id}
+    if index.watermark:
+        # Marge: une écriture horodatée avant le filigrane peut être validée après la lecture
+        query.update(date_range_query("updated_at", gte=index.watermark - REFRESH_OVERLAP))
+    products = await db.products.find(query, _PROJECTION).to_list(None)
+    for product in products:
+        index.upsert(product)
+    _advance_watermark(index, products)
+
+
+async def get_index(tenant_id: str) -> TenantSearchIndex:
+    """Index du tenant, construit au premier appel et rafraîchi au plus toutes les REFRESH_INTERVAL s"""
+    index = _indexes.get(tenant_id)
+    if index is not None and time.monotonic() - index.refreshed_at < REFRESH_INTERVAL:
+        _touch(tenant_id, index)
+        return index
+    lock = _locks.setdefault(tenant_id, asyncio.Lock())
+    async with lock:
+        index = _indexes.get(tenant_id)
+        if index is None:
+            index = _indexes[tenant_id] = await _build(tenant_id)
+        elif time.monotonic() - index.refreshed_at >= REFRESH_INTERVAL:
+            await _refresh(tenant_id, index)
+        _touch(tenant_id, index)
+    _evict()
+    return index
+
+
+async def search_products(tenant_id: str, q: str, limit: int) -> List[dict]:
+    """Produits correspondant à q, classés, relus en base (stock et prix à jour)"""
+    index = await get_index(tenant_id)
+    ids = index.search(q, limit)
+    if not ids:
+        return []
+    products = await db.products.find({"tenant_id": tenant_id, "id": {"$in": ids}}, {"_id": 0}).to_list(len(ids))
+    by_id = {p['id']: p for p in products}
+    # Produits supprimés par un autre worker: retirés de l'index
+    for product_id in ids:
+        if product_id not in by_id:
+            index.remove(product_id)
+    return [by_id[product_id] for product_id in ids if product_id in by_id]
+
+
+def upsert_product(tenant_id: str, product: dict):
+    """Répercuter une création / modification de produit (sans effet si l'index n'est pas construit)"""
+    index = _indexes.get(tenant_id)
+    if index is not None:
+        index.upsert(product)
+
+
+def remove_product(tenant_id: str, product_id: str):
+    """Répercuter une suppression de produit"""
+    index = _indexes.get(tenant_id)
+    if index is not None:
+        index.remove(product_id)
+
+
+def invalidate(tenant_id: str):
+    """Forcer la reconstruction de l'index (écritures en masse: import catalogue, synchronisation)"""
+    _indexes.pop(tenant_id, None)
@@ -1,8 +1,10 @@
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
-from datetime import datetime
 from database import db
-from auth import hash_password, verify_password, create_access_token, get_current_user
+from auth import (
+    hash_password, verify_password, verify_and_update_password, create_access_token, get_current_user,
+    invalidate_user_sessions
+)
 from models.user import User, UserCreate, UserLogin, Token, UserResponse
 
 router = APIRouter(prefix="/auth", tags=["Authentication"])
@@ -46,12 +48,11 @@ async def register(user_data: UserCreate):
         raise HTTPException(status_code=400, detail="Ce code employé est déjà utilisé")
     
     user_dict = user_data.model_dump()
-    hashed_password = hash_password(user_dict.pop("password"))
+    hashed_password = await hash_password(user_dict.pop("password"))
     user_obj = User(**user_dict)
     
     doc = user_obj.model_dump()
     doc['password'] = hashed_password
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.users.insert_one(doc)
     return user_obj
@@ -60,8 +61,16 @@ async def register(user_data: UserCreate):
 async def login(credentials: UserLogin):
     """Login and get access token"""
     user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user['password']):
+    if not user:
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
+    valid, new_hash = await verify_and_update_password(credentials.password, user['password'])
+    if not valid:
         raise HTTPException(status_code=401, detail="Incorrect email or password")
+    if user.get('is_active') is False:
+        raise HTTPException(status_code=403, detail="Compte désactivé")
+    # Coût bcrypt modifié depuis le dernier hachage: recalcul transparent
+    if new_hash:
+        await db.users.update_one({"id": user['id'], "password": user['password']}, {"$set": {"password": new_hash}})
     
     # Normaliser les données utilisateur avant de créer le token
     user = normalize_user_data(user)
@@ -70,12 +79,11 @@ async def login(credentials: UserLogin):
         "sub": user['id'], 
         "tenant_id": user['tenant_id'],
         "role": user['role'],
-        "employee_code": user.get('employee_code', '')
+        "employee_code": user.get('employee_code', ''),
+        "ver": user.get('token_version', 0)
     })
     
     user.pop('password')
-    if isinstance(user['created_at'], str):
-        user['created_at'] = datetime.fromisoformat(user['created_at'])
     
     # Normaliser les données utilisateur
     user = normalize_user_data(user)
@@ -88,8 +96,6 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     user = await db.users.find_one({"id": current_user['user_id']}, {"_id": 0, "password": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    if isinstance(user.get('created_at'), str):
-        user['created_at'] = datetime.fromisoformat(user['created_at'])
     if 'is_active' not in user:
         user['is_active'] = True
     
@@ -107,7 +113,7 @@ async def change_password(password_data: PasswordChange, current_user: dict = De
         raise HTTPException(status_code=404, detail="Utilisateur non trouvé")
     
     # Vérifier le mot de passe actuel
-    if not verify_password(password_data.current_password, user['password']):
+    if not await verify_password(password_data.current_password, user['password']):
         raise HTTPException(status_code=400, detail="Mot de passe actuel incorrect")
     
     # Valider le nouveau mot de passe
@@ -115,10 +121,12 @@ async def change_password(password_data: PasswordChange, current_user: dict = De
         raise HTTPException(status_code=400, detail="Le nouveau mot de passe doit contenir au moins 6 caractères")
     
     # Mettre à jour le mot de passe
-    new_hashed_password = hash_password(password_data.new_password)
+    new_hashed_password = await hash_password(password_data.new_password)
+    # token_version: les jetons émis avant le changement sont révoqués
     await db.users.update_one(
         {"id": current_user['user_id']},
-        {"$set": {"password": new_hashed_password}}
+        {"$set": {"password": new_hashed_password}, "$inc": {"token_version": 1}}
     )
+    invalidate_user_sessions(current_user['user_id'])
     
     return {"message": "Mot de passe mis à jour avec succès"}
@@ -1,7 +1,7 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from typing import List, Optional
 from database import db
+from pagination import fetch_page, set_next_cursor, BY_NAME, MAX_PAGE_SIZE
 from auth import require_role, get_current_user
 from models.category import Category, CategoryCreate
 
@@ -15,18 +15,20 @@ async def create_category(category_data: CategoryCreate, current_user: dict = De
     category_obj = Category(**category_dict)
     
     doc = category_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.categories.insert_one(doc)
     return category_obj
 
 @router.get("", response_model=List[Category])
-async def get_categories(current_user: dict = Depends(get_current_user)):
-    """Get all categories"""
-    categories = await db.categories.find({"tenant_id": current_user['tenant_id']}, {"_id": 0}).to_list(1000)
-    for category in categories:
-        if isinstance(category.get('created_at'), str):
-            category['created_at'] = datetime.fromisoformat(category['created_at'])
+async def get_categories(
+    response: Response,
+    limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get categories page by page (sorted by name)"""
+    categories, next_cursor = await fetch_page(db.categories, {"tenant_id": current_user['tenant_id']}, BY_NAME, limit, cursor)
+    set_next_cursor(response, next_cursor)
     return categories
 
 @router.get("/{category_id}", response_model=Category)
@@ -35,8 +37,6 @@ async def get_category(category_id: str, current_user: dict = Depends(get_curren
     category = await db.categories.find_one({"id": category_id, "tenant_id": current_user['tenant_id']}, {"_id": 0})
     if not category:
         raise HTTPException(status_code=404, detail="Category not found")
-    if isinstance(category.get('created_at'), str):
-        category['created_at'] = datetime.fromisoformat(category['created_at'])
     return Category(**category)
 
 @router.put("/{category_id}", response_model=Category)
@@ -50,8 +50,6 @@ async def update_category(category_id: str, category_data: CategoryCreate, curre
     await db.categories.update_one({"id": category_id}, {"$set": update_data})
     
     updated_category = await db.categories.find_one({"id": category_id}, {"_id": 0})
-    if isinstance(updated_category.get('created_at'), str):
-        updated_category['created_at'] = datetime.fromisoformat(updated_category['created_at'])
     return Category(**updated_category)
 
 @router.delete("/{category_id}")
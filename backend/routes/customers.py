@@ -1,9 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from typing import List, Optional
 from database import db
+from pagination import fetch_page, set_next_cursor, BY_NAME, MAX_PAGE_SIZE
 from auth import get_current_user
 from models.customer import Customer, CustomerCreate
+from change_log import tracked_changes, DELETE
+from hlc import server_clock, field_version_updates
 
 router = APIRouter(prefix="/customers", tags=["Customers"])
 
@@ -15,17 +17,20 @@ async def create_customer(customer_data: CustomerCreate, current_user: dict = De
     customer_obj = Customer(**customer_dict)
     
     doc = customer_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.customers.insert_one(doc)
+    async with tracked_changes(current_user['tenant_id'], {"customers": [customer_obj.id]}):
+        await db.customers.insert_one(doc)
     return customer_obj
 
 @router.get("", response_model=List[Customer])
-async def get_customers(current_user: dict = Depends(get_current_user)):
-    """Get all customers"""
-    customers = await db.customers.find({"tenant_id": current_user['tenant_id']}, {"_id": 0}).to_list(1000)
-    for customer in customers:
-        if isinstance(customer['created_at'], str):
-            customer['created_at'] = datetime.fromisoformat(customer['created_at'])
+async def get_customers(
+    response: Response,
+    limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get customers page by page (sorted by name)"""
+    customers, next_cursor = await fetch_page(db.customers, {"tenant_id": current_user['tenant_id']}, BY_NAME, limit, cursor)
+    set_next_cursor(response, next_cursor)
     return customers
 
 @router.get("/{customer_id}", response_model=Customer)
@@ -34,8 +39,6 @@ async def get_customer(customer_id: str, current_user: dict = Depends(get_curren
     customer = await db.customers.find_one({"id": customer_id, "tenant_id": current_user['tenant_id']}, {"_id": 0})
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
-    if isinstance(customer['created_at'], str):
-        customer['created_at'] = datetime.fromisoformat(customer['created_at'])
     return Customer(**customer)
 
 @router.put("/{customer_id}", response_model=Customer)
@@ -46,18 +49,20 @@ async def update_customer(customer_id: str, customer_data: CustomerCreate, curre
         raise HTTPException(status_code=404, detail="Customer not found")
     
     update_data = customer_data.model_dump()
+    # Seuls les champs dont la valeur change sont versionnés
+    update_data.update(field_version_updates((f for f, value in update_data.items() if existing.get(f) != value), server_clock.now()))
     
-    await db.customers.update_one({"id": customer_id}, {"$set": update_data})
+    async with tracked_changes(current_user['tenant_id'], {"customers": [customer_id]}):
+        await db.customers.update_one({"id": customer_id}, {"$set": update_data})
     
     updated_customer = await db.customers.find_one({"id": customer_id}, {"_id": 0})
-    if isinstance(updated_customer['created_at'], str):
-        updated_customer['created_at'] = datetime.fromisoformat(updated_customer['created_at'])
     return Customer(**updated_customer)
 
 @router.delete("/{customer_id}")
 async def delete_customer(customer_id: str, current_user: dict = Depends(get_current_user)):
     """Delete a customer"""
-    result = await db.customers.delete_one({"id": customer_id, "tenant_id": current_user['tenant_id']})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Customer not found")
+    async with tracked_changes(current_user['tenant_id'], {"customers": [customer_id]}, op=DELETE):
+        result = await db.customers.delete_one({"id": customer_id, "tenant_id": current_user['tenant_id']})
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Customer not found")
     return {"message": "Customer deleted successfully"}
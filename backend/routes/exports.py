@@ -0,0 +1,151 @@
+"""
+Exports en flux (NDJSON ou CSV) des ventes, mouvements de stock et historique des prix.
+
+Les documents sont lus depuis un curseur Motor et sérialisés au fil de l'eau
+dans une StreamingResponse: la mémoire serveur reste constante quelle que soit
+la période exportée (ex: une année de ventes pour la comptabilité).
+"""
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
+from datetime import datetime
+import csv
+import io
+import json
+from database import db
+from dates import as_datetime, date_range_query
+from auth import require_role
+from models.sale import Sale
+from models.stock import StockMovement
+from models.price import PriceHistory
+
+router = APIRouter(prefix="/exports", tags=["Exports"])
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+EXPORT_BATCH_SIZE = 1000
+# Nombre de lignes CSV regroupées par morceau envoyé
+CSV_CHUNK_ROWS = 500
+
+# Champs exportables par collection (le tenant_id n'est jamais exporté)
+SALES_FIELDS = [f for f in Sale.model_fields if f != "tenant_id"]
+STOCK_MOVEMENT_FIELDS = [f for f in StockMovement.model_fields if f != "tenant_id"]
+PRICE_HISTORY_FIELDS = [f for f in PriceHistory.model_fields if f != "tenant_id"]
+
+
+def parse_export_fields(fields: Optional[str], allowed: List[str]) -> List[str]:
+    """Liste de champs séparés par des virgules; tous les champs exportables si absente"""
+    if not fields:
+        return allowed
+    selected = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in selected if f not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Champ(s) non exportable(s): {', '.join(unknown)}. Champs disponibles: {', '.join(allowed)}"
+        )
+    return selected
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        # Lignes de vente, etc.: sérialisées en JSON dans une seule cellule
+        return json.dumps(value, default=str, ensure_ascii=False)
+    return value
+
+
+async def _ndjson_rows(cursor, fields: List[str]):
+    async for doc in cursor:
+        yield json.dumps({f: doc.get(f) for f in fields}, default=str, ensure_ascii=False) + "\n"
+
+
+async def _csv_rows(cursor, fields: List[str]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    rows = 0
+    async for doc in cursor:
+        writer.writerow([_csv_value(doc.get(f)) for f in fields])
+        rows += 1
+        if rows % CSV_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def stream_export(collection, query: dict, fields: List[str], export_format: str, filename: str) -> StreamingResponse:
+    """Diffuser les documents d'une requête, du plus ancien au plus récent"""
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format inconnu: {export_format}. Formats: {', '.join(EXPORT_FORMATS)}")
+    projection = {"_id": 0, **{f: 1 for f in fields}}
+    cursor = collection.find(query, projection).sort([("created_at", 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    rows = _ndjson_rows(cursor, fields) if export_format == "ndjson" else _csv_rows(cursor, fields)
+    return StreamingResponse(
+        rows,
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'}
+    )
+
+
+def export_query(tenant_id: str, start: Optional[datetime], end: Optional[datetime]) -> dict:
+    query = {"tenant_id": tenant_id}
+    if start or end:
+        query.update(date_range_query("created_at", gte=as_datetime(start), lt=as_datetime(end)))
+    return query
+
+
+@router.get("/sales")
+async def export_sales(
+    start: Optional[datetime] = Query(default=None, description="Date de début (incluse)"),
+    end: Optional[datetime] = Query(default=None, description="Date de fin (exclue)"),
+    fields: Optional[str] = Query(default=None, description="Champs à exporter, séparés par des virgules"),
+    export_format: str = Query(default="ndjson", alias="format", description="ndjson ou csv"),
+    current_user: dict = Depends(require_role(["admin", "pharmacien"]))
+):
+    """Exporter les ventes d'une période en NDJSON ou CSV"""
+    selected = parse_export_fields(fields, SALES_FIELDS)
+    return stream_export(db.sales, export_query(current_user["tenant_id"], start, end), selected, export_format, "ventes")
+
+
+@router.get("/stock-movements")
+async def export_stock_movements(
+    start: Optional[datetime] = Query(default=None, description="Date de début (incluse)"),
+    end: Optional[datetime] = Query(default=None, description="Date de fin (exclue)"),
+    product_id: Optional[str] = None,
+    movement_type: Optional[str] = None,
+    fields: Optional[str] = Query(default=None, description="Champs à exporter, séparés par des virgules"),
+    export_format: str = Query(default="ndjson", alias="format", description="ndjson ou csv"),
+    current_user: dict = Depends(require_role(["admin", "pharmacien"]))
+):
+    """Exporter les mouvements de stock d'une période en NDJSON ou CSV"""
+    selected = parse_export_fields(fields, STOCK_MOVEMENT_FIELDS)
+    query = export_query(current_user["tenant_id"], start, end)
+    if product_id:
+        query["product_id"] = product_id
+    if movement_type:
+        query["movement_type"] = movement_type
+    return stream_export(db.stock_movements, query, selected, export_format, "mouvements_stock")
+
+
+@router.get("/price-history")
+async def export_price_history(
+    start: Optional[datetime] = Query(default=None, description="Date de début (incluse)"),
+    end: Optional[datetime] = Query(default=None, description="Date de fin (exclue)"),
+    product_id: Optional[str] = None,
+    change_type: Optional[str] = None,
+    fields: Optional[str] = Query(default=None, description="Champs à exporter, séparés par des virgules"),
+    export_format: str = Query(default="ndjson", alias="format", description="ndjson ou csv"),
+    current_user: dict = Depends(require_role(["admin", "pharmacien"]))
+):
+    """Exporter l'historique des prix d'une période en NDJSON ou CSV"""
+    selected = parse_export_fields(fields, PRICE_HISTORY_FIELDS)
+    query = export_query(current_user["tenant_id"], start, end)
+    if product_id:
+        query["product_id"] = product_id
+    if change_type:
+        query["change_type"] = change_type
+    return stream_export(db.price_history, query, selected, export_format, "historique_prix")
@@ -1,12 +1,20 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from typing import List, Optional
+from pymongo import ReturnDocument
 from database import db
+from pagination import fetch_page, set_next_cursor, NEWEST_FIRST, MAX_PAGE_SIZE
 from auth import require_role
 from models.prescription import Prescription, PrescriptionCreate
+from tenant_stats import increment_tenant_stats
 
 router = APIRouter(prefix="/prescriptions", tags=["Prescriptions"])
 
+
+def pending_delta(old_status: str, new_status: str) -> int:
+    """Variation du nombre d'ordonnances en attente lors d'un changement de statut"""
+    return int(new_status == "pending") - int(old_status == "pending")
+
+
 @router.post("", response_model=Prescription)
 async def create_prescription(prescription_data: PrescriptionCreate, current_user: dict = Depends(require_role(["admin", "pharmacien"]))):
     """Create a new prescription"""
@@ -15,28 +23,40 @@ async def create_prescription(prescription_data: PrescriptionCreate, current_use
     prescription_obj = Prescription(**prescription_dict)
     
     doc = prescription_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.prescriptions.insert_one(doc)
+    await increment_tenant_stats(current_user['tenant_id'], totals={
+        "pending_prescriptions": int(prescription_obj.status == "pending")
+    })
     return prescription_obj
 
 @router.get("", response_model=List[Prescription])
-async def get_prescriptions(current_user: dict = Depends(require_role(["admin", "pharmacien"]))):
-    """Get all prescriptions"""
-    prescriptions = await db.prescriptions.find({"tenant_id": current_user['tenant_id']}, {"_id": 0}).to_list(1000)
-    for prescription in prescriptions:
-        if isinstance(prescription['created_at'], str):
-            prescription['created_at'] = datetime.fromisoformat(prescription['created_at'])
+async def get_prescriptions(
+    response: Response,
+    limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(require_role(["admin", "pharmacien"]))
+):
+    """Get prescriptions page by page (newest first)"""
+    prescriptions, next_cursor = await fetch_page(
+        db.prescriptions, {"tenant_id": current_user['tenant_id']}, NEWEST_FIRST, limit, cursor
+    )
+    set_next_cursor(response, next_cursor)
     return prescriptions
 
 @router.put("/{prescription_id}/status")
 async def update_prescription_status(prescription_id: str, new_status: str, current_user: dict = Depends(require_role(["admin", "pharmacien"]))):
     """Update prescription status"""
-    result = await db.prescriptions.update_one(
+    previous = await db.prescriptions.find_one_and_update(
         {"id": prescription_id, "tenant_id": current_user['tenant_id']},
-        {"$set": {"status": new_status}}
+        {"$set": {"status": new_status}},
+        projection={"_id": 0, "status": 1},
+        return_document=ReturnDocument.BEFORE
     )
-    if result.matched_count == 0:
+    if not previous:
         raise HTTPException(status_code=404, detail="Prescription not found")
+    await increment_tenant_stats(current_user['tenant_id'], totals={
+        "pending_prescriptions": pending_delta(previous.get('status'), new_status)
+    })
     return {"message": "Prescription updated successfully"}
 
 @router.put("/{prescription_id}/edit", response_model=Prescription)
@@ -50,16 +70,23 @@ async def edit_prescription(prescription_id: str, prescription_data: Prescriptio
     update_data['tenant_id'] = current_user['tenant_id']
     
     await db.prescriptions.update_one({"id": prescription_id}, {"$set": update_data})
+    await increment_tenant_stats(current_user['tenant_id'], totals={
+        "pending_prescriptions": pending_delta(existing.get('status'), update_data.get('status'))
+    })
     
     updated_prescription = await db.prescriptions.find_one({"id": prescription_id}, {"_id": 0})
-    if isinstance(updated_prescription['created_at'], str):
-        updated_prescription['created_at'] = datetime.fromisoformat(updated_prescription['created_at'])
     return Prescription(**updated_prescription)
 
 @router.delete("/{prescription_id}")
 async def delete_prescription(prescription_id: str, current_user: dict = Depends(require_role(["admin", "pharmacien"]))):
     """Delete a prescription"""
-    result = await db.prescriptions.delete_one({"id": prescription_id, "tenant_id": current_user['tenant_id']})
-    if result.deleted_count == 0:
+    deleted = await db.prescriptions.find_one_and_delete(
+        {"id": prescription_id, "tenant_id": current_user['tenant_id']},
+        projection={"_id": 0, "status": 1}
+    )
+    if not deleted:
         raise HTTPException(status_code=404, detail="Prescription not found")
+    await increment_tenant_stats(current_user['tenant_id'], totals={
+        "pending_prescriptions": -int(deleted.get('status') == "pending")
+    })
     return {"message": "Prescription deleted successfully"}
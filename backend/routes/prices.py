@@ -1,9 +1,13 @@
-from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
 from typing import List, Optional
 from datetime import datetime, timezone
 from database import db
+from dates import as_datetime
+from pagination import fetch_page, set_next_cursor, NEWEST_FIRST
 from auth import require_role, get_current_user
 from models.price import PriceHistory, PriceHistoryCreate, PriceChangeType, PriceSummary
+from change_log import tracked_changes
+from hlc import server_clock, field_version_updates
 import uuid
 
 router = APIRouter(prefix="/prices", tags=["Prices"])
@@ -52,34 +56,32 @@ async def create_price_history(
     )
     
     doc = price_entry.model_dump()
-    doc["created_at"] = doc["created_at"].isoformat()
-    doc["date_maj_prix"] = doc["date_maj_prix"].isoformat()
-    if doc.get("date_appro"):
-        doc["date_appro"] = doc["date_appro"].isoformat()
-    if doc.get("date_peremption"):
-        doc["date_peremption"] = doc["date_peremption"].isoformat()
     doc["change_type"] = doc["change_type"].value
     
-    await db.price_history.insert_one(doc)
+    async with tracked_changes(tenant_id, {"products": [product_id]}):
+        await db.price_history.insert_one(doc)
     
-    # Mettre à jour les prix du produit
-    await db.products.update_one(
-        {"id": product_id},
-        {"$set": {
-            "purchase_price": prix_appro,
-            "price": prix_vente_prod,
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+        # Mettre à jour les prix du produit
+        await db.products.update_one(
+            {"id": product_id},
+            {"$set": {
+                "purchase_price": prix_appro,
+                "price": prix_vente_prod,
+                **field_version_updates(["purchase_price", "price"], server_clock.now()),
+                "updated_at": datetime.now(timezone.utc)
+            }}
+        )
     
     return price_entry
 
 
 @router.get("/history", response_model=List[PriceHistory])
 async def get_price_history(
+    response: Response,
     product_id: Optional[str] = None,
     change_type: Optional[str] = None,
-    limit: int = Query(default=100, le=500),
+    limit: int = Query(default=100, ge=1, le=500),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Récupérer l'historique des prix"""
@@ -91,13 +93,8 @@ async def get_price_history(
     if change_type:
         query["change_type"] = change_type
     
-    history = await db.price_history.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
-    
-    for entry in history:
-        # Convertir les dates string en datetime
-        for field in ["created_at", "date_maj_prix", "date_appro", "date_peremption", "modified_at"]:
-            if entry.get(field) and isinstance(entry[field], str):
-                entry[field] = datetime.fromisoformat(entry[field])
+    history, next_cursor = await fetch_page(db.price_history, query, NEWEST_FIRST, limit, cursor)
+    set_next_cursor(response, next_cursor)
     
     return [PriceHistory(**entry) for entry in history]
 
@@ -105,21 +102,18 @@ async def get_price_history(
 @router.get("/history/{product_id}", response_model=List[PriceHistory])
 async def get_product_price_history(
     product_id: str,
-    limit: int = Query(default=50, le=200),
+    response: Response,
+    limit: int = Query(default=50, ge=1, le=200),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Récupérer l'historique de prix d'un produit spécifique"""
     tenant_id = current_user["tenant_id"]
     
-    history = await db.price_history.find(
-        {"product_id": product_id, "tenant_id": tenant_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(limit)
-    
-    for entry in history:
-        for field in ["created_at", "date_maj_prix", "date_appro", "date_peremption", "modified_at"]:
-            if entry.get(field) and isinstance(entry[field], str):
-                entry[field] = datetime.fromisoformat(entry[field])
+    history, next_cursor = await fetch_page(
+        db.price_history, {"product_id": product_id, "tenant_id": tenant_id}, NEWEST_FIRST, limit, cursor
+    )
+    set_next_cursor(response, next_cursor)
     
     return [PriceHistory(**entry) for entry in history]
 
@@ -174,8 +168,7 @@ async def get_price_summary(
     last_date = None
     last_modified_by = None
     if last_change:
-        if last_change.get("created_at"):
-            last_date = datetime.fromisoformat(last_change["created_at"]) if isinstance(last_change["created_at"], str) else last_change["created_at"]
+        last_date = as_datetime(last_change.get("created_at"))
         last_modified_by = last_change.get("created_by")  # employee_code
     
     return PriceSummary(
@@ -1,113 +1,184 @@
-from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi import APIRouter, HTTPException, Depends, Query, Response, UploadFile, File, Form
 from typing import List, Optional
 from datetime import datetime, timezone, timedelta
+from pydantic import ValidationError
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import asyncio
+import codecs
+import csv
+import io
+import json
+import logging
+import tempfile
+import uuid
 from database import db
+from indexes import index_ready
+from dates import as_datetime
+from pagination import fetch_page, set_next_cursor, after_cursor, sort_spec, encode_cursor, cursor_values, BY_NAME, MAX_PAGE_SIZE
 from auth import require_role, get_current_user
 from models.product import Product, ProductCreate
+from names import name_key, clean_barcode
+from hlc import server_clock, field_version_updates
+import product_search
+from change_log import tracked_changes, DELETE
+from tenant_stats import increment_tenant_stats, low_stock_delta
+from settings_cache import get_tenant_settings
 
 router = APIRouter(prefix="/products", tags=["Products"])
+logger = logging.getLogger(__name__)
+
+# Taille des lots de la mise à niveau des clés produits
+BACKFILL_BATCH_SIZE = 500
+# Mise à niveau unique (collection migrations)
+PRODUCT_KEYS_MIGRATION_ID = "product_keys"
+
+
+async def backfill_product_keys(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Renseigner name_key et retirer les codes-barres vides des produits existants
+    (à exécuter avant la création des index uniques). Retourne le nombre de produits mis à jour.
+    Migration unique: ignorée dès qu'elle est marquée terminée dans la collection migrations.
+    """
+    state = await db.migrations.find_one({"_id": PRODUCT_KEYS_MIGRATION_ID}, {"completed": 1})
+    if state and state.get("completed"):
+        return 0
+    query = {"$or": [{"name_key": {"$exists": False}}, {"barcode": {"$regex": r"^\s*$"}}]}
+    updated = 0
+    while True:
+        products = await db.products.find(query, {"_id": 0, "id": 1, "name": 1, "barcode": 1}).to_list(batch_size)
+        if not products:
+            break
+        operations = []
+        for product in products:
+            update = {"$set": {"name_key": name_key(product.get('name'))}}
+            if product.get('barcode') is not None and not clean_barcode(product['barcode']):
+                update["$unset"] = {"barcode": ""}
+            operations.append(UpdateOne({"id": product['id']}, update))
+        await db.products.bulk_write(operations, ordered=False)
+        updated += len(operations)
+    await db.migrations.update_one(
+        {"_id": PRODUCT_KEYS_MIGRATION_ID},
+        {"$set": {"completed": True, "completed_at": datetime.now(timezone.utc)}, "$inc": {"updated": updated}},
+        upsert=True
+    )
+    return updated
+
+
+async def check_product_available(tenant_id: str, name: str, barcode: Optional[str], product_id: Optional[str] = None):
+    """Contrôle applicatif des doublons (nom normalisé, code-barres), tant que les index
+    uniques produits ne sont pas en place; ensuite la base les détecte seule.
+    """
+    prefix = "Un autre produit" if product_id else "Un produit"
+    others = {"id": {"$ne": product_id}} if product_id else {}
+    if not index_ready("products", "tenant_name_key_unique"):
+        if await db.products.find_one({"tenant_id": tenant_id, "name_key": name_key(name), **others}, {"_id": 1}):
+            raise HTTPException(status_code=400, detail=f"{prefix} avec le nom '{name}' existe déjà")
+    if barcode and not index_ready("products", "tenant_barcode"):
+        owner = await db.products.find_one({"tenant_id": tenant_id, "barcode": barcode, **others}, {"_id": 0, "name": 1})
+        if owner:
+            raise HTTPException(
+                status_code=400,
+                detail=f"{prefix} avec le code-barres '{barcode}' existe déjà ({owner['name']})"
+            )
+
+
+async def raise_duplicate_product(error: DuplicateKeyError, tenant_id: str, name: str, barcode: Optional[str], other: bool = False):
+    """Traduire une violation d'index unique produit en erreur 400 explicite"""
+    prefix = "Un autre produit" if other else "Un produit"
+    if "barcode" in (error.details or {}).get("keyPattern", {}):
+        owner = await db.products.find_one({"tenant_id": tenant_id, "barcode": barcode}, {"_id": 0, "name": 1})
+        raise HTTPException(
+            status_code=400,
+            detail=f"{prefix} avec le code-barres '{barcode}' existe déjà ({owner['name'] if owner else '?'})"
+        )
+    raise HTTPException(status_code=400, detail=f"{prefix} avec le nom '{name}' existe déjà")
 
 
 async def get_expiration_alert_days(tenant_id: str) -> int:
     """Récupérer le délai d'alerte de péremption configuré"""
-    settings = await db.settings.find_one({"tenant_id": tenant_id}, {"_id": 0})
-    if settings:
-        return settings.get("expiration_alert_days", 30)
-    return 30
+    settings = await get_tenant_settings(tenant_id)
+    return settings.get("expiration_alert_days", 30)
 
 
 @router.post("", response_model=Product)
 async def create_product(product_data: ProductCreate, current_user: dict = Depends(require_role(["admin", "pharmacien"]))):
     """Create a new product"""
-    # Vérifier si un produit avec le même nom existe déjà
-    existing_by_name = await db.products.find_one({
-        "tenant_id": current_user['tenant_id'],
-        "name": {"$regex": f"^{product_data.name}$", "$options": "i"}
-    })
-    if existing_by_name:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Un produit avec le nom '{product_data.name}' existe déjà"
-        )
-    
-    # Vérifier si un produit avec le même code-barres existe déjà (si fourni)
-    if product_data.barcode:
-        existing_by_barcode = await db.products.find_one({
-            "tenant_id": current_user['tenant_id'],
-            "barcode": product_data.barcode
-        })
-        if existing_by_barcode:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Un produit avec le code-barres '{product_data.barcode}' existe déjà ({existing_by_barcode['name']})"
-            )
-    
     product_dict = product_data.model_dump()
     product_dict['tenant_id'] = current_user['tenant_id']
     product_obj = Product(**product_dict)
     
     doc = product_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
-    if doc.get('expiration_date'):
-        doc['expiration_date'] = doc['expiration_date'].isoformat()
     
-    await db.products.insert_one(doc)
+    # Doublons (nom normalisé, code-barres) détectés par les index uniques
+    await check_product_available(current_user['tenant_id'], product_obj.name, product_obj.barcode)
+    async with tracked_changes(current_user['tenant_id'], {"products": [product_obj.id]}):
+        try:
+            await db.products.insert_one(doc)
+        except DuplicateKeyError as e:
+            await raise_duplicate_product(e, current_user['tenant_id'], product_obj.name, product_obj.barcode)
+    product_search.upsert_product(current_user['tenant_id'], doc)
+    await increment_tenant_stats(current_user['tenant_id'], totals={
+        "products_count": 1,
+        "low_stock_count": int(product_obj.stock <= product_obj.min_stock)
+    })
     return product_obj
 
 
+# Tri par priorité (réappro > péremption la plus proche > alphabétique), calculé en base.
+# Les clés ne dépendent que des champs stockés (jamais de l'heure de la requête): un curseur
+# reste valide d'une page à l'autre. Les produits proches de la péremption précèdent les
+# autres puisque la date de péremption est croissante; sans date, en dernier.
+PRIORITY_SORT = [("_needs_restock", 1), ("_expiration", 1), ("_name_lower", 1)]
+NO_EXPIRATION = datetime(9999, 12, 31, tzinfo=timezone.utc)
+
+
+def product_priority_pipeline(tenant_id: str, limit: int, cursor: Optional[str] = None) -> list:
+    """Page de produits triés par priorité sur tout le catalogue (keyset sur les clés calculées)"""
+    expiration = {"$convert": {"input": "$expiration_date", "to": "date", "onError": None, "onNull": None}}
+    return [
+        {"$match": {"tenant_id": tenant_id}},
+        {"$addFields": {
+            "_needs_restock": {"$cond": [{"$lte": [{"$ifNull": ["$stock", 0]}, {"$ifNull": ["$min_stock", 10]}]}, 0, 1]},
+            "_expiration": {"$ifNull": [expiration, NO_EXPIRATION]},
+            "_name_lower": {"$toLower": {"$ifNull": ["$name", ""]}},
+        }},
+        {"$match": after_cursor({}, PRIORITY_SORT, cursor)},
+        {"$sort": sort_spec(PRIORITY_SORT)},
+        {"$limit": limit + 1},
+        {"$project": {"_id": 0}},
+    ]
+
+
 @router.get("", response_model=List[Product])
 async def get_products(
-    sort_by: Optional[str] = Query(default="priority", description="priority, name, stock, expiration"),
+    response: Response,
+    sort_by: Optional[str] = Query(default="priority", description="priority, name"),
+    limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(require_role(["admin", "pharmacien"]))
 ):
-    """Get all products sorted by priority: low stock > near expiration > alphabetical"""
+    """Get products page by page.
+    priority (default): low stock > near expiration > alphabetical, across the whole catalogue;
+    name: alphabetical (keyset on name, id).
+    """
     tenant_id = current_user['tenant_id']
-    products = await db.products.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(1000)
+    if sort_by == "name":
+        products, next_cursor = await fetch_page(db.products, {"tenant_id": tenant_id}, BY_NAME, limit, cursor)
+        set_next_cursor(response, next_cursor)
+        return products
     
-    # Récupérer le délai d'alerte de péremption
-    expiration_alert_days = await get_expiration_alert_days(tenant_id)
-    expiration_threshold = datetime.now(timezone.utc) + timedelta(days=expiration_alert_days)
-    
-    for product in products:
-        if isinstance(product.get('created_at'), str):
-            product['created_at'] = datetime.fromisoformat(product['created_at'])
-        if isinstance(product.get('updated_at'), str):
-            product['updated_at'] = datetime.fromisoformat(product['updated_at'])
-        if isinstance(product.get('expiration_date'), str):
-            product['expiration_date'] = datetime.fromisoformat(product['expiration_date'])
-        
-        # Ajouter des indicateurs de tri
-        product['_needs_restock'] = product.get('stock', 0) <= product.get('min_stock', 10)
-        
-        exp_date = product.get('expiration_date')
-        if exp_date:
-            if isinstance(exp_date, str):
-                exp_date = datetime.fromisoformat(exp_date)
-            # Ensure timezone awareness
-            if exp_date.tzinfo is None:
-                exp_date = exp_date.replace(tzinfo=timezone.utc)
-            product['_near_expiration'] = exp_date <= expiration_threshold
-            product['_days_until_expiration'] = (exp_date - datetime.now(timezone.utc)).days
-        else:
-            product['_near_expiration'] = False
-            product['_days_until_expiration'] = 9999
-    
-    # Tri par priorité: réappro > péremption proche > alphabétique
-    def sort_key(p):
-        needs_restock = 0 if p.get('_needs_restock') else 1
-        near_expiration = 0 if p.get('_near_expiration') else 1
-        days = p.get('_days_until_expiration', 9999)
-        name = p.get('name', '').lower()
-        return (needs_restock, near_expiration, days, name)
-    
-    products.sort(key=sort_key)
+    pipeline = product_priority_pipeline(tenant_id, limit, cursor)
+    products = await db.products.aggregate(pipeline, allowDiskUse=True).to_list(limit + 1)
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_cursor = encode_cursor(cursor_values(products[-1], PRIORITY_SORT))
+    set_next_cursor(response, next_cursor)
     
     # Nettoyer les champs temporaires
     for product in products:
-        product.pop('_needs_restock', None)
-        product.pop('_near_expiration', None)
-        product.pop('_days_until_expiration', None)
+        for field, _ in PRIORITY_SORT:
+            product.pop(field, None)
     
     return products
 
@@ -118,9 +189,9 @@ async def get_product_alerts(current_user: dict = Depends(require_role(["admin",
     tenant_id = current_user['tenant_id']
     
     # Récupérer les paramètres
-    settings = await db.settings.find_one({"tenant_id": tenant_id}, {"_id": 0})
-    low_stock_threshold = settings.get("low_stock_threshold", 10) if settings else 10
-    expiration_alert_days = settings.get("expiration_alert_days", 30) if settings else 30
+    settings = await get_tenant_settings(tenant_id)
+    low_stock_threshold = settings.get("low_stock_threshold", 10)
+    expiration_alert_days = settings.get("expiration_alert_days", 30)
     expiration_threshold = datetime.now(timezone.utc) + timedelta(days=expiration_alert_days)
     
     products = await db.products.find({"tenant_id": tenant_id, "is_active": {"$ne": False}}, {"_id": 0}).to_list(1000)
@@ -140,15 +211,8 @@ async def get_product_alerts(current_user: dict = Depends(require_role(["admin",
             })
         
         # Vérifier la péremption
-        exp_date = product.get('expiration_date')
+        exp_date = as_datetime(product.get('expiration_date'))
         if exp_date:
-            if isinstance(exp_date, str):
-                exp_date = datetime.fromisoformat(exp_date)
-            
-            # Ensure timezone awareness
-            if exp_date.tzinfo is None:
-                exp_date = exp_date.replace(tzinfo=timezone.utc)
-            
             now = datetime.now(timezone.utc)
             days_until = (exp_date - now).days
             
@@ -190,23 +254,255 @@ async def get_product_alerts(current_user: dict = Depends(require_role(["admin",
 
 
 @router.get("/search")
-async def search_products(q: str, current_user: dict = Depends(require_role(["admin", "pharmacien"]))):
-    """Search products by name or barcode"""
-    products = await db.products.find({
-        "tenant_id": current_user['tenant_id'],
-        "$or": [
-            {"name": {"$regex": q, "$options": "i"}},
-            {"barcode": {"$regex": q, "$options": "i"}}
-        ]
-    }, {"_id": 0}).to_list(50)
-    for product in products:
-        if isinstance(product.get('created_at'), str):
-            product['created_at'] = datetime.fromisoformat(product['created_at'])
-        if isinstance(product.get('updated_at'), str):
-            product['updated_at'] = datetime.fromisoformat(product['updated_at'])
-        if isinstance(product.get('expiration_date'), str):
-            product['expiration_date'] = datetime.fromisoformat(product['expiration_date'])
-    return products
+async def search_products(
+    q: str,
+    limit: int = Query(default=50, ge=1, le=200),
+    current_user: dict = Depends(require_role(["admin", "pharmacien"]))
+):
+    """Search products by barcode (exact), name prefix, then approximate name (typos)"""
+    return await product_search.search_products(current_user['tenant_id'], q, limit)
+
+
+# Taille des lots bulk_write de l'import catalogue
+IMPORT_CHUNK_SIZE = 500
+# Nombre maximal d'erreurs détaillées conservées dans le suivi d'import
+IMPORT_MAX_REPORTED_ERRORS = 1000
+# Champs numériques acceptant la virgule décimale dans les CSV
+IMPORT_DECIMAL_FIELDS = ("price", "purchase_price")
+# Fichier importé: gardé en mémoire jusqu'à cette taille, sur disque au-delà
+IMPORT_SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+IMPORT_READ_CHUNK = 1024 * 1024
+
+# Imports en cours (référence conservée jusqu'à leur fin)
+import_tasks = set()
+
+
+def iter_catalogue_rows(text, file_format: str):
+    """Lignes d'un fichier catalogue (CSV avec en-tête ou NDJSON): (numéro de ligne, dict ou erreur)"""
+    if file_format == "ndjson":
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                yield line_number, row if isinstance(row, dict) else ValueError("objet JSON attendu")
+            except ValueError as e:
+                yield line_number, e
+        return
+    header_line = text.readline()
+    delimiter = ";" if header_line.count(";") > header_line.count(",") else ","
+    header = [h.strip() for h in next(csv.reader([header_line], delimiter=delimiter))]
+    for line_number, values in enumerate(csv.reader(text, delimiter=delimiter), start=2):
+        if not any(v.strip() for v in values):
+            continue
+        row = {}
+        for field, value in zip(header, values):
+            value = value.strip()
+            if value:
+                row[field] = value.replace(",", ".") if field in IMPORT_DECIMAL_FIELDS else value
+        yield line_number, row
+
+
+class CatalogueIndex:
+    """Index mémoire des produits du tenant (un seul prefetch) pour dédoublonner l'import"""
+    
+    def __init__(self, products: List[dict]):
+        self.by_id = {p['id']: p for p in products}
+        self.by_name = {name_key(p['name']): p['id'] for p in products if p.get('name')}
+        self.by_barcode = {clean_barcode(p['barcode']): p['id'] for p in products if clean_barcode(p.get('barcode'))}
+    
+    def match(self, name: Optional[str], barcode: Optional[str]) -> Optional[str]:
+        """Produit existant désigné par la ligne (code-barres prioritaire); ValueError si ambigu"""
+        by_barcode = self.by_barcode.get(clean_barcode(barcode)) if barcode else None
+        by_name = self.by_name.get(name_key(name)) if name else None
+        if by_barcode and by_name and by_barcode != by_name:
+            raise ValueError(
+                f"le code-barres '{barcode}' et le nom '{name}' désignent deux produits différents"
+            )
+        return by_barcode or by_name
+    
+    def check_available(self, product_id: str, name: Optional[str], barcode: Optional[str]):
+        owner = self.by_name.get(name_key(name)) if name else None
+        if owner and owner != product_id:
+            raise ValueError(f"un produit avec le nom '{name}' existe déjà")
+        owner = self.by_barcode.get(clean_barcode(barcode)) if barcode else None
+        if owner and owner != product_id:
+            raise ValueError(f"un produit avec le code-barres '{barcode}' existe déjà")
+    
+    def put(self, product: dict, previous: Optional[dict] = None):
+        if previous:
+            self.by_name.pop(name_key(previous.get('name')), None)
+            self.by_barcode.pop(clean_barcode(previous.get('barcode')), None)
+        self.by_id[product['id']] = product
+        self.by_name[name_key(product['name'])] = product['id']
+        if product.get('barcode'):
+            self.by_barcode[product['barcode']] = product['id']
+
+
+async def flush_catalogue_chunk(tenant_id: str, job: dict, operations: list, rows: list, stats: dict):
+    """Écrire un lot (bulk_write non ordonné) et reporter les erreurs ligne par ligne"""
+    failed = set()
+    async with tracked_changes(tenant_id, {"products": [row['id'] for row in rows]}) as changes:
+        if operations:
+            try:
+                await db.products.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    failed.add(error['index'])
+                    job['errors'].append({"line": rows[error['index']]['line'], "error": error.get('errmsg', 'Erreur d\'écriture')})
+        changes["products"] = [row['id'] for position, row in enumerate(rows) if position not in failed]
+    for position, row in enumerate(rows):
+        if position in failed:
+            continue
+        job[row['action']] += 1
+        stats['products_count'] += int(row['action'] == 'inserted')
+        stats['low_stock_count'] += row['low_stock_delta']
+    
+    await increment_tenant_stats(tenant_id, totals=stats)
+    job['errors_count'] = len(job['errors']) + job.get('dropped_errors', 0)
+    await db.import_jobs.update_one({"id": job['id']}, {"$set": {
+        "processed": job['processed'],
+        "inserted": job['inserted'],
+        "updated": job['updated'],
+        "unchanged": job['unchanged'],
+        "errors_count": job['errors_count'],
+        "errors": job['errors'][:IMPORT_MAX_REPORTED_ERRORS],
+        "updated_at": datetime.now(timezone.utc),
+    }})
+
+
+def import_value_changed(current, value) -> bool:
+    """Valeur importée différente de la valeur stockée (dates comparées en UTC)"""
+    if isinstance(value, datetime) and current is not None:
+        return as_datetime(current) != as_datetime(value)
+    return current != value
+
+
+async def run_catalogue_import(job: dict, source, file_format: str, encoding: str):
+    """Traiter un fichier catalogue en tâche de fond; l'avancement est écrit dans import_jobs"""
+    tenant_id = job['tenant_id']
+    text = io.TextIOWrapper(source, encoding=encoding, errors="replace", newline="")
+    operations, rows = [], []
+    stats = {"products_count": 0, "low_stock_count": 0}
+    now = datetime.now(timezone.utc)
+    try:
+        # Un seul prefetch du catalogue existant
+        index = CatalogueIndex(await db.products.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(None))
+        for line_number, row in iter_catalogue_rows(text, file_format):
+            job['processed'] += 1
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                existing_id = index.match(row.get('name'), row.get('barcode'))
+                if existing_id:
+                    existing = index.by_id[existing_id]
+                    if existing.get('_import_line'):
+                        raise ValueError(f"doublon de la ligne {existing['_import_line']} du fichier")
+                    data = ProductCreate(**{**existing, **row}).model_dump()
+                    data.pop('stock')
+                    index.check_available(existing_id, data['name'], data.get('barcode'))
+                    # Seuls les champs dont la valeur change sont écrits et versionnés
+                    changed = {field: value for field, value in data.items() if import_value_changed(existing.get(field), value)}
+                    index.put({**existing, **changed, "_import_line": line_number}, previous=existing)
+                    if not changed:
+                        job['unchanged'] += 1
+                        continue
+                    update = {**changed, **field_version_updates(changed, server_clock.now()), "updated_at": now}
+                    if 'name' in changed:
+                        update['name_key'] = name_key(changed['name'])
+                    operations.append(UpdateOne({"id": existing_id, "tenant_id": tenant_id}, {"$set": update}))
+                    rows.append({"line": line_number, "id": existing_id, "action": "updated", "low_stock_delta": low_stock_delta(
+                        existing.get('stock', 0), existing.get('stock', 0), existing.get('min_stock', 10), data['min_stock']
+                    )})
+                else:
+                    product = Product(**ProductCreate(**row).model_dump(), tenant_id=tenant_id)
+                    doc = product.model_dump()
+                    index.check_available(product.id, doc['name'], doc.get('barcode'))
+                    operations.append(InsertOne(doc))
+                    rows.append({"line": line_number, "id": product.id, "action": "inserted", "low_stock_delta": int(product.stock <= product.min_stock)})
+                    index.put({**doc, "_import_line": line_number})
+            except (ValueError, ValidationError) as e:
+                if len(job['errors']) < IMPORT_MAX_REPORTED_ERRORS:
+                    job['errors'].append({"line": line_number, "error": str(e)})
+                else:
+                    job['dropped_errors'] = job.get('dropped_errors', 0) + 1
+            
+            if len(operations) >= IMPORT_CHUNK_SIZE:
+                await flush_catalogue_chunk(tenant_id, job, operations, rows, stats)
+                operations, rows = [], []
+                stats = {"products_count": 0, "low_stock_count": 0}
+        await flush_catalogue_chunk(tenant_id, job, operations, rows, stats)
+    except Exception as e:
+        logger.error(f"Import catalogue {job['id']} en échec: {e!r}")
+        await db.import_jobs.update_one({"id": job['id']}, {"$set": {
+            "status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc)
+        }})
+        return
+    finally:
+        text.close()
+        product_search.invalidate(tenant_id)
+    
+    await db.import_jobs.update_one({"id": job['id']}, {"$set": {"status": "completed", "finished_at": datetime.now(timezone.utc)}})
+
+
+@router.post("/import", status_code=202)
+async def import_products(
+    file: UploadFile = File(...),
+    file_format: Optional[str] = Form(default=None, description="csv ou ndjson (déduit de l'extension si absent)"),
+    encoding: str = Form(default="utf-8-sig"),
+    current_user: dict = Depends(require_role(["admin", "pharmacien"]))
+):
+    """Importer / mettre à jour un catalogue produits (CSV ou NDJSON).
+    Les lignes sont rapprochées des produits existants par code-barres puis par nom (sans casse ni accents).
+    Un produit existant est mis à jour (hors stock, qui ne varie que par mouvements);
+    sinon il est créé. L'import s'exécute en tâche de fond: la réponse est le suivi
+    initial, l'avancement est consultable via GET /products/import/{job_id}.
+    """
+    tenant_id = current_user['tenant_id']
+    file_format = file_format or ("ndjson" if (file.filename or "").lower().endswith((".ndjson", ".jsonl")) else "csv")
+    if file_format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Format inconnu: csv ou ndjson")
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        raise HTTPException(status_code=400, detail=f"Encodage inconnu: {encoding}")
+    
+    # Le fichier reçu est fermé à la fin de la requête: copie dans un fichier temporaire
+    source = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_MAX_MEMORY)
+    while chunk := await file.read(IMPORT_READ_CHUNK):
+        source.write(chunk)
+    source.seek(0)
+    
+    job = {
+        "id": str(uuid.uuid4()),
+        "tenant_id": tenant_id,
+        "type": "products",
+        "filename": file.filename,
+        "status": "running",
+        "processed": 0,
+        "inserted": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "errors_count": 0,
+        "errors": [],
+        "created_by": current_user.get('employee_code', 'N/A'),
+        "started_at": datetime.now(timezone.utc),
+    }
+    await db.import_jobs.insert_one(dict(job))
+    
+    task = asyncio.create_task(run_catalogue_import(dict(job), source, file_format, encoding), name=f"import-{job['id']}")
+    import_tasks.add(task)
+    task.add_done_callback(import_tasks.discard)
+    return job
+
+
+@router.get("/import/{job_id}")
+async def get_import_job(job_id: str, current_user: dict = Depends(require_role(["admin", "pharmacien"]))):
+    """Suivre l'avancement d'un import catalogue"""
+    job = await db.import_jobs.find_one({"id": job_id, "tenant_id": current_user['tenant_id']}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Import non trouvé")
+    return job
 
 
 @router.get("/{product_id}", response_model=Product)
@@ -215,12 +511,6 @@ async def get_product(product_id: str, current_user: dict = Depends(require_role
     product = await db.products.find_one({"id": product_id, "tenant_id": current_user['tenant_id']}, {"_id": 0})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    if isinstance(product['created_at'], str):
-        product['created_at'] = datetime.fromisoformat(product['created_at'])
-    if isinstance(product['updated_at'], str):
-        product['updated_at'] = datetime.fromisoformat(product['updated_at'])
-    if isinstance(product.get('expiration_date'), str):
-        product['expiration_date'] = datetime.fromisoformat(product['expiration_date'])
     return Product(**product)
 
 
@@ -231,45 +521,26 @@ async def update_product(product_id: str, product_data: ProductCreate, current_u
     if not existing:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    # Vérifier si un autre produit avec le même nom existe
-    existing_by_name = await db.products.find_one({
-        "tenant_id": current_user['tenant_id'],
-        "name": {"$regex": f"^{product_data.name}$", "$options": "i"},
-        "id": {"$ne": product_id}
-    })
-    if existing_by_name:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Un autre produit avec le nom '{product_data.name}' existe déjà"
-        )
-    
-    # Vérifier si un autre produit avec le même code-barres existe
-    if product_data.barcode:
-        existing_by_barcode = await db.products.find_one({
-            "tenant_id": current_user['tenant_id'],
-            "barcode": product_data.barcode,
-            "id": {"$ne": product_id}
-        })
-        if existing_by_barcode:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Un autre produit avec le code-barres '{product_data.barcode}' existe déjà ({existing_by_barcode['name']})"
-            )
-    
+    await check_product_available(current_user['tenant_id'], product_data.name, product_data.barcode, product_id)
     update_data = product_data.model_dump()
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
-    if update_data.get('expiration_date'):
-        update_data['expiration_date'] = update_data['expiration_date'].isoformat()
+    # Seuls les champs dont la valeur change sont versionnés (le stock est un compteur, jamais versionné):
+    # réécrire une valeur inchangée ne doit pas l'emporter sur une modification hors ligne d'un autre poste
+    changed = [f for f, value in update_data.items() if f != 'stock' and import_value_changed(existing.get(f), value)]
+    update_data.update(field_version_updates(changed, server_clock.now()))
+    update_data['name_key'] = name_key(product_data.name)
+    update_data['updated_at'] = datetime.now(timezone.utc)
     
-    await db.products.update_one({"id": product_id}, {"$set": update_data})
+    async with tracked_changes(current_user['tenant_id'], {"products": [product_id]}):
+        try:
+            await db.products.update_one({"id": product_id}, {"$set": update_data})
+        except DuplicateKeyError as e:
+            await raise_duplicate_product(e, current_user['tenant_id'], product_data.name, product_data.barcode, other=True)
+    await increment_tenant_stats(current_user['tenant_id'], totals={"low_stock_count": low_stock_delta(
+        existing.get('stock', 0), product_data.stock, existing.get('min_stock', 10), product_data.min_stock
+    )})
     
     updated_product = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if isinstance(updated_product['created_at'], str):
-        updated_product['created_at'] = datetime.fromisoformat(updated_product['created_at'])
-    if isinstance(updated_product['updated_at'], str):
-        updated_product['updated_at'] = datetime.fromisoformat(updated_product['updated_at'])
-    if isinstance(updated_product.get('expiration_date'), str):
-        updated_product['expiration_date'] = datetime.fromisoformat(updated_product['expiration_date'])
+    product_search.upsert_product(current_user['tenant_id'], updated_product)
     return Product(**updated_product)
 
 
@@ -282,10 +553,11 @@ async def toggle_product_status(product_id: str, current_user: dict = Depends(re
     
     new_status = not product.get('is_active', True)
     
-    await db.products.update_one(
-        {"id": product_id},
-        {"$set": {"is_active": new_status, "updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
+    async with tracked_changes(current_user['tenant_id'], {"products": [product_id]}):
+        await db.products.update_one(
+            {"id": product_id},
+            {"$set": {"is_active": new_status, **field_version_updates(["is_active"], server_clock.now()), "updated_at": datetime.now(timezone.utc)}}
+        )
     
     status_text = "activé" if new_status else "désactivé"
     return {"message": f"Produit {status_text} avec succès", "is_active": new_status}
@@ -305,7 +577,16 @@ async def delete_product(product_id: str, current_user: dict = Depends(require_r
             detail=f"Impossible de supprimer ce produit : il a été vendu {sales_with_product} fois. Vous pouvez le désactiver ou modifier son stock à 0."
         )
     
-    result = await db.products.delete_one({"id": product_id, "tenant_id": current_user['tenant_id']})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Product not found")
+    async with tracked_changes(current_user['tenant_id'], {"products": [product_id]}, op=DELETE):
+        deleted = await db.products.find_one_and_delete(
+            {"id": product_id, "tenant_id": current_user['tenant_id']},
+            projection={"_id": 0, "stock": 1, "min_stock": 1}
+        )
+        if not deleted:
+            raise HTTPException(status_code=404, detail="Product not found")
+    product_search.remove_product(current_user['tenant_id'], product_id)
+    await increment_tenant_stats(current_user['tenant_id'], totals={
+        "products_count": -1,
+        "low_stock_count": -int(deleted.get('stock', 0) <= deleted.get('min_stock', 10))
+    })
     return {"message": "Product deleted successfully"}
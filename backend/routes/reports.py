@@ -1,70 +1,144 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
+from typing import Optional
 from datetime import datetime, timezone, timedelta
 from database import db
+from dates import date_range_query
 from auth import require_role, get_current_user
-from routes.stock import get_valuation_for_product
+from routes.stock import get_stock_valuation_totals
+from tenant_stats import TOTALS_DAY, stats_day, stats_initialized, rebuild_tenant_stats, start_tenant_stats_rebuild
+from settings_cache import get_tenant_settings
 
 router = APIRouter(prefix="/reports", tags=["Reports"])
 
 @router.get("/dashboard")
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
     """Get dashboard statistics"""
-    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    tenant_id = current_user['tenant_id']
+    today = stats_day()
     
-    sales = await db.sales.find({"tenant_id": current_user['tenant_id']}, {"_id": 0}).to_list(1000)
+    # Compteurs matérialisés: document global + document du jour
+    stats = await db.tenant_stats.find(
+        {"tenant_id": tenant_id, "day": {"$in": [TOTALS_DAY, today]}}, {"_id": 0}
+    ).to_list(2)
+    stats_map = {s['day']: s for s in stats}
+    initializing = not stats_initialized(stats_map.get(TOTALS_DAY))
+    if initializing:
+        # Premier accès: compteurs initialisés depuis l'historique en tâche de fond (le
+        # document "total" peut déjà exister, créé par les $inc des écritures précédentes)
+        await start_tenant_stats_rebuild(tenant_id)
+    totals = stats_map.get(TOTALS_DAY, {})
+    today_stats = stats_map.get(today, {})
     
-    today_sales = [s for s in sales if datetime.fromisoformat(s['created_at']) >= today]
-    today_revenue = sum(s['total'] for s in today_sales)
+    # Calculer la valeur totale du stock (agrégation en base)
+    settings = await get_tenant_settings(tenant_id)
+    method = settings.get('stock_valuation_method', 'weighted_average')
     
-    products = await db.products.find({"tenant_id": current_user['tenant_id']}, {"_id": 0}).to_list(1000)
-    low_stock_count = len([p for p in products if p['stock'] <= p['min_stock']])
-    
-    prescriptions = await db.prescriptions.find({"tenant_id": current_user['tenant_id'], "status": "pending"}, {"_id": 0}).to_list(1000)
-    
-    # Calculer la valeur totale du stock
-    settings = await db.settings.find_one({"tenant_id": current_user['tenant_id']}, {"_id": 0})
-    method = settings.get('stock_valuation_method', 'weighted_average') if settings else 'weighted_average'
-    
-    total_stock_value = 0
-    for product in products:
-        valuation = await get_valuation_for_product(product['id'], current_user['tenant_id'], method)
-        
-        if valuation['total_value'] == 0 and product.get('stock', 0) > 0:
-            estimated_cost = product.get('price', 0) * 0.7
-            total_stock_value += product['stock'] * estimated_cost
-        else:
-            total_stock_value += valuation['total_value']
+    valuation = await get_stock_valuation_totals(tenant_id, method)
+    total_stock_value = valuation['total_estimated_value']
     
     return {
-        "today_sales_count": len(today_sales),
-        "today_revenue": today_revenue,
-        "total_products": len(products),
-        "low_stock_count": low_stock_count,
-        "pending_prescriptions": len(prescriptions),
+        "today_sales_count": today_stats.get('sales_count', 0),
+        "today_revenue": round(today_stats.get('revenue', 0), 2),
+        "total_products": totals.get('products_count', 0),
+        "low_stock_count": totals.get('low_stock_count', 0),
+        "pending_prescriptions": totals.get('pending_prescriptions', 0),
         "total_stock_value": round(total_stock_value, 2),
-        "stock_valuation_method": method
+        "stock_valuation_method": method,
+        "stats_initializing": initializing
     }
 
+
+@router.post("/dashboard/rebuild")
+async def rebuild_dashboard_stats(current_user: dict = Depends(require_role(["admin"]))):
+    """Recalculer les compteurs du tableau de bord depuis l'historique (Admin uniquement)"""
+    totals = await rebuild_tenant_stats(current_user['tenant_id'])
+    if totals is None:
+        raise HTTPException(status_code=409, detail="Un recalcul des compteurs est déjà en cours")
+    return {"message": "Compteurs recalculés", **totals}
+
+# Formats de regroupement des ventes ($dateToString)
+SALES_REPORT_GROUPINGS = {
+    "hour": "%Y-%m-%dT%H:00",
+    "day": "%Y-%m-%d",
+    "week": "%G-W%V",
+    "month": "%Y-%m",
+}
+
+
+def sales_report_pipeline(tenant_id: str, start: datetime, end: datetime, group_by: str) -> list:
+    """Pipeline d'agrégation du rapport des ventes: totaux, périodes, moyens de paiement et employés"""
+    period_format = SALES_REPORT_GROUPINGS[group_by]
+    return [
+        {"$match": {"tenant_id": tenant_id, **date_range_query("created_at", gte=start, lt=end)}},
+        {"$project": {
+            "_id": 0,
+            "total": 1,
+            "payment_method": {"$ifNull": ["$payment_method", "N/A"]},
+            "employee_code": {"$ifNull": ["$employee_code", "N/A"]},
+            "period": {"$dateToString": {"format": period_format, "date": {"$toDate": "$created_at"}}},
+        }},
+        {"$facet": {
+            "totals": [
+                {"$group": {"_id": None, "count": {"$sum": 1}, "revenue": {"$sum": "$total"}}}
+            ],
+            "periods": [
+                {"$group": {"_id": "$period", "count": {"$sum": 1}, "revenue": {"$sum": "$total"}}},
+                {"$sort": {"_id": 1}}
+            ],
+            "payment_methods": [
+                {"$group": {"_id": "$payment_method", "count": {"$sum": 1}, "revenue": {"$sum": "$total"}}},
+                {"$sort": {"revenue": -1}}
+            ],
+            "employees": [
+                {"$group": {"_id": "$employee_code", "count": {"$sum": 1}, "revenue": {"$sum": "$total"}}},
+                {"$sort": {"revenue": -1}}
+            ],
+        }},
+    ]
+
+
 @router.get("/sales")
-async def get_sales_report(days: int = 7, current_user: dict = Depends(require_role(["admin", "pharmacien"]))):
+async def get_sales_report(
+    days: int = 7,
+    start: Optional[datetime] = Query(default=None, description="Début de période (ISO 8601)"),
+    end: Optional[datetime] = Query(default=None, description="Fin de période exclue (ISO 8601)"),
+    group_by: str = Query(default="day", description="hour, day, week, month"),
+    current_user: dict = Depends(require_role(["admin", "pharmacien"]))
+):
     """Get sales report for a specific period"""
-    start_date = datetime.now(timezone.utc) - timedelta(days=days)
+    if group_by not in SALES_REPORT_GROUPINGS:
+        raise HTTPException(status_code=400, detail=f"group_by invalide. Valeurs possibles: {', '.join(SALES_REPORT_GROUPINGS)}")
     
-    sales = await db.sales.find({"tenant_id": current_user['tenant_id']}, {"_id": 0}).to_list(10000)
+    end_date = end or datetime.now(timezone.utc)
+    start_date = start or end_date - timedelta(days=days)
+    if end_date.tzinfo is None:
+        end_date = end_date.replace(tzinfo=timezone.utc)
+    if start_date.tzinfo is None:
+        start_date = start_date.replace(tzinfo=timezone.utc)
+    if start_date >= end_date:
+        raise HTTPException(status_code=400, detail="La date de début doit précéder la date de fin")
     
-    filtered_sales = [s for s in sales if datetime.fromisoformat(s['created_at']) >= start_date]
+    pipeline = sales_report_pipeline(current_user['tenant_id'], start_date, end_date, group_by)
+    result = (await db.sales.aggregate(pipeline).to_list(1))[0]
     
-    daily_stats = {}
-    for sale in filtered_sales:
-        sale_date = datetime.fromisoformat(sale['created_at']).date().isoformat()
-        if sale_date not in daily_stats:
-            daily_stats[sale_date] = {"count": 0, "revenue": 0}
-        daily_stats[sale_date]['count'] += 1
-        daily_stats[sale_date]['revenue'] += sale['total']
+    totals = result['totals'][0] if result['totals'] else {"count": 0, "revenue": 0}
+    period_stats = {row['_id']: {"count": row['count'], "revenue": row['revenue']} for row in result['periods']}
     
     return {
-        "period_days": days,
-        "total_sales": len(filtered_sales),
-        "total_revenue": sum(s['total'] for s in filtered_sales),
-        "daily_stats": daily_stats
+        "period_days": (end_date - start_date).days,
+        "start": start_date.isoformat(),
+        "end": end_date.isoformat(),
+        "group_by": group_by,
+        "total_sales": totals['count'],
+        "total_revenue": totals['revenue'],
+        # Clé historique conservée pour le frontend (regroupement par défaut: jour)
+        "daily_stats": period_stats,
+        "by_payment_method": [
+            {"payment_method": row['_id'], "count": row['count'], "revenue": row['revenue']}
+            for row in result['payment_methods']
+        ],
+        "by_employee": [
+            {"employee_code": row['_id'], "count": row['count'], "revenue": row['revenue']}
+            for row in result['employees']
+        ]
     }
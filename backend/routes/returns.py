@@ -1,10 +1,20 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timezone, timedelta
 import uuid
-from database import db
+from pymongo import UpdateOne
+from database import db, client, supports_transactions
+from dates import as_datetime
+from pagination import (
+    fetch_page, set_next_cursor, encode_cursor, cursor_values, after_cursor, sort_spec, NEWEST_FIRST, MAX_PAGE_SIZE
+)
 from auth import get_current_user
 from models.returns import SaleReturn, SaleReturnCreate
+from models.stock import StockMovement, StockMovementType
+from routes.stock import update_stock_layers
+from tenant_stats import increment_tenant_stats, low_stock_delta
+from settings_cache import get_tenant_settings
+from change_log import tracked_changes
 
 router = APIRouter(prefix="/returns", tags=["Returns"])
 
@@ -19,10 +29,322 @@ async def generate_return_number(tenant_id: str) -> str:
 
 async def get_return_delay_days(tenant_id: str) -> int:
     """Récupérer le délai de retour configuré dans les paramètres"""
-    settings = await db.settings.find_one({"tenant_id": tenant_id}, {"_id": 0})
-    if settings:
-        return settings.get("return_delay_days", 3)  # 3 jours par défaut
-    return 3
+    settings = await get_tenant_settings(tenant_id)
+    return settings.get("return_delay_days", 3)  # 3 jours par défaut
+
+
+async def load_sales_numbers(sale_ids: List[str], tenant_id: str) -> dict:
+    """Charger en une requête les ventes (id, sale_number) référencées par des retours"""
+    if not sale_ids:
+        return {}
+    sales = await db.sales.find(
+        {"id": {"$in": list(set(sale_ids))}, "tenant_id": tenant_id},
+        {"_id": 0, "id": 1, "sale_number": 1}
+    ).to_list(None)
+    return {s['id']: s for s in sales}
+
+
+def operations_history_pipeline(tenant_id: str, limit: int, cursor: Optional[str] = None) -> list:
+    """Pipeline fusionnant ventes et retours après le curseur, triés du plus récent au plus ancien.
+    Chaque branche est bornée à limit + 1 documents (index tenant_created_at) avant la fusion.
+    """
+    def branch(operation: str) -> list:
+        return [
+            {"$match": after_cursor({"tenant_id": tenant_id}, NEWEST_FIRST, cursor)},
+            {"$sort": sort_spec(NEWEST_FIRST)},
+            {"$limit": limit + 1},
+            {"$project": {"_id": 0}},
+            {"$set": {"_operation": operation}},
+        ]
+    return branch("sale") + [
+        {"$unionWith": {"coll": "returns", "pipeline": branch("return")}},
+        {"$sort": sort_spec(NEWEST_FIRST)},
+        {"$limit": limit + 1},
+    ]
+
+
+async def load_returned_quantities(sale: dict) -> Dict[str, int]:
+    """Registre des quantités déjà retournées de la vente (returned_quantities).
+    Les anciennes ventes sans registre sont initialisées une fois depuis leurs retours.
+    """
+    if 'returned_quantities' in sale:
+        return sale['returned_quantities'] or {}
+    
+    returned = {}
+    async for r in db.returns.find({"sale_id": sale['id'], "tenant_id": sale['tenant_id']}, {"_id": 0, "items": 1}):
+        for item in r.get('items', []):
+            returned[item['product_id']] = returned.get(item['product_id'], 0) + item['quantity']
+    result = await db.sales.update_one(
+        {"id": sale['id'], "tenant_id": sale['tenant_id'], "returned_quantities": {"$exists": False}},
+        {"$set": {"returned_quantities": returned}}
+    )
+    if result.modified_count == 0:
+        # Initialisé entre-temps par une autre requête
+        current = await db.sales.find_one({"id": sale['id']}, {"_id": 0, "returned_quantities": 1})
+        returned = current.get('returned_quantities') or {}
+    return returned
+
+
+def check_returnable_quantity(name: str, already_returned: int, quantity: int, sold_quantity: int):
+    if already_returned + quantity > sold_quantity:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Quantité totale retournée ({already_returned + quantity}) dépasse la quantité vendue ({sold_quantity}) pour {name}"
+        )
+
+
+async def reserve_returned_quantities(
+    sale: dict, quantities: Dict[str, int], sold: Dict[str, int], session=None, pending: dict = None
+) -> bool:
+    """Incrémenter le registre en une écriture gardée: aucune quantité ne peut dépasser le vendu.
+    pending (retour sans transaction): posé dans la même écriture sous pending_returns.<return_id>,
+    avant tout autre effet, pour que recover_pending_returns puisse annuler un retour interrompu.
+    """
+    guard = {
+        f"returned_quantities.{product_id}": {"$not": {"$gt": sold[product_id] - quantity}}
+        for product_id, quantity in quantities.items()
+    }
+    update = {"$inc": {f"returned_quantities.{product_id}": quantity for product_id, quantity in quantities.items()}}
+    if pending:
+        update["$set"] = {f"pending_returns.{pending['return_id']}": {
+            "quantities": quantities, "reserved_at": pending['reserved_at']
+        }}
+    result = await db.sales.update_one(
+        {"id": sale['id'], "tenant_id": sale['tenant_id'], **guard},
+        update,
+        session=session
+    )
+    return result.modified_count == 1
+
+
+async def release_returned_quantities(sale: dict, quantities: Dict[str, int], return_id: str = None) -> bool:
+    """Annuler une réservation du registre (retour non abouti).
+    Avec return_id, la réservation n'est annulée qu'une fois, avec son marqueur pending_returns.
+    """
+    query = {"id": sale['id'], "tenant_id": sale['tenant_id']}
+    update = {"$inc": {f"returned_quantities.{product_id}": -quantity for product_id, quantity in quantities.items()}}
+    if return_id:
+        query[f"pending_returns.{return_id}"] = {"$exists": True}
+        update["$unset"] = {f"pending_returns.{return_id}": ""}
+    result = await db.sales.update_one(query, update)
+    return result.modified_count == 1
+
+
+async def raise_over_return(sale: dict, return_items: List[dict], sold: Dict[str, int], session=None):
+    """Le registre a refusé l'écriture: expliquer le dépassement à partir de son état actuel"""
+    current = await db.sales.find_one({"id": sale['id']}, {"_id": 0, "returned_quantities": 1}, session=session)
+    returned = (current or {}).get('returned_quantities') or {}
+    for item in return_items:
+        check_returnable_quantity(item['name'], returned.get(item['product_id'], 0), item['quantity'], sold[item['product_id']])
+    raise HTTPException(status_code=409, detail="La vente a été modifiée pendant le retour, veuillez réessayer")
+
+
+async def load_return_products(quantities: Dict[str, int], tenant_id: str, session=None) -> Dict[str, dict]:
+    """Charger en une requête les produits à réintégrer (les produits supprimés sont ignorés)"""
+    products = await db.products.find(
+        {"id": {"$in": list(quantities)}, "tenant_id": tenant_id},
+        {"_id": 0, "id": 1, "name": 1, "stock": 1, "min_stock": 1},
+        session=session
+    ).to_list(None)
+    return {p['id']: p for p in products}
+
+
+def build_return_movements(return_doc: dict, quantities: Dict[str, int], products_map: Dict[str, dict], employee_code: str) -> List[dict]:
+    """Construire les mouvements de stock RETURN d'un retour"""
+    movements = []
+    for product_id, quantity in quantities.items():
+        product = products_map.get(product_id)
+        if not product:
+            continue
+        stock_before = product.get('stock', 0)
+        movement = StockMovement(
+            product_id=product_id,
+            product_name=product.get('name'),
+            movement_type=StockMovementType.RETURN,
+            movement_quantity=quantity,
+            stock_before=stock_before,
+            stock_after=stock_before + quantity,
+            reference_type="return",
+            reference_id=return_doc['id'],
+            notes=f"Retour {return_doc.get('return_number') or ''} - Vente {return_doc.get('sale_number') or ''}".strip(),
+            tenant_id=return_doc['tenant_id'],
+            created_by=employee_code
+        )
+        doc = movement.model_dump()
+        doc['movement_type'] = doc['movement_type'].value
+        doc['created_at'] = return_doc['created_at']
+        movements.append(doc)
+    return movements
+
+
+async def commit_return_transaction(
+    return_doc: dict, sale: dict, quantities: Dict[str, int], sold: Dict[str, int], employee_code: str
+) -> Tuple[List[dict], Dict[str, dict]]:
+    """Enregistrer le retour dans une transaction (replica set): registre de la vente,
+    réintégration du stock (un bulk_write), mouvements RETURN (un insert_many) et retour.
+    """
+    tenant_id = return_doc['tenant_id']
+    committed = {}
+
+    async def callback(session):
+        if not await reserve_returned_quantities(sale, quantities, sold, session=session):
+            await raise_over_return(sale, return_doc['items'], sold, session=session)
+        products_map = await load_return_products(quantities, tenant_id, session=session)
+        movements = build_return_movements(return_doc, quantities, products_map, employee_code)
+        if movements:
+            await db.products.bulk_write([
+                UpdateOne({"id": m['product_id'], "tenant_id": tenant_id}, {"$inc": {"stock": m['movement_quantity']}})
+                for m in movements
+            ], ordered=False, session=session)
+            await db.stock_movements.insert_many([dict(m) for m in movements], session=session)
+        await db.returns.insert_one(dict(return_doc), session=session)
+        committed['movements'] = movements
+        committed['products'] = products_map
+
+    async with await client.start_session() as session:
+        await session.with_transaction(callback)
+    return committed['movements'], committed['products']
+
+
+async def commit_return_compensated(
+    return_doc: dict, sale: dict, quantities: Dict[str, int], sold: Dict[str, int], employee_code: str
+) -> Tuple[List[dict], Dict[str, dict]]:
+    """Enregistrer le retour sans transaction (mongod standalone).
+    Le registre est réservé en premier, avec le marqueur pending_returns.<return_id>
+    de la vente; le stock est réintégré avec le même marqueur sur chaque produit pour
+    que l'annulation soit idempotente. L'insertion du retour est le point de validation:
+    toute erreur avant est compensée, et un arrêt brutal est repris par recover_pending_returns.
+    """
+    tenant_id = return_doc['tenant_id']
+    return_id = return_doc['id']
+    marker = f"pending_returns.{return_id}"
+
+    pending = {"return_id": return_id, "reserved_at": return_doc['created_at']}
+    if not await reserve_returned_quantities(sale, quantities, sold, pending=pending):
+        await raise_over_return(sale, return_doc['items'], sold)
+
+    products_map = await load_return_products(quantities, tenant_id)
+    movements = build_return_movements(return_doc, quantities, products_map, employee_code)
+    try:
+        if movements:
+            await db.stock_movements.insert_many([dict(m) for m in movements])
+            await db.products.bulk_write([
+                UpdateOne(
+                    {"id": m['product_id'], "tenant_id": tenant_id, marker: {"$exists": False}},
+                    {"$inc": {"stock": m['movement_quantity']}, "$set": {marker: {
+                        "quantity": m['movement_quantity'], "sale_id": sale['id'], "reserved_at": return_doc['created_at']
+                    }}}
+                )
+                for m in movements
+            ], ordered=False)
+        await db.returns.insert_one(dict(return_doc))
+    except Exception:
+        # Ne retirer que le stock effectivement réintégré (lignes portant le marqueur)
+        if movements:
+            await db.products.bulk_write([
+                UpdateOne(
+                    {"id": m['product_id'], "tenant_id": tenant_id, marker: {"$exists": True}},
+                    {"$inc": {"stock": -m['movement_quantity']}, "$unset": {marker: ""}}
+                )
+                for m in movements
+            ], ordered=False)
+        await db.stock_movements.delete_many({"reference_type": "return", "reference_id": return_id, "tenant_id": tenant_id})
+        await release_returned_quantities(sale, quantities, return_id)
+        raise
+
+    if movements:
+        await db.products.update_many(
+            {"id": {"$in": [m['product_id'] for m in movements]}, "tenant_id": tenant_id},
+            {"$unset": {marker: ""}}
+        )
+    # Marqueur de la vente retiré en dernier: la reprise retrouve un retour validé incomplet
+    await db.sales.update_one({"id": sale['id'], "tenant_id": tenant_id}, {"$unset": {marker: ""}})
+    return movements, products_map
+
+
+async def _cancel_return_restock(return_id: str, tenant_id: str) -> List[str]:
+    """Retirer le stock réintégré par un retour non abouti (lignes portant le marqueur) et ses mouvements"""
+    marker = f"pending_returns.{return_id}"
+    restocked = await db.products.find(
+        {"tenant_id": tenant_id, marker: {"$exists": True}}, {"_id": 0, "id": 1, "pending_returns": 1}
+    ).to_list(None)
+    cancelled = []
+    for product in restocked:
+        result = await db.products.update_one(
+            {"id": product['id'], "tenant_id": tenant_id, marker: {"$exists": True}},
+            {"$inc": {"stock": -product['pending_returns'][return_id]['quantity']}, "$unset": {marker: ""}}
+        )
+        if result.modified_count:
+            cancelled.append(product['id'])
+    await db.stock_movements.delete_many({"reference_type": "return", "reference_id": return_id, "tenant_id": tenant_id})
+    return cancelled
+
+
+async def recover_pending_returns(max_age_minutes: int = 5) -> int:
+    """Résoudre les retours interrompus sans transaction (arrêt avant l'insertion du retour).
+    Le marqueur de la vente, posé avec la réservation du registre avant tout autre effet,
+    couvre aussi un arrêt avant la réintégration: si le retour existe, les marqueurs sont
+    retirés; sinon stock, mouvements puis registre sont annulés, le marqueur de la vente en dernier.
+    Exécutée périodiquement (server.recover_pending_operations): les retours plus récents
+    que max_age_minutes peuvent être encore en cours.
+    """
+    threshold = datetime.now(timezone.utc) - timedelta(minutes=max_age_minutes)
+    resolved = 0
+    sales = db.sales.find(
+        {"pending_returns": {"$exists": True, "$ne": {}}},
+        {"_id": 0, "id": 1, "tenant_id": 1, "pending_returns": 1}
+    )
+    async for sale in sales:
+        for return_id, pending in (sale.get('pending_returns') or {}).items():
+            reserved_at = as_datetime(pending.get('reserved_at'))
+            if reserved_at and reserved_at > threshold:
+                continue
+            tenant_id = sale['tenant_id']
+            marker = f"pending_returns.{return_id}"
+            if await db.returns.find_one({"id": return_id, "tenant_id": tenant_id}, {"_id": 1}):
+                await db.products.update_many({"tenant_id": tenant_id, marker: {"$exists": True}}, {"$unset": {marker: ""}})
+                await db.sales.update_one({"id": sale['id'], "tenant_id": tenant_id}, {"$unset": {marker: ""}})
+            else:
+                quantities = pending.get('quantities') or {}
+                async with tracked_changes(tenant_id, {"products": quantities, "sales": [sale['id']]}) as changes:
+                    changes["products"] = await _cancel_return_restock(return_id, tenant_id)
+                    if not await release_returned_quantities(sale, quantities, return_id):
+                        changes["sales"] = []
+            resolved += 1
+    
+    # Marqueurs produit sans marqueur de vente (retours antérieurs au marqueur de vente)
+    products = db.products.find(
+        {"pending_returns": {"$exists": True, "$ne": {}}},
+        {"_id": 0, "id": 1, "tenant_id": 1, "pending_returns": 1}
+    )
+    async for product in products:
+        for return_id, pending in (product.get('pending_returns') or {}).items():
+            reserved_at = as_datetime(pending.get('reserved_at'))
+            if reserved_at and reserved_at > threshold:
+                continue
+            tenant_id = product['tenant_id']
+            marker = f"pending_returns.{return_id}"
+            if await db.sales.find_one({"id": pending['sale_id'], "tenant_id": tenant_id, marker: {"$exists": True}}, {"_id": 1}):
+                # Résolu par le marqueur de la vente (au passage suivant s'il est récent)
+                continue
+            if await db.returns.find_one({"id": return_id, "tenant_id": tenant_id}, {"_id": 1}):
+                await db.products.update_one({"id": product['id'], "tenant_id": tenant_id}, {"$unset": {marker: ""}})
+            else:
+                async with tracked_changes(tenant_id, {"products": [product['id']], "sales": [pending['sale_id']]}) as changes:
+                    result = await db.products.update_one(
+                        {"id": product['id'], "tenant_id": tenant_id, marker: {"$exists": True}},
+                        {"$inc": {"stock": -pending['quantity']}, "$unset": {marker: ""}}
+                    )
+                    if result.modified_count:
+                        await db.stock_movements.delete_many({
+                            "reference_type": "return", "reference_id": return_id,
+                            "product_id": product['id'], "tenant_id": tenant_id
+                        })
+                        await release_returned_quantities({"id": pending['sale_id'], "tenant_id": tenant_id}, {product['id']: pending['quantity']})
+                    else:
+                        changes.clear()
+            resolved += 1
+    return resolved
 
 
 async def check_sale_return_eligibility(sale: dict, tenant_id: str) -> tuple:
@@ -33,9 +355,7 @@ async def check_sale_return_eligibility(sale: dict, tenant_id: str) -> tuple:
     return_delay_days = await get_return_delay_days(tenant_id)
     
     # Parser la date de la vente
-    sale_date = sale.get('created_at')
-    if isinstance(sale_date, str):
-        sale_date = datetime.fromisoformat(sale_date.replace('Z', '+00:00'))
+    sale_date = as_datetime(sale.get('created_at'))
     
     # Calculer la date limite de retour
     deadline = sale_date + timedelta(days=return_delay_days)
@@ -78,49 +398,42 @@ async def create_return(return_data: SaleReturnCreate, current_user: dict = Depe
     # Récupérer le numéro de vente (ou générer un fallback)
     sale_number = sale.get('sale_number') or f"VNT-{sale['id'][:8].upper()}"
     
-    # Vérifier les articles retournés
+    # Quantités demandées par produit et quantités vendues
+    requested = {}
+    for return_item in return_data.items:
+        quantity = return_item.get('quantity')
+        if not isinstance(quantity, int) or quantity <= 0:
+            raise HTTPException(status_code=400, detail="La quantité retournée doit être un entier positif")
+        requested[return_item['product_id']] = requested.get(return_item['product_id'], 0) + quantity
+    sold = {}
+    for item in sale['items']:
+        sold[item['product_id']] = sold.get(item['product_id'], 0) + item['quantity']
+    
     return_items = []
     total_refund = 0
     
-    for return_item in return_data.items:
+    returned = await load_returned_quantities(sale)
+    for product_id, quantity in requested.items():
         # Trouver l'article dans la vente originale
-        sale_item = next((item for item in sale['items'] if item['product_id'] == return_item['product_id']), None)
+        sale_item = next((item for item in sale['items'] if item['product_id'] == product_id), None)
         if not sale_item:
-            raise HTTPException(status_code=400, detail=f"Produit {return_item['product_id']} non trouvé dans cette vente")
+            raise HTTPException(status_code=400, detail=f"Produit {product_id} non trouvé dans cette vente")
         
         # Vérifier la quantité
-        if return_item['quantity'] > sale_item['quantity']:
-            raise HTTPException(status_code=400, detail=f"Quantité de retour ({return_item['quantity']}) supérieure à la quantité vendue ({sale_item['quantity']}) pour {sale_item['name']}")
-        
-        # Vérifier si déjà retourné
-        existing_returns = await db.returns.find({"sale_id": return_data.sale_id, "tenant_id": tenant_id}).to_list(100)
-        already_returned = sum(
-            sum(ri['quantity'] for ri in r['items'] if ri['product_id'] == return_item['product_id'])
-            for r in existing_returns
-        )
+        if quantity > sold[product_id]:
+            raise HTTPException(status_code=400, detail=f"Quantité de retour ({quantity}) supérieure à la quantité vendue ({sold[product_id]}) pour {sale_item['name']}")
+        check_returnable_quantity(sale_item['name'], returned.get(product_id, 0), quantity, sold[product_id])
         
-        if already_returned + return_item['quantity'] > sale_item['quantity']:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Quantité totale retournée ({already_returned + return_item['quantity']}) dépasse la quantité vendue ({sale_item['quantity']}) pour {sale_item['name']}"
-            )
-        
-        item_refund = round(sale_item['price'] * return_item['quantity'], 2)
+        item_refund = round(sale_item['price'] * quantity, 2)
         total_refund += item_refund
         
         return_items.append({
-            "product_id": return_item['product_id'],
+            "product_id": product_id,
             "name": sale_item['name'],
-            "quantity": return_item['quantity'],
+            "quantity": quantity,
             "price": sale_item['price'],
             "refund": item_refund
         })
-        
-        # Restaurer le stock
-        product = await db.products.find_one({"id": return_item['product_id'], "tenant_id": tenant_id})
-        if product:
-            new_stock = product['stock'] + return_item['quantity']
-            await db.products.update_one({"id": return_item['product_id']}, {"$set": {"stock": new_stock}})
     
     # Générer le numéro de retour
     return_number = await generate_return_number(tenant_id)
@@ -137,10 +450,30 @@ async def create_return(return_data: SaleReturnCreate, current_user: dict = Depe
         employee_code=employee_code,  # Utiliser employee_code
         tenant_id=tenant_id
     )
-    
     doc = return_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.returns.insert_one(doc)
+    
+    # Registre, stock, mouvements RETURN et retour écrits ensemble
+    async with tracked_changes(tenant_id, {"sales": [sale['id']], "products": requested}):
+        if await supports_transactions():
+            movements, products_map = await commit_return_transaction(doc, sale, requested, sold, employee_code)
+        else:
+            movements, products_map = await commit_return_compensated(doc, sale, requested, sold, employee_code)
+    
+    # Réintégrer les quantités retournées dans les couches de valorisation (au coût moyen)
+    await update_stock_layers(tenant_id, movements)
+    await increment_tenant_stats(
+        tenant_id,
+        daily={
+            "returns_count": 1,
+            "refund_total": return_obj.total_refund,
+            "stock_entries": sum(item['quantity'] for item in return_items),
+        },
+        totals={"low_stock_count": sum(
+            low_stock_delta(m['stock_before'], m['stock_after'], products_map[m['product_id']].get('min_stock', 10))
+            for m in movements
+        )},
+        at=doc['created_at']
+    )
     
     return return_obj
 
@@ -167,18 +500,26 @@ async def check_return_eligibility(sale_id: str, current_user: dict = Depends(ge
 
 
 @router.get("", response_model=List[SaleReturn])
-async def get_returns(current_user: dict = Depends(get_current_user)):
-    """Obtenir tous les retours avec le numéro de vente"""
+async def get_returns(
+    response: Response,
+    limit: int = Query(default=100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Obtenir les retours par page (plus récents d'abord) avec le numéro de vente"""
     tenant_id = current_user['tenant_id']
-    returns = await db.returns.find({"tenant_id": tenant_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    
-    # Récupérer tous les utilisateurs pour enrichir les données
-    users = await db.users.find({"tenant_id": tenant_id}, {"_id": 0, "password": 0}).to_list(1000)
+    returns, next_cursor = await fetch_page(db.returns, {"tenant_id": tenant_id}, NEWEST_FIRST, limit, cursor)
+    set_next_cursor(response, next_cursor)
+    
+    # Récupérer les utilisateurs et les ventes de la page pour enrichir les données
+    users = await db.users.find(
+        {"id": {"$in": list({r['user_id'] for r in returns if r.get('user_id')})}, "tenant_id": tenant_id},
+        {"_id": 0, "password": 0}
+    ).to_list(None)
     users_map = {u['id']: u for u in users}
+    sales_map = await load_sales_numbers([r['sale_id'] for r in returns if not r.get('sale_number') and r.get('sale_id')], tenant_id)
     
     for r in returns:
-        if isinstance(r['created_at'], str):
-            r['created_at'] = datetime.fromisoformat(r['created_at'])
         
         # Générer un return_number si absent (pour les anciens retours)
         if not r.get('return_number'):
@@ -186,7 +527,7 @@ async def get_returns(current_user: dict = Depends(get_current_user)):
         
         # Récupérer le numéro de vente si absent
         if not r.get('sale_number') and r.get('sale_id'):
-            sale = await db.sales.find_one({"id": r['sale_id'], "tenant_id": tenant_id}, {"_id": 0})
+            sale = sales_map.get(r['sale_id'])
             if sale:
                 r['sale_number'] = sale.get('sale_number') or f"VNT-{sale['id'][:8].upper()}"
             else:
@@ -220,8 +561,6 @@ async def get_returns_for_sale(sale_id: str, current_user: dict = Depends(get_cu
         sale_number = sale.get('sale_number') or f"VNT-{sale['id'][:8].upper()}"
     
     for r in returns:
-        if isinstance(r['created_at'], str):
-            r['created_at'] = datetime.fromisoformat(r['created_at'])
         
         # Ajouter le numéro de vente si absent
         if not r.get('sale_number'):
@@ -235,22 +574,31 @@ async def get_returns_for_sale(sale_id: str, current_user: dict = Depends(get_cu
 
 
 @router.get("/history")
-async def get_operations_history(current_user: dict = Depends(get_current_user)):
-    """Obtenir l'historique complet des opérations (ventes + retours) avec informations agent"""
+async def get_operations_history(
+    response: Response,
+    limit: int = Query(default=100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Obtenir l'historique des opérations (ventes + retours) par page, avec informations agent.
+    Les deux collections sont fusionnées côté serveur ($unionWith) dans l'ordre (created_at, id).
+    """
     tenant_id = current_user['tenant_id']
     
-    # Récupérer les ventes
-    sales = await db.sales.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(1000)
-    
-    # Récupérer les retours
-    returns = await db.returns.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(1000)
+    rows = await db.sales.aggregate(operations_history_pipeline(tenant_id, limit, cursor)).to_list(limit + 1)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        set_next_cursor(response, encode_cursor(cursor_values(rows[-1], NEWEST_FIRST)))
+    page = [(row.pop('_operation'), row) for row in rows]
+    returns = [doc for kind, doc in page if kind == "return"]
     
-    # Récupérer tous les utilisateurs pour enrichir les données
-    users = await db.users.find({"tenant_id": tenant_id}, {"_id": 0, "password": 0}).to_list(1000)
+    # Récupérer les utilisateurs de la page pour enrichir les données
+    user_ids = list({doc['user_id'] for _, doc in page if doc.get('user_id')})
+    users = await db.users.find({"id": {"$in": user_ids}, "tenant_id": tenant_id}, {"_id": 0, "password": 0}).to_list(None)
     users_map = {u['id']: u for u in users}
     
     # Créer un map des ventes pour récupérer les numéros de vente
-    sales_map = {s['id']: s for s in sales}
+    sales_map = await load_sales_numbers([r['sale_id'] for r in returns if not r.get('sale_number') and r.get('sale_id')], tenant_id)
     
     # Récupérer le délai de retour configuré
     return_delay_days = await get_return_delay_days(tenant_id)
@@ -283,12 +631,9 @@ async def get_operations_history(current_user: dict = Depends(get_current_user))
             'user_name': 'Inconnu'
         }
     
-    def check_return_eligibility(sale_date_str):
+    def check_return_eligibility(created_at):
         """Vérifier si une vente est encore éligible au retour"""
-        if isinstance(sale_date_str, str):
-            sale_date = datetime.fromisoformat(sale_date_str.replace('Z', '+00:00'))
-        else:
-            sale_date = sale_date_str
+        sale_date = as_datetime(created_at)
         
         deadline = sale_date + timedelta(days=return_delay_days)
         now = datetime.now(timezone.utc)
@@ -297,17 +642,14 @@ async def get_operations_history(current_user: dict = Depends(get_current_user))
             return False, 0
         return True, (deadline - now).days
     
-    # Créer l'historique unifié
-    history = []
-    
-    for sale in sales:
+    def build_sale_entry(sale):
         user_info = get_user_info(sale.get('user_id'), sale.get('employee_code'))
         sale_number = sale.get('sale_number') or f"VNT-{sale['id'][:8].upper()}"
         
-        # Vérifier l'éligibilité au retour
+        # Vérifier l'éligibilité au retour (uniquement pour les ventes de la page)
         is_returnable, days_remaining = check_return_eligibility(sale['created_at'])
         
-        history.append({
+        return {
             "id": sale['id'],
             "operation_number": sale_number,
             "type": "sale",
@@ -320,9 +662,9 @@ async def get_operations_history(current_user: dict = Depends(get_current_user))
             "return_days_remaining": days_remaining,
             **user_info,
             "details": sale
-        })
+        }
     
-    for ret in returns:
+    def build_return_entry(ret):
         user_info = get_user_info(ret.get('user_id'), ret.get('employee_code'))
         return_number = ret.get('return_number') or f"RET-{ret['id'][:8].upper()}"
         
@@ -335,7 +677,7 @@ async def get_operations_history(current_user: dict = Depends(get_current_user))
             else:
                 sale_number = f"VNT-{ret['sale_id'][:8].upper()}"
         
-        history.append({
+        return {
             "id": ret['id'],
             "operation_number": return_number,
             "type": "return",
@@ -348,9 +690,10 @@ async def get_operations_history(current_user: dict = Depends(get_current_user))
             "user_id": ret.get('user_id'),
             **user_info,
             "details": ret
-        })
-    
-    # Trier par date décroissante
-    history.sort(key=lambda x: x['date'], reverse=True)
+        }
     
-    return history
+    # Créer l'historique unifié, déjà trié par le pipeline
+    return [
+        build_sale_entry(doc) if operation == "sale" else build_return_entry(doc)
+        for operation, doc in page
+    ]
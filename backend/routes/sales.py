@@ -1,12 +1,21 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
-from datetime import datetime, timezone
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from typing import List, Dict, Any, Optional, Tuple
+from datetime import datetime, timezone, timedelta
+import logging
 import uuid
-from database import db
+from pymongo import UpdateOne
+from database import db, client, supports_transactions
+from dates import as_datetime
+from pagination import fetch_page, set_next_cursor, NEWEST_FIRST, MAX_PAGE_SIZE
 from auth import require_role, get_current_user
 from models.sale import Sale, SaleCreate
+from models.stock import StockMovement, StockMovementType
+from routes.stock import update_stock_layers
+from tenant_stats import increment_tenant_stats, low_stock_delta
+from change_log import tracked_changes
 
 router = APIRouter(prefix="/sales", tags=["Sales"])
+logger = logging.getLogger(__name__)
 
 
 async def generate_sale_number(tenant_id: str) -> str:
@@ -17,6 +26,239 @@ async def generate_sale_number(tenant_id: str) -> str:
     return f"VNT-{unique_id}"
 
 
+def aggregate_item_quantities(items: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Regrouper les quantités par produit (un même produit peut apparaître plusieurs fois)"""
+    quantities = {}
+    for item in items:
+        product_id = item.get('product_id')
+        if not isinstance(product_id, str) or not product_id:
+            raise HTTPException(status_code=400, detail="Missing product_id in sale item")
+        quantity = item.get('quantity', 0)
+        # 2.0 (JSON de certains clients) est accepté comme 2
+        if isinstance(quantity, float) and quantity.is_integer():
+            quantity = int(quantity)
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity <= 0:
+            raise HTTPException(status_code=400, detail=f"Invalid quantity for product {product_id}")
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return quantities
+
+
+async def load_sale_products(quantities: Dict[str, int], tenant_id: str, session=None) -> Dict[str, dict]:
+    """Charger les produits du panier en une requête et vérifier le stock disponible"""
+    products = await db.products.find(
+        {"id": {"$in": list(quantities)}, "tenant_id": tenant_id},
+        {"_id": 0, "id": 1, "name": 1, "stock": 1, "min_stock": 1},
+        session=session
+    ).to_list(None)
+    products_map = {p['id']: p for p in products}
+    for product_id, quantity in quantities.items():
+        product = products_map.get(product_id)
+        if not product:
+            raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
+        if product.get('stock', 0) < quantity:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
+    return products_map
+
+
+def build_sale_movements(sale_doc: dict, quantities: Dict[str, int], products_map: Dict[str, dict], employee_code: str) -> List[dict]:
+    """Construire les mouvements de stock SALE d'une vente"""
+    movements = []
+    for product_id, quantity in quantities.items():
+        product = products_map[product_id]
+        stock_before = product.get('stock', 0)
+        movement = StockMovement(
+            product_id=product_id,
+            product_name=product.get('name'),
+            movement_type=StockMovementType.SALE,
+            movement_quantity=-quantity,
+            stock_before=stock_before,
+            stock_after=stock_before - quantity,
+            reference_type="sale",
+            reference_id=sale_doc['id'],
+            notes=f"Vente {sale_doc.get('sale_number') or ''}".strip(),
+            tenant_id=sale_doc['tenant_id'],
+            created_by=employee_code
+        )
+        doc = movement.model_dump()
+        doc['movement_type'] = doc['movement_type'].value
+        movements.append(doc)
+    return movements
+
+
+async def reserve_sale_stock(sale_id: str, quantities: Dict[str, int], tenant_id: str) -> Optional[Dict[str, int]]:
+    """Décrémenter le stock de tout le panier en un seul bulk_write.
+    Chaque ligne n'est appliquée que si le stock est suffisant ($gte) et pose un
+    marqueur pending_sales.<sale_id> permettant une compensation idempotente.
+    Le marqueur conserve le stock lu par la mise à jour elle-même (stock_before):
+    c'est la valeur exacte avant décrément, même avec des ventes concurrentes.
+    Retourne le stock avant réservation par produit, ou None si au moins une ligne
+    n'a pas pu être appliquée.
+    """
+    marker = f"pending_sales.{sale_id}"
+    reserved_at = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"id": product_id, "tenant_id": tenant_id, "stock": {"$gte": quantity}, marker: {"$exists": False}},
+            [{"$set": {
+                "stock": {"$subtract": ["$stock", quantity]},
+                marker: {"quantity": quantity, "reserved_at": reserved_at, "stock_before": "$stock"},
+            }}]
+        )
+        for product_id, quantity in quantities.items()
+    ]
+    result = await db.products.bulk_write(operations, ordered=False)
+    if result.modified_count != len(operations):
+        return None
+    reserved = await db.products.find(
+        {"id": {"$in": list(quantities)}, "tenant_id": tenant_id, marker: {"$exists": True}},
+        {"_id": 0, "id": 1, marker: 1}
+    ).to_list(None)
+    return {p['id']: p['pending_sales'][sale_id]['stock_before'] for p in reserved}
+
+
+async def release_sale_stock(sale_id: str, quantities: Dict[str, int], tenant_id: str) -> None:
+    """Annuler une réservation: ne restaure que les lignes portant encore le marqueur (idempotent)"""
+    marker = f"pending_sales.{sale_id}"
+    operations = [
+        UpdateOne(
+            {"id": product_id, "tenant_id": tenant_id, marker: {"$exists": True}},
+            {"$inc": {"stock": quantity}, "$unset": {marker: ""}}
+        )
+        for product_id, quantity in quantities.items()
+    ]
+    await db.products.bulk_write(operations, ordered=False)
+    await db.stock_movements.delete_many({"reference_type": "sale", "reference_id": sale_id, "tenant_id": tenant_id})
+
+
+async def confirm_sale_stock(sale_id: str, quantities: Dict[str, int], tenant_id: str) -> None:
+    """Confirmer une réservation en retirant les marqueurs"""
+    await db.products.update_many(
+        {"id": {"$in": list(quantities)}, "tenant_id": tenant_id},
+        {"$unset": {f"pending_sales.{sale_id}": ""}}
+    )
+
+
+async def commit_sale_transaction(sale_doc: dict, quantities: Dict[str, int], employee_code: str) -> Tuple[List[dict], Dict[str, dict]]:
+    """Enregistrer la vente dans une transaction (replica set).
+    Stock, vente et mouvements sont validés ensemble; with_transaction rejoue
+    automatiquement le callback sur les erreurs transitoires.
+    """
+    tenant_id = sale_doc['tenant_id']
+    committed = {}
+
+    async def callback(session):
+        products_map = await load_sale_products(quantities, tenant_id, session=session)
+        operations = [
+            UpdateOne(
+                {"id": product_id, "tenant_id": tenant_id, "stock": {"$gte": quantity}},
+                {"$inc": {"stock": -quantity}}
+            )
+            for product_id, quantity in quantities.items()
+        ]
+        result = await db.products.bulk_write(operations, ordered=False, session=session)
+        if result.modified_count != len(operations):
+            raise HTTPException(status_code=400, detail="Insufficient stock: concurrent sale detected, please retry")
+        movements = build_sale_movements(sale_doc, quantities, products_map, employee_code)
+        await db.sales.insert_one(dict(sale_doc), session=session)
+        await db.stock_movements.insert_many([dict(m) for m in movements], session=session)
+        committed['movements'] = movements
+        committed['products'] = products_map
+
+    async with await client.start_session() as session:
+        await session.with_transaction(callback)
+    return committed['movements'], committed['products']
+
+
+async def commit_sale_compensated(sale_doc: dict, quantities: Dict[str, int], employee_code: str) -> Tuple[List[dict], Dict[str, dict]]:
+    """Enregistrer la vente sans transaction (mongod standalone).
+    Le stock est réservé avec marqueurs, puis les mouvements et la vente sont écrits;
+    l'insertion de la vente est le point de validation. Toute erreur avant ce point
+    est compensée par release_sale_stock, et recover_pending_sales rattrape un arrêt brutal.
+    """
+    tenant_id = sale_doc['tenant_id']
+    sale_id = sale_doc['id']
+    products_map = await load_sale_products(quantities, tenant_id)
+
+    # Décrément atomique et conditionnel: tout ou rien
+    stock_before = await reserve_sale_stock(sale_id, quantities, tenant_id)
+    if stock_before is None:
+        await release_sale_stock(sale_id, quantities, tenant_id)
+        raise HTTPException(status_code=400, detail="Insufficient stock: concurrent sale detected, please retry")
+    for product_id, stock in stock_before.items():
+        products_map[product_id]['stock'] = stock
+
+    movements = build_sale_movements(sale_doc, quantities, products_map, employee_code)
+    try:
+        await db.stock_movements.insert_many([dict(m) for m in movements])
+        await db.sales.insert_one(dict(sale_doc))
+    except Exception:
+        await release_sale_stock(sale_id, quantities, tenant_id)
+        raise
+
+    # La vente est enregistrée: un échec ici ne doit pas la faire renvoyer par le client.
+    # Les marqueurs restants sont retirés par recover_pending_sales (la vente existe).
+    try:
+        await confirm_sale_stock(sale_id, quantities, tenant_id)
+    except Exception as e:
+        logger.warning(f"Vente {sale_id}: marqueurs de réservation non retirés ({e!r}), repris par la récupération")
+    return movements, products_map
+
+
+async def commit_sale(sale_doc: dict, quantities: Dict[str, int], employee_code: str) -> List[dict]:
+    """Enregistrer une vente: transaction si disponible, sinon chemin compensé.
+    Met ensuite à jour les couches de valorisation et les compteurs du tableau de bord.
+    Retourne les mouvements de stock SALE créés.
+    """
+    tenant_id = sale_doc['tenant_id']
+    async with tracked_changes(tenant_id, {"sales": [sale_doc['id']], "products": quantities}):
+        if await supports_transactions():
+            movements, products_map = await commit_sale_transaction(sale_doc, quantities, employee_code)
+        else:
+            movements, products_map = await commit_sale_compensated(sale_doc, quantities, employee_code)
+    await update_stock_layers(tenant_id, movements)
+    await increment_tenant_stats(
+        tenant_id,
+        daily={
+            "sales_count": 1,
+            "revenue": sale_doc['total'],
+            "stock_exits": sum(quantities.values()),
+        },
+        totals={"low_stock_count": sum(
+            low_stock_delta(m['stock_before'], m['stock_after'], products_map[m['product_id']].get('min_stock', 10))
+            for m in movements
+        )},
+        at=sale_doc['created_at']
+    )
+    return movements
+
+
+async def recover_pending_sales(max_age_minutes: int = 5) -> int:
+    """Résoudre les réservations de stock orphelines (arrêt entre réservation et vente).
+    Si la vente existe, le marqueur est simplement retiré; sinon le stock est restauré.
+    Exécutée périodiquement (server.recover_pending_operations): les réservations
+    plus récentes que max_age_minutes peuvent appartenir à une vente en cours.
+    """
+    threshold = datetime.now(timezone.utc) - timedelta(minutes=max_age_minutes)
+    resolved = 0
+    products = db.products.find(
+        {"pending_sales": {"$exists": True, "$ne": {}}},
+        {"_id": 0, "id": 1, "tenant_id": 1, "pending_sales": 1}
+    )
+    async for product in products:
+        for sale_id, reservation in (product.get('pending_sales') or {}).items():
+            reserved_at = as_datetime(reservation.get('reserved_at'))
+            if reserved_at and reserved_at > threshold:
+                continue
+            quantities = {product['id']: reservation.get('quantity', 0)}
+            if await db.sales.find_one({"id": sale_id, "tenant_id": product['tenant_id']}, {"_id": 1}):
+                await confirm_sale_stock(sale_id, quantities, product['tenant_id'])
+            else:
+                async with tracked_changes(product['tenant_id'], {"products": quantities}):
+                    await release_sale_stock(sale_id, quantities, product['tenant_id'])
+            resolved += 1
+    return resolved
+
+
 @router.post("", response_model=Sale)
 async def create_sale(sale_data: SaleCreate, current_user: dict = Depends(get_current_user)):
     """Create a new sale"""
@@ -35,36 +277,31 @@ async def create_sale(sale_data: SaleCreate, current_user: dict = Depends(get_cu
     sale_dict['total'] = round(sale_dict['total'], 2)
     sale_obj = Sale(**sale_dict)
     
-    for item in sale_data.items:
-        product = await db.products.find_one({"id": item['product_id'], "tenant_id": tenant_id})
-        if not product:
-            raise HTTPException(status_code=404, detail=f"Product {item['product_id']} not found")
-        
-        new_stock = product['stock'] - item['quantity']
-        if new_stock < 0:
-            raise HTTPException(status_code=400, detail=f"Insufficient stock for {product['name']}")
-        
-        await db.products.update_one({"id": item['product_id']}, {"$set": {"stock": new_stock}})
+    quantities = aggregate_item_quantities(sale_data.items)
     
     doc = sale_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.sales.insert_one(doc)
+    await commit_sale(doc, quantities, employee_code)
     return sale_obj
 
 
 @router.get("")
-async def get_sales(current_user: dict = Depends(get_current_user)):
-    """Get all sales with user information"""
+async def get_sales(
+    response: Response,
+    limit: int = Query(default=100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get sales page by page (newest first) with user information"""
     tenant_id = current_user['tenant_id']
-    sales = await db.sales.find({"tenant_id": tenant_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
+    sales, next_cursor = await fetch_page(db.sales, {"tenant_id": tenant_id}, NEWEST_FIRST, limit, cursor)
+    set_next_cursor(response, next_cursor)
     
-    # Récupérer tous les utilisateurs pour enrichir les ventes
-    users = await db.users.find({"tenant_id": tenant_id}, {"_id": 0, "password": 0}).to_list(1000)
+    # Récupérer les utilisateurs de la page pour enrichir les ventes
+    user_ids = list({s['user_id'] for s in sales if s.get('user_id')})
+    users = await db.users.find({"id": {"$in": user_ids}, "tenant_id": tenant_id}, {"_id": 0, "password": 0}).to_list(None)
     users_map = {u['id']: u for u in users}
     
     for sale in sales:
-        if isinstance(sale['created_at'], str):
-            sale['created_at'] = datetime.fromisoformat(sale['created_at'])
         
         # Générer un sale_number si absent (pour les anciennes ventes)
         if not sale.get('sale_number'):
@@ -97,8 +334,6 @@ async def get_sale(sale_id: str, current_user: dict = Depends(get_current_user))
     sale = await db.sales.find_one({"id": sale_id, "tenant_id": current_user['tenant_id']}, {"_id": 0})
     if not sale:
         raise HTTPException(status_code=404, detail="Sale not found")
-    if isinstance(sale['created_at'], str):
-        sale['created_at'] = datetime.fromisoformat(sale['created_at'])
     
     # Générer un sale_number si absent
     if not sale.get('sale_number'):
@@ -3,6 +3,7 @@ from datetime import datetime, timezone
 from database import db
 from auth import require_role, get_current_user
 from models.settings import Settings, SettingsUpdate
+from settings_cache import get_tenant_settings, invalidate_tenant_settings
 
 router = APIRouter(prefix="/settings", tags=["Settings"])
 
@@ -10,7 +11,7 @@ router = APIRouter(prefix="/settings", tags=["Settings"])
 async def get_public_settings():
     """Get public settings (pharmacy name) - No authentication required"""
     # Récupérer les paramètres du tenant par défaut
-    settings = await db.settings.find_one({"tenant_id": "default"}, {"_id": 0})
+    settings = await get_tenant_settings("default")
     if settings:
         return {
             "pharmacy_name": settings.get("pharmacy_name", "DynSoft Pharma"),
@@ -48,7 +49,7 @@ async def get_all_agencies():
 @router.get("")
 async def get_settings(current_user: dict = Depends(get_current_user)):
     """Get application settings"""
-    settings = await db.settings.find_one({"tenant_id": current_user['tenant_id']}, {"_id": 0})
+    settings = await get_tenant_settings(current_user['tenant_id'])
     if not settings:
         # Créer les paramètres par défaut
         default_settings = Settings(
@@ -57,23 +58,31 @@ async def get_settings(current_user: dict = Depends(get_current_user)):
             currency="EUR"
         )
         doc = default_settings.model_dump()
-        doc['created_at'] = doc['created_at'].isoformat()
-        doc['updated_at'] = doc['updated_at'].isoformat()
-        await db.settings.insert_one(doc)
-        settings = doc
+        doc.pop('tenant_id')
+        # Upsert: deux premières lectures simultanées ne créent qu'un document, et
+        # des paramètres écrits entre-temps ne sont pas écrasés
+        await db.settings.update_one(
+            {"tenant_id": current_user['tenant_id']},
+            {"$setOnInsert": doc},
+            upsert=True
+        )
+        invalidate_tenant_settings(current_user['tenant_id'])
+        settings = await get_tenant_settings(current_user['tenant_id'])
     return settings
 
 @router.put("")
 async def update_settings(settings_data: SettingsUpdate, current_user: dict = Depends(require_role(["admin"]))):
     """Update application settings (Admin only)"""
     update_data = {k: v for k, v in settings_data.model_dump().items() if v is not None}
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = datetime.now(timezone.utc)
     
+    # version: invalide les caches de paramètres des autres workers
     result = await db.settings.update_one(
         {"tenant_id": current_user['tenant_id']},
-        {"$set": update_data},
+        {"$set": update_data, "$inc": {"version": 1}},
         upsert=True
     )
+    invalidate_tenant_settings(current_user['tenant_id'])
     
     settings = await db.settings.find_one({"tenant_id": current_user['tenant_id']}, {"_id": 0})
     return settings
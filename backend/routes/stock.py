@@ -1,16 +1,302 @@
-from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+import asyncio
 from database import db
+from dates import as_datetime
+from pagination import fetch_page, set_next_cursor, NEWEST_FIRST
 from auth import require_role, get_current_user
 from models.stock import StockMovement, StockMovementCreate, StockMovementType, StockSummary
+from tenant_stats import increment_tenant_stats, low_stock_delta
+from change_log import tracked_changes
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+import json
+import logging
 import uuid
 
 router = APIRouter(prefix="/stock", tags=["Stock"])
+logger = logging.getLogger(__name__)
+
+
+VALUATION_METHODS = ("fifo", "lifo", "weighted_average")
+
+# Verrou de reconstruction des couches (collection stock_layer_rebuilds, un document par tenant)
+REBUILD_LOCK_TTL = timedelta(minutes=10)
+# Passes de reconstruction tentées tant que des mouvements arrivent pendant la relecture
+REBUILD_MAX_PASSES = 5
+
+
+def new_layer_state(tenant_id: str, product_id: str) -> dict:
+    """État initial des couches de valorisation d'un produit"""
+    return {
+        "tenant_id": tenant_id,
+        "product_id": product_id,
+        "quantity": 0,              # Quantité couverte par les couches
+        "fifo_layers": [],          # [{quantity, unit_cost, received_at, reference_id}]
+        "lifo_layers": [],
+        "fifo_value": 0,
+        "lifo_value": 0,
+        "weighted_average_value": 0,
+        "revision": None,
+        "rebuild_id": None,         # Reconstruction dont l'état est issu
+    }
+
+
+def _consume_layers(layers: List[dict], quantity: int, newest_first: bool) -> List[dict]:
+    """Consommer une quantité dans les couches (les plus anciennes ou les plus récentes d'abord)"""
+    remaining = quantity
+    order = reversed(layers) if newest_first else layers
+    for layer in order:
+        if remaining <= 0:
+            break
+        taken = min(layer["quantity"], remaining)
+        layer["quantity"] -= taken
+        remaining -= taken
+    return [layer for layer in layers if layer["quantity"] > 0]
+
+
+def apply_movement_to_layers(state: dict, movement: dict) -> dict:
+    """Appliquer un mouvement de stock aux couches FIFO/LIFO et au coût moyen pondéré"""
+    quantity = movement.get("movement_quantity", 0)
+    if quantity > 0:
+        unit_cost = movement.get("unit_cost")
+        if unit_cost is None:
+            # Entrée sans coût connu (retour, ajustement): valorisée au coût moyen courant
+            unit_cost = state["weighted_average_value"] / state["quantity"] if state["quantity"] else 0
+        layer = {
+            "quantity": quantity,
+            "unit_cost": unit_cost,
+            "received_at": movement.get("created_at"),
+            "reference_id": movement.get("reference_id"),
+        }
+        state["fifo_layers"].append(dict(layer))
+        state["lifo_layers"].append(dict(layer))
+        state["quantity"] += quantity
+        state["weighted_average_value"] += quantity * unit_cost
+    elif quantity < 0 and state["quantity"] > 0:
+        taken = min(-quantity, state["quantity"])
+        average_cost = state["weighted_average_value"] / state["quantity"]
+        state["fifo_layers"] = _consume_layers(state["fifo_layers"], taken, newest_first=False)
+        state["lifo_layers"] = _consume_layers(state["lifo_layers"], taken, newest_first=True)
+        state["quantity"] -= taken
+        state["weighted_average_value"] = max(0, state["weighted_average_value"] - taken * average_cost)
+    state["fifo_value"] = sum(l["quantity"] * l["unit_cost"] for l in state["fifo_layers"])
+    state["lifo_value"] = sum(l["quantity"] * l["unit_cost"] for l in state["lifo_layers"])
+    return state
+
+
+async def _deferred_to_rebuild(tenant_id: str, product_ids) -> set:
+    """Produits dont une reconstruction est en cours: la reconstruction est marquée
+    "dirty" et relira l'historique, qui contient déjà les mouvements de l'appelant.
+    """
+    lock = await db.stock_layer_rebuilds.find_one_and_update(
+        {
+            "_id": tenant_id,
+            "expires_at": {"$gt": datetime.now(timezone.utc)},
+            "$or": [{"product_id": None}, {"product_id": {"$in": list(product_ids)}}],
+        },
+        {"$set": {"dirty": True}}
+    )
+    if lock is None:
+        return set()
+    return set(product_ids) if lock.get("product_id") is None else {lock["product_id"]}
+
+
+async def _write_layer_state(tenant_id: str, product_id: str, state: dict, previous_revision: Optional[str]) -> bool:
+    """Écriture conditionnée par la révision lue (compare-and-set sur un document).
+    Le résultat de l'opération elle-même dit si elle a été appliquée.
+    """
+    try:
+        result = await db.stock_layers.update_one(
+            {"tenant_id": tenant_id, "product_id": product_id, "revision": previous_revision},
+            {"$set": state},
+            upsert=previous_revision is None
+        )
+    except DuplicateKeyError:
+        # Création concurrente du même état (clé unique): relu au tour suivant
+        return False
+    return result.matched_count == 1 or result.upserted_id is not None
+
+
+async def update_stock_layers(tenant_id: str, movements: List[dict], max_attempts: int = 5) -> None:
+    """Mettre à jour incrémentalement les couches de valorisation après des mouvements.
+    Les états sont lus en une requête, recalculés en mémoire puis écrits en parallèle,
+    chacun conditionné par la révision lue; les produits modifiés entre-temps sont
+    relus et rejoués. Pendant une reconstruction (rebuild_stock_layers), les produits
+    concernés ne sont pas mis à jour: la reconstruction relit l'historique.
+    Les produits encore en conflit après max_attempts, ou déjà périmés, sont marqués
+    pour reconstruction (rebuild_stale_stock_layers) au lieu d'être abandonnés.
+    """
+    by_product = {}
+    for movement in movements:
+        by_product.setdefault(movement["product_id"], []).append(movement)
+    
+    pending = set(by_product)
+    stale = set()
+    seen_rebuilds = {}
+    for _ in range(max_attempts):
+        if not pending:
+            break
+        pending -= await _deferred_to_rebuild(tenant_id, pending)
+        if not pending:
+            break
+        docs = await db.stock_layers.find(
+            {"tenant_id": tenant_id, "product_id": {"$in": list(pending)}}, {"_id": 0}
+        ).to_list(None)
+        states = {d["product_id"]: d for d in docs}
+        
+        writes = []
+        for product_id in list(pending):
+            state = states.get(product_id) or new_layer_state(tenant_id, product_id)
+            if state.get("stale_at"):
+                # Reconstruction à venir: le marquage est renouvelé pour qu'elle relise ce mouvement
+                stale.add(product_id)
+                pending.discard(product_id)
+                continue
+            if product_id in seen_rebuilds and state.get("rebuild_id") != seen_rebuilds[product_id]:
+                # Reconstruit depuis la première lecture: l'historique relu contenait déjà ces mouvements
+                pending.discard(product_id)
+                continue
+            seen_rebuilds.setdefault(product_id, state.get("rebuild_id"))
+            previous_revision = state.get("revision")
+            for movement in by_product[product_id]:
+                apply_movement_to_layers(state, movement)
+            state["revision"] = str(uuid.uuid4())
+            state["updated_at"] = datetime.now(timezone.utc)
+            writes.append((product_id, _write_layer_state(tenant_id, product_id, state, previous_revision)))
+        
+        applied = await asyncio.gather(*(write for _, write in writes))
+        pending -= {product_id for (product_id, _), ok in zip(writes, applied) if ok}
+    
+    if pending:
+        logger.warning(f"Couches de valorisation de {len(pending)} produit(s) marquées pour reconstruction (conflits répétés)")
+    if pending or stale:
+        await _mark_layers_stale(tenant_id, pending | stale)
+
+
+async def _mark_layers_stale(tenant_id: str, product_ids) -> None:
+    """Marquer des couches périmées: rebuild_stale_stock_layers relira l'historique.
+    stale_at ne fait qu'avancer; une reconstruction ne lève que les marquages antérieurs à sa passe.
+    """
+    now = datetime.now(timezone.utc)
+    await db.stock_layers.bulk_write([
+        UpdateOne(
+            {"tenant_id": tenant_id, "product_id": product_id},
+            {"$max": {"stale_at": now}, "$setOnInsert": {
+                k: v for k, v in new_layer_state(tenant_id, product_id).items() if k not in ("tenant_id", "product_id")
+            }},
+            upsert=True
+        )
+        for product_id in product_ids
+    ], ordered=False)
+
+
+async def _acquire_rebuild_lock(tenant_id: str, product_id: Optional[str], token: str):
+    now = datetime.now(timezone.utc)
+    lock = {"token": token, "product_id": product_id, "dirty": False, "expires_at": now + REBUILD_LOCK_TTL}
+    try:
+        await db.stock_layer_rebuilds.insert_one({"_id": tenant_id, **lock})
+        return
+    except DuplicateKeyError:
+        pass
+    # Verrou expiré (processus interrompu): repris
+    result = await db.stock_layer_rebuilds.update_one({"_id": tenant_id, "expires_at": {"$lte": now}}, {"$set": lock})
+    if not result.matched_count:
+        raise HTTPException(status_code=409, detail="Une reconstruction des couches est déjà en cours")
+
+
+async def _rebuild_pass(tenant_id: str, product_id: Optional[str], rebuild_id: str) -> int:
+    started_at = datetime.now(timezone.utc)
+    # Prix d'achat des lignes d'approvisionnements validés
+    supply_costs = {}
+    supplies_query = {"tenant_id": tenant_id, "is_validated": True}
+    if product_id:
+        supplies_query["items.product_id"] = product_id
+    async for supply in db.supplies.find(supplies_query, {"_id": 0, "id": 1, "items": 1}):
+        for item in supply.get("items", []):
+            supply_costs[(supply["id"], item.get("product_id"))] = item.get("unit_price", 0)
+    
+    movements_query = {"tenant_id": tenant_id}
+    if product_id:
+        movements_query["product_id"] = product_id
+    states = {}
+    # Tri sur la date convertie: pendant la migration (dates.migrate_string_dates), le tri BSON
+    # placerait toutes les anciennes chaînes avant les dates natives; _id départage les égalités
+    cursor = db.stock_movements.aggregate([
+        {"$match": movements_query},
+        {"$addFields": {"_created_at": {"$toDate": "$created_at"}}},
+        {"$sort": {"_created_at": 1, "_id": 1}},
+        {"$project": {"_id": 0, "_created_at": 0}},
+    ], allowDiskUse=True)
+    async for movement in cursor:
+        if movement.get("unit_cost") is None and movement.get("reference_type") == "supply":
+            movement["unit_cost"] = supply_costs.get((movement.get("reference_id"), movement["product_id"]))
+        state = states.setdefault(movement["product_id"], new_layer_state(tenant_id, movement["product_id"]))
+        apply_movement_to_layers(state, movement)
+    
+    operations = []
+    for state in states.values():
+        state["revision"] = str(uuid.uuid4())
+        state["rebuild_id"] = rebuild_id
+        state["updated_at"] = datetime.now(timezone.utc)
+        operations.append(UpdateOne(
+            {"tenant_id": tenant_id, "product_id": state["product_id"]},
+            {"$set": state},
+            upsert=True
+        ))
+    for i in range(0, len(operations), 1000):
+        await db.stock_layers.bulk_write(operations[i:i + 1000], ordered=False)
+    # Marquages antérieurs à la passe: leurs mouvements ont été relus
+    stale_query = {"tenant_id": tenant_id, "stale_at": {"$lt": started_at}}
+    if product_id:
+        stale_query["product_id"] = product_id
+    await db.stock_layers.update_many(stale_query, {"$unset": {"stale_at": ""}})
+    return len(operations)
+
+
+async def rebuild_stock_layers(tenant_id: str, product_id: str = None) -> int:
+    """Reconstruire les couches à partir de l'historique (approvisionnements validés et mouvements).
+    Sert à initialiser les couches existantes; les mises à jour suivantes sont incrémentales.
+    Un verrou par tenant écarte les reconstructions concurrentes; les mises à jour
+    incrémentales arrivées pendant une passe la marquent "dirty" et une nouvelle passe
+    relit l'historique, jusqu'à une passe sans écriture concurrente.
+    """
+    token = str(uuid.uuid4())
+    await _acquire_rebuild_lock(tenant_id, product_id, token)
+    try:
+        for _ in range(REBUILD_MAX_PASSES):
+            await db.stock_layer_rebuilds.update_one(
+                {"_id": tenant_id, "token": token},
+                {"$set": {"dirty": False, "expires_at": datetime.now(timezone.utc) + REBUILD_LOCK_TTL}}
+            )
+            count = await _rebuild_pass(tenant_id, product_id, token)
+            released = await db.stock_layer_rebuilds.delete_one({"_id": tenant_id, "token": token, "dirty": False})
+            if released.deleted_count:
+                return count
+    finally:
+        await db.stock_layer_rebuilds.delete_one({"_id": tenant_id, "token": token})
+    raise HTTPException(status_code=409, detail="Mouvements de stock trop fréquents pendant la reconstruction, veuillez relancer")
+
+
+async def rebuild_stale_stock_layers() -> int:
+    """Reconstruire les couches des tenants marqués périmés (update_stock_layers en conflit).
+    Exécutée périodiquement (server.recover_pending_operations); un tenant déjà en
+    reconstruction est repris au passage suivant.
+    """
+    rebuilt = 0
+    for tenant_id in await db.stock_layers.distinct("tenant_id", {"stale_at": {"$exists": True}}):
+        try:
+            await rebuild_stock_layers(tenant_id)
+        except HTTPException:
+            continue
+        rebuilt += 1
+    return rebuilt
 
 
 async def get_valuation_for_product(product_id: str, tenant_id: str, method: str = "weighted_average") -> dict:
-    """Calculer la valorisation du stock pour un produit"""
+    """Calculer la valorisation du stock pour un produit à partir des couches précalculées"""
     product = await db.products.find_one({"id": product_id, "tenant_id": tenant_id})
     if not product:
         return {"unit_cost": 0, "total_value": 0}
@@ -21,15 +307,32 @@ async def get_valuation_for_product(product_id: str, tenant_id: str, method: str
     if current_stock <= 0:
         return {"unit_cost": 0, "total_value": 0}
     
-    # Méthode simple basée sur le prix d'achat
-    if method == "fifo" or method == "weighted_average":
-        unit_cost = purchase_price
-        total_value = current_stock * unit_cost
+    if method not in VALUATION_METHODS:
+        method = "weighted_average"
+    
+    layers = await db.stock_layers.find_one({"tenant_id": tenant_id, "product_id": product_id}, {"_id": 0})
+    if layers and layers.get("quantity", 0) > 0:
+        unit_cost = layers.get(f"{method}_value", 0) / layers["quantity"]
     else:
+        # Pas d'historique d'entrées: prix d'achat courant
         unit_cost = purchase_price
-        total_value = current_stock * unit_cost
     
-    return {"unit_cost": unit_cost, "total_value": total_value}
+    return {"unit_cost": unit_cost, "total_value": current_stock * unit_cost}
+
+
+async def record_movement_stats(tenant_id: str, movements: List[dict], min_stocks: dict) -> None:
+    """Répercuter des mouvements de stock sur les compteurs du tableau de bord"""
+    await increment_tenant_stats(
+        tenant_id,
+        daily={
+            "stock_entries": sum(m["movement_quantity"] for m in movements if m["movement_quantity"] > 0),
+            "stock_exits": sum(-m["movement_quantity"] for m in movements if m["movement_quantity"] < 0),
+        },
+        totals={"low_stock_count": sum(
+            low_stock_delta(m["stock_before"], m["stock_after"], min_stocks.get(m["product_id"], 10))
+            for m in movements
+        )}
+    )
 
 
 async def get_product_info(product_id: str, tenant_id: str) -> dict:
@@ -49,54 +352,66 @@ async def create_stock_movement(
     reference_id: str = None,
     notes: str = None
 ) -> StockMovement:
-    """Créer un mouvement de stock et mettre à jour le produit"""
-    # Récupérer le produit
-    product = await db.products.find_one({"id": product_id, "tenant_id": tenant_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="Produit non trouvé")
-    
-    stock_before = product.get("stock", 0)
-    stock_after = stock_before + movement_quantity
-    
-    # Vérifier que le stock ne devient pas négatif (sauf ajustement)
-    if stock_after < 0 and movement_type != StockMovementType.ADJUSTMENT:
-        raise HTTPException(status_code=400, detail=f"Stock insuffisant. Stock actuel: {stock_before}")
-    
-    # Créer le mouvement avec employee_code
-    movement = StockMovement(
-        product_id=product_id,
-        product_name=product.get("name"),
-        movement_type=movement_type,
-        movement_quantity=movement_quantity,
-        stock_before=stock_before,
-        stock_after=max(0, stock_after),
-        reference_type=reference_type,
-        reference_id=reference_id,
-        notes=notes,
-        tenant_id=tenant_id,
-        created_by=employee_code  # Utiliser employee_code
-    )
-    
-    doc = movement.model_dump()
-    doc["created_at"] = doc["created_at"].isoformat()
-    doc["movement_type"] = doc["movement_type"].value
-    
-    await db.stock_movements.insert_one(doc)
-    
-    # Mettre à jour le stock du produit
-    await db.products.update_one(
-        {"id": product_id},
-        {"$set": {"stock": max(0, stock_after), "updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
+    """Créer un mouvement de stock et mettre à jour le produit.
+    Le stock est modifié par une seule mise à jour atomique (jamais négatif hors
+    ajustement, plancher à 0): stock_before/stock_after sont ceux de l'écriture
+    elle-même, sans écraser une vente concurrente.
+    """
+    query = {"id": product_id, "tenant_id": tenant_id}
+    if movement_quantity < 0 and movement_type != StockMovementType.ADJUSTMENT:
+        query["stock"] = {"$gte": -movement_quantity}
+    async with tracked_changes(tenant_id, {"products": [product_id]}):
+        # Document avant la mise à jour: le plancher à 0 empêche de déduire stock_before de stock_after
+        product = await db.products.find_one_and_update(
+            query,
+            [{"$set": {
+                "stock": {"$max": [0, {"$add": [{"$ifNull": ["$stock", 0]}, movement_quantity]}]},
+                "updated_at": datetime.now(timezone.utc),
+            }}],
+            return_document=ReturnDocument.BEFORE
+        )
+        if not product:
+            current = await db.products.find_one({"id": product_id, "tenant_id": tenant_id}, {"_id": 0, "stock": 1})
+            if not current:
+                raise HTTPException(status_code=404, detail="Produit non trouvé")
+            raise HTTPException(status_code=400, detail=f"Stock insuffisant. Stock actuel: {current.get('stock', 0)}")
+    
+        stock_before = product.get("stock", 0)
+        stock_after = max(0, stock_before + movement_quantity)
+    
+        # Créer le mouvement avec employee_code
+        movement = StockMovement(
+            product_id=product_id,
+            product_name=product.get("name"),
+            movement_type=movement_type,
+            movement_quantity=movement_quantity,
+            stock_before=stock_before,
+            stock_after=stock_after,
+            reference_type=reference_type,
+            reference_id=reference_id,
+            unit_cost=product.get("purchase_price") if movement_quantity > 0 and movement_type != StockMovementType.RETURN else None,
+            notes=notes,
+            tenant_id=tenant_id,
+            created_by=employee_code  # Utiliser employee_code
+        )
+    
+        doc = movement.model_dump()
+        doc["movement_type"] = doc["movement_type"].value
+    
+        await db.stock_movements.insert_one(doc)
+    await update_stock_layers(tenant_id, [doc])
+    await record_movement_stats(tenant_id, [doc], {product_id: product.get("min_stock", 10)})
     
     return movement
 
 
 @router.get("/movements", response_model=List[StockMovement])
 async def get_stock_movements(
+    response: Response,
     product_id: Optional[str] = None,
     movement_type: Optional[str] = None,
-    limit: int = Query(default=100, le=500),
+    limit: int = Query(default=100, ge=1, le=500),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Récupérer l'historique des mouvements de stock"""
@@ -108,12 +423,8 @@ async def get_stock_movements(
     if movement_type:
         query["movement_type"] = movement_type
     
-    movements = await db.stock_movements.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
-    
-    # Convertir les dates
-    for mov in movements:
-        if isinstance(mov.get("created_at"), str):
-            mov["created_at"] = datetime.fromisoformat(mov["created_at"])
+    movements, next_cursor = await fetch_page(db.stock_movements, query, NEWEST_FIRST, limit, cursor)
+    set_next_cursor(response, next_cursor)
     
     return [StockMovement(**mov) for mov in movements]
 
@@ -121,20 +432,18 @@ async def get_stock_movements(
 @router.get("/movements/{product_id}", response_model=List[StockMovement])
 async def get_product_stock_history(
     product_id: str,
-    limit: int = Query(default=50, le=200),
+    response: Response,
+    limit: int = Query(default=50, ge=1, le=200),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Récupérer l'historique de stock d'un produit spécifique"""
     tenant_id = current_user["tenant_id"]
     
-    movements = await db.stock_movements.find(
-        {"product_id": product_id, "tenant_id": tenant_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(limit)
-    
-    for mov in movements:
-        if isinstance(mov.get("created_at"), str):
-            mov["created_at"] = datetime.fromisoformat(mov["created_at"])
+    movements, next_cursor = await fetch_page(
+        db.stock_movements, {"product_id": product_id, "tenant_id": tenant_id}, NEWEST_FIRST, limit, cursor
+    )
+    set_next_cursor(response, next_cursor)
     
     return [StockMovement(**mov) for mov in movements]
 
@@ -189,8 +498,8 @@ async def get_stock_summary(
     )
     
     last_date = None
-    if last_movement and last_movement.get("created_at"):
-        last_date = datetime.fromisoformat(last_movement["created_at"]) if isinstance(last_movement["created_at"], str) else last_movement["created_at"]
+    if last_movement:
+        last_date = as_datetime(last_movement.get("created_at"))
     
     return StockSummary(
         product_id=product_id,
@@ -219,6 +528,77 @@ async def get_stock_alerts(
     return low_stock_products
 
 
+# Coefficient appliqué au prix de vente quand le prix d'achat est inconnu
+ESTIMATED_COST_RATIO = 0.7
+
+
+def stock_valuation_pipeline(tenant_id: str, method: str = "weighted_average") -> List[dict]:
+    """Pipeline de valorisation par produit: stock * coût unitaire selon la méthode
+    (couches FIFO/LIFO ou coût moyen pondéré précalculés dans stock_layers, prix
+    d'achat à défaut), avec estimation (prix de vente * 0.7) pour les produits en
+    stock sans coût connu"""
+    if method not in VALUATION_METHODS:
+        method = "weighted_average"
+    return [
+        {"$match": {"tenant_id": tenant_id, "stock": {"$gt": 0}}},
+        {"$lookup": {
+            "from": "stock_layers",
+            "let": {"product_id": "$id"},
+            "pipeline": [
+                {"$match": {"tenant_id": tenant_id, "$expr": {"$eq": ["$product_id", "$$product_id"]}}},
+                {"$project": {"_id": 0, "quantity": 1, "value": f"${method}_value"}},
+            ],
+            "as": "layers",
+        }},
+        {"$project": {
+            "_id": 0,
+            "product_id": "$id",
+            "product_name": "$name",
+            "stock": 1,
+            "purchase_price": {"$ifNull": ["$purchase_price", 0]},
+            "price": {"$ifNull": ["$price", 0]},
+            "layers": {"$arrayElemAt": ["$layers", 0]},
+        }},
+        {"$addFields": {"unit_cost": {"$cond": [
+            {"$gt": [{"$ifNull": ["$layers.quantity", 0]}, 0]},
+            {"$divide": ["$layers.value", "$layers.quantity"]},
+            "$purchase_price"
+        ]}}},
+        {"$addFields": {"total_value": {"$multiply": ["$stock", "$unit_cost"]}}},
+        {"$addFields": {"estimated_value": {"$cond": [
+            {"$eq": ["$total_value", 0]},
+            {"$multiply": ["$stock", "$price", ESTIMATED_COST_RATIO]},
+            "$total_value"
+        ]}}},
+        {"$project": {"price": 0, "purchase_price": 0, "layers": 0}},
+    ]
+
+
+async def get_stock_valuation_totals(tenant_id: str, method: str = "weighted_average") -> dict:
+    """Totaux de valorisation du stock calculés en base (une seule agrégation)"""
+    pipeline = stock_valuation_pipeline(tenant_id, method) + [
+        {"$group": {
+            "_id": None,
+            "total_valuation": {"$sum": "$total_value"},
+            "total_estimated_value": {"$sum": "$estimated_value"},
+            "products_count": {"$sum": 1},
+        }}
+    ]
+    result = await db.products.aggregate(pipeline).to_list(1)
+    if not result:
+        return {"total_valuation": 0, "total_estimated_value": 0, "products_count": 0}
+    totals = result[0]
+    totals.pop("_id", None)
+    return totals
+
+
+async def iter_stock_valuation(tenant_id: str, method: str = "weighted_average", batch_size: int = 1000):
+    """Itérer la valorisation par produit depuis le curseur d'agrégation"""
+    cursor = db.products.aggregate(stock_valuation_pipeline(tenant_id, method), batchSize=batch_size)
+    async for row in cursor:
+        yield row
+
+
 @router.get("/valuation")
 async def get_stock_valuation(
     method: str = Query(default="weighted_average", description="Méthode: fifo, lifo, weighted_average"),
@@ -227,27 +607,39 @@ async def get_stock_valuation(
     """Calculer la valorisation totale du stock"""
     tenant_id = current_user["tenant_id"]
     
-    products = await db.products.find(
-        {"tenant_id": tenant_id, "stock": {"$gt": 0}},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    total_valuation = 0
-    valuations = []
-    
-    for product in products:
-        valuation = await get_valuation_for_product(product["id"], tenant_id, method)
-        total_valuation += valuation["total_value"]
-        valuations.append({
-            "product_id": product["id"],
-            "product_name": product.get("name"),
-            "stock": product.get("stock", 0),
-            "unit_cost": valuation["unit_cost"],
-            "total_value": valuation["total_value"]
-        })
+    totals = await get_stock_valuation_totals(tenant_id, method)
+    valuations = [row async for row in iter_stock_valuation(tenant_id, method)]
     
     return {
         "method": method,
-        "total_valuation": total_valuation,
+        "total_valuation": totals["total_valuation"],
+        "total_estimated_value": totals["total_estimated_value"],
         "products": valuations
     }
+
+
+@router.get("/valuation/stream")
+async def stream_stock_valuation(
+    method: str = Query(default="weighted_average", description="Méthode: fifo, lifo, weighted_average"),
+    current_user: dict = Depends(get_current_user)
+):
+    """Valorisation du stock en NDJSON: une ligne de totaux puis une ligne par produit"""
+    tenant_id = current_user["tenant_id"]
+    totals = await get_stock_valuation_totals(tenant_id, method)
+    
+    async def generate():
+        yield json.dumps({"type": "totals", "method": method, **totals}) + "\n"
+        async for row in iter_stock_valuation(tenant_id, method):
+            yield json.dumps({"type": "product", **row}, default=str) + "\n"
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@router.post("/layers/rebuild")
+async def rebuild_valuation_layers(
+    product_id: Optional[str] = None,
+    current_user: dict = Depends(require_role(["admin"]))
+):
+    """Reconstruire les couches de valorisation FIFO/LIFO/CMP depuis l'historique (Admin uniquement)"""
+    count = await rebuild_stock_layers(current_user["tenant_id"], product_id)
+    return {"message": f"Couches de valorisation reconstruites pour {count} produit(s)", "products_count": count}
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
 from typing import List, Optional
 from datetime import datetime, timezone
 from database import db
+from pagination import fetch_page, set_next_cursor, BY_NAME, MAX_PAGE_SIZE
 from auth import require_role
 from models.supplier import Supplier, SupplierCreate, SupplierUpdate
 
@@ -26,14 +27,16 @@ async def create_supplier(supplier_data: SupplierCreate, current_user: dict = De
     supplier_obj = Supplier(**supplier_dict)
     
     doc = supplier_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.suppliers.insert_one(doc)
     return supplier_obj
 
 
 @router.get("", response_model=List[Supplier])
 async def get_suppliers(
+    response: Response,
     include_inactive: Optional[bool] = None,
+    limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(require_role(["admin", "pharmacien", "caissier"]))
 ):
     """
@@ -41,6 +44,7 @@ async def get_suppliers(
     - Admin voit tous les fournisseurs (actifs et inactifs)
     - Autres utilisateurs voient uniquement les fournisseurs actifs
     - Param include_inactive: Admin peut forcer l'affichage de tous
+    - Pagination par nom: limit, cursor (curseur suivant dans X-Next-Cursor)
     """
     query = {"tenant_id": current_user['tenant_id']}
     
@@ -56,13 +60,10 @@ async def get_suppliers(
         # Non-admin voit uniquement les fournisseurs actifs
         query['is_active'] = True
     
-    suppliers = await db.suppliers.find(query, {"_id": 0}).to_list(1000)
+    suppliers, next_cursor = await fetch_page(db.suppliers, query, BY_NAME, limit, cursor)
+    set_next_cursor(response, next_cursor)
     
     for supplier in suppliers:
-        if isinstance(supplier.get('created_at'), str):
-            supplier['created_at'] = datetime.fromisoformat(supplier['created_at'])
-        if isinstance(supplier.get('updated_at'), str):
-            supplier['updated_at'] = datetime.fromisoformat(supplier['updated_at'])
         # Assurer la compatibilité avec les anciens fournisseurs sans is_active
         if 'is_active' not in supplier:
             supplier['is_active'] = True
@@ -83,10 +84,6 @@ async def get_supplier(supplier_id: str, current_user: dict = Depends(require_ro
     if not supplier:
         raise HTTPException(status_code=404, detail="Fournisseur non trouvé")
     
-    if isinstance(supplier.get('created_at'), str):
-        supplier['created_at'] = datetime.fromisoformat(supplier['created_at'])
-    if isinstance(supplier.get('updated_at'), str):
-        supplier['updated_at'] = datetime.fromisoformat(supplier['updated_at'])
     if 'is_active' not in supplier:
         supplier['is_active'] = True
     
@@ -106,16 +103,12 @@ async def update_supplier(
     
     # Préparer les données de mise à jour
     update_data = {k: v for k, v in supplier_data.model_dump().items() if v is not None}
-    update_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    update_data['updated_at'] = datetime.now(timezone.utc)
     update_data['updated_by'] = current_user.get('employee_code', '')
     
     await db.suppliers.update_one({"id": supplier_id}, {"$set": update_data})
     
     updated_supplier = await db.suppliers.find_one({"id": supplier_id}, {"_id": 0})
-    if isinstance(updated_supplier.get('created_at'), str):
-        updated_supplier['created_at'] = datetime.fromisoformat(updated_supplier['created_at'])
-    if isinstance(updated_supplier.get('updated_at'), str):
-        updated_supplier['updated_at'] = datetime.fromisoformat(updated_supplier['updated_at'])
     if 'is_active' not in updated_supplier:
         updated_supplier['is_active'] = True
     
@@ -140,17 +133,13 @@ async def toggle_supplier_status(
     
     update_data = {
         'is_active': new_status,
-        'updated_at': datetime.now(timezone.utc).isoformat(),
+        'updated_at': datetime.now(timezone.utc),
         'updated_by': current_user.get('employee_code', '')
     }
     
     await db.suppliers.update_one({"id": supplier_id}, {"$set": update_data})
     
     updated_supplier = await db.suppliers.find_one({"id": supplier_id}, {"_id": 0})
-    if isinstance(updated_supplier.get('created_at'), str):
-        updated_supplier['created_at'] = datetime.fromisoformat(updated_supplier['created_at'])
-    if isinstance(updated_supplier.get('updated_at'), str):
-        updated_supplier['updated_at'] = datetime.fromisoformat(updated_supplier['updated_at'])
     
     return Supplier(**updated_supplier)
 
@@ -1,81 +1,96 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List, Optional
-from datetime import datetime, timezone
-from database import db
+from fastapi import APIRouter, HTTPException, Depends, Query, Response, UploadFile, File, Form
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timezone, timedelta
+from pymongo import UpdateOne
+from database import db, client, supports_transactions
+from dates import as_datetime
+from pagination import fetch_page, set_next_cursor, MAX_PAGE_SIZE
 from auth import require_role, get_current_user
 from models.supply import Supply, SupplyCreate, SupplyUpdate, SupplyItem, SupplyItemCreate
 from models.stock import StockMovementType
 from models.price import PriceChangeType
+from routes.stock import update_stock_layers, record_movement_stats
+from change_log import tracked_changes
+import asyncio
+import codecs
+import csv
+import io
 import uuid
 
 router = APIRouter(prefix="/supplies", tags=["Supplies"])
 
 
-async def get_product_name(product_id: str, tenant_id: str) -> str:
-    """Récupérer le nom d'un produit"""
-    product = await db.products.find_one({"id": product_id, "tenant_id": tenant_id})
-    return product.get("name", "Produit inconnu") if product else "Produit inconnu"
+def is_employee_code(value: str) -> bool:
+    """Vérifier si une valeur de traçabilité est déjà un code employé (format XXX-NNN)"""
+    return "-" in value and len(value) <= 10
 
 
-async def get_supplier_name(supplier_id: str, tenant_id: str) -> str:
-    """Récupérer le nom d'un fournisseur"""
-    if not supplier_id:
-        return None
-    supplier = await db.suppliers.find_one({"id": supplier_id, "tenant_id": tenant_id})
-    return supplier.get("name", "Fournisseur inconnu") if supplier else "Fournisseur inconnu"
-
-
-async def get_employee_code_from_user_id(user_id: str, tenant_id: str) -> str:
-    """Récupérer le code employé à partir de l'ID utilisateur (pour compatibilité)"""
-    if not user_id:
-        return "N/A"
-    user = await db.users.find_one({"id": user_id, "tenant_id": tenant_id})
-    if user:
-        return user.get("employee_code", "N/A")
-    return "N/A"
+async def enrich_supplies(supplies: List[dict], tenant_id: str) -> List[dict]:
+    """Enrichir une page d'approvisionnements avec les noms et codes employés.
+    Les produits, fournisseurs et utilisateurs référencés sont résolus avec une
+    seule requête $in par collection, quelle que soit la taille de la page.
+    """
+    product_ids = set()
+    supplier_ids = set()
+    user_ids = set()
+    for supply in supplies:
+        if supply.get("supplier_id"):
+            supplier_ids.add(supply["supplier_id"])
+        for item in supply.get("items", []):
+            if item.get("product_id"):
+                product_ids.add(item["product_id"])
+        for field in ("created_by", "updated_by", "validated_by"):
+            value = supply.get(field)
+            if value and not is_employee_code(value):
+                # C'est probablement un UUID, chercher le code employé
+                user_ids.add(value)
+    
+    product_names = {}
+    if product_ids:
+        products = await db.products.find(
+            {"id": {"$in": list(product_ids)}, "tenant_id": tenant_id}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
+        product_names = {p["id"]: p.get("name", "Produit inconnu") for p in products}
+    
+    supplier_names = {}
+    if supplier_ids:
+        suppliers = await db.suppliers.find(
+            {"id": {"$in": list(supplier_ids)}, "tenant_id": tenant_id}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(None)
+        supplier_names = {s["id"]: s.get("name", "Fournisseur inconnu") for s in suppliers}
+    
+    employee_codes = {}
+    if user_ids:
+        users = await db.users.find(
+            {"id": {"$in": list(user_ids)}, "tenant_id": tenant_id}, {"_id": 0, "id": 1, "employee_code": 1}
+        ).to_list(None)
+        employee_codes = {u["id"]: u.get("employee_code", "N/A") for u in users}
+    
+    def resolve_employee(value, default):
+        if not value:
+            return default
+        if is_employee_code(value):
+            return value
+        return employee_codes.get(value, "N/A")
+    
+    for supply in supplies:
+        supplier_id = supply.get("supplier_id")
+        supply["supplier_name"] = supplier_names.get(supplier_id, "Fournisseur inconnu") if supplier_id else None
+        
+        # Enrichir les items
+        for item in supply.get("items", []):
+            item["product_name"] = product_names.get(item.get("product_id"), "Produit inconnu")
+        
+        supply["created_by_name"] = resolve_employee(supply.get("created_by"), "N/A")
+        supply["updated_by_name"] = resolve_employee(supply.get("updated_by"), None)
+        supply["validated_by_name"] = resolve_employee(supply.get("validated_by"), None)
+    
+    return supplies
 
 
 async def enrich_supply(supply: dict, tenant_id: str) -> dict:
     """Enrichir un approvisionnement avec les noms et codes employés"""
-    supply["supplier_name"] = await get_supplier_name(supply.get("supplier_id"), tenant_id)
-    
-    # Enrichir les items
-    for item in supply.get("items", []):
-        item["product_name"] = await get_product_name(item.get("product_id"), tenant_id)
-    
-    # Ajouter created_by_name (code employé ou chercher dans users si c'est un UUID)
-    created_by = supply.get("created_by")
-    if created_by:
-        # Vérifier si c'est déjà un code employé (format XXX-NNN)
-        if "-" in created_by and len(created_by) <= 10:
-            supply["created_by_name"] = created_by
-        else:
-            # C'est probablement un UUID, chercher le code employé
-            supply["created_by_name"] = await get_employee_code_from_user_id(created_by, tenant_id)
-    else:
-        supply["created_by_name"] = "N/A"
-    
-    # Ajouter updated_by_name (code employé)
-    updated_by = supply.get("updated_by")
-    if updated_by:
-        if "-" in updated_by and len(updated_by) <= 10:
-            supply["updated_by_name"] = updated_by
-        else:
-            supply["updated_by_name"] = await get_employee_code_from_user_id(updated_by, tenant_id)
-    else:
-        supply["updated_by_name"] = None
-    
-    # Ajouter validated_by_name (code employé)
-    validated_by = supply.get("validated_by")
-    if validated_by:
-        if "-" in validated_by and len(validated_by) <= 10:
-            supply["validated_by_name"] = validated_by
-        else:
-            supply["validated_by_name"] = await get_employee_code_from_user_id(validated_by, tenant_id)
-    else:
-        supply["validated_by_name"] = None
-    
-    return supply
+    return (await enrich_supplies([supply], tenant_id))[0]
 
 
 @router.post("", response_model=Supply)
@@ -107,7 +122,7 @@ async def create_supply(supply_data: SupplyCreate, current_user: dict = Depends(
         }
         # Ajouter date_peremption si fournie
         if item_data.date_peremption:
-            item_dict["date_peremption"] = item_data.date_peremption.isoformat()
+            item_dict["date_peremption"] = item_data.date_peremption
         
         items.append(item_dict)
     
@@ -129,8 +144,6 @@ async def create_supply(supply_data: SupplyCreate, current_user: dict = Depends(
     
     # Convertir les dates en ISO string pour MongoDB
     doc = supply.model_dump()
-    doc["supply_date"] = doc["supply_date"].isoformat() if doc["supply_date"] else None
-    doc["created_at"] = doc["created_at"].isoformat() if doc["created_at"] else None
     
     await db.supplies.insert_one(doc)
     
@@ -139,12 +152,196 @@ async def create_supply(supply_data: SupplyCreate, current_user: dict = Depends(
     return Supply(**enriched)
 
 
+# Colonnes reconnues dans les fichiers CSV de livraison (en-têtes insensibles à la casse)
+IMPORT_CSV_COLUMNS = {
+    "code": ["code", "barcode", "code_barre", "ean", "cip", "reference", "internal_reference", "ref"],
+    "quantity": ["quantity", "quantite", "qte", "qty"],
+    "unit_price": ["unit_price", "prix", "prix_achat", "pu", "price"],
+    "date_peremption": ["date_peremption", "peremption", "expiration", "expiration_date"],
+}
+
+# Format à largeur fixe: (début, fin) de chaque champ, prix en centimes, date AAAAMMJJ
+FIXED_WIDTH_LAYOUT = {
+    "code": (0, 13),
+    "quantity": (13, 21),
+    "unit_price": (21, 31),
+    "date_peremption": (31, 39),
+}
+
+
+async def load_product_code_index(tenant_id: str) -> Dict[str, dict]:
+    """Index mémoire code-barres / référence interne -> produit, chargé en un seul parcours"""
+    index = {}
+    cursor = db.products.find(
+        {"tenant_id": tenant_id, "$or": [{"barcode": {"$nin": [None, ""]}}, {"internal_reference": {"$nin": [None, ""]}}]},
+        {"_id": 0, "id": 1, "name": 1, "barcode": 1, "internal_reference": 1}
+    )
+    async for product in cursor:
+        # Le code-barres est prioritaire sur une référence interne identique
+        if product.get("internal_reference"):
+            index.setdefault(product["internal_reference"].strip().upper(), product)
+        if product.get("barcode"):
+            index[product["barcode"].strip().upper()] = product
+    return index
+
+
+def _parse_import_date(value: str) -> Optional[datetime]:
+    value = (value or "").strip()
+    if not value:
+        return None
+    for fmt in ("%Y%m%d", "%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    raise ValueError(f"date invalide '{value}'")
+
+
+def iter_csv_delivery_lines(text):
+    """Lignes d'un CSV de livraison: (numéro de ligne, champs bruts)"""
+    header_line = text.readline()
+    delimiter = ";" if header_line.count(";") > header_line.count(",") else ","
+    header = [h.strip().lower() for h in next(csv.reader([header_line], delimiter=delimiter))]
+    positions = {}
+    for field, aliases in IMPORT_CSV_COLUMNS.items():
+        positions[field] = next((header.index(a) for a in aliases if a in header), None)
+    if positions["code"] is None or positions["quantity"] is None:
+        raise HTTPException(status_code=400, detail="En-tête CSV invalide: colonnes code et quantité obligatoires")
+    for line_number, row in enumerate(csv.reader(text, delimiter=delimiter), start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        yield line_number, {
+            field: (row[pos] if pos is not None and pos < len(row) else "")
+            for field, pos in positions.items()
+        }
+
+
+def iter_fixed_width_delivery_lines(text):
+    """Lignes d'un fichier de livraison à largeur fixe (FIXED_WIDTH_LAYOUT)"""
+    for line_number, line in enumerate(text, start=1):
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        fields = {field: line[start:end] for field, (start, end) in FIXED_WIDTH_LAYOUT.items()}
+        unit_price = fields["unit_price"].strip()
+        fields["unit_price"] = str(int(unit_price) / 100) if unit_price.isdigit() else unit_price
+        yield line_number, fields
+
+
+def parse_delivery_file(binary, file_format: str, encoding: str, index: Dict[str, dict]) -> Tuple[List[dict], List[dict], float]:
+    """Lire un fichier de livraison ligne à ligne (jamais chargé entièrement en mémoire).
+    Retourne (lignes d'approvisionnement, lignes non reconnues, montant total).
+    """
+    text = io.TextIOWrapper(binary, encoding=encoding, errors="replace", newline="")
+    lines = iter_csv_delivery_lines(text) if file_format == "csv" else iter_fixed_width_delivery_lines(text)
+    
+    items = []
+    unmatched = []
+    total_amount = 0
+    for line_number, fields in lines:
+        code = fields["code"].strip()
+        product = index.get(code.upper())
+        if not product:
+            unmatched.append({"line": line_number, "code": code, "reason": "Produit non trouvé"})
+            continue
+        try:
+            quantity = int(fields["quantity"].strip())
+            unit_price = float((fields["unit_price"] or "0").strip().replace(",", ".") or 0)
+            date_peremption = _parse_import_date(fields.get("date_peremption"))
+            if quantity <= 0 or unit_price < 0:
+                raise ValueError("quantité ou prix invalide")
+        except ValueError as e:
+            unmatched.append({"line": line_number, "code": code, "reason": f"Ligne invalide: {e}"})
+            continue
+        
+        item_total = quantity * unit_price
+        total_amount += item_total
+        item = SupplyItem(
+            product_id=product["id"],
+            product_name=product.get("name"),
+            quantity=quantity,
+            unit_price=unit_price,
+            total_price=item_total,
+            date_peremption=date_peremption
+        ).model_dump()
+        if item["date_peremption"] is None:
+            item.pop("date_peremption")
+        items.append(item)
+    text.detach()
+    return items, unmatched, total_amount
+
+
+@router.post("/import")
+async def import_supply(
+    file: UploadFile = File(...),
+    file_format: Optional[str] = Form(default=None, description="csv ou fixed (déduit de l'extension si absent)"),
+    encoding: str = Form(default="utf-8-sig"),
+    supplier_id: Optional[str] = Form(default=None),
+    supply_date: Optional[datetime] = Form(default=None),
+    purchase_order_ref: Optional[str] = Form(default=None),
+    delivery_note_number: Optional[str] = Form(default=None),
+    invoice_number: Optional[str] = Form(default=None),
+    notes: Optional[str] = Form(default=None),
+    current_user: dict = Depends(require_role(["admin", "pharmacien"]))
+):
+    """Importer un bon de livraison grossiste (CSV ou largeur fixe) en un approvisionnement en attente.
+    Les produits sont reconnus par code-barres ou référence interne; les lignes non reconnues sont signalées.
+    """
+    tenant_id = current_user["tenant_id"]
+    employee_code = current_user.get("employee_code", "N/A")
+    
+    file_format = file_format or ("csv" if (file.filename or "").lower().endswith(".csv") else "fixed")
+    if file_format not in ("csv", "fixed"):
+        raise HTTPException(status_code=400, detail="Format inconnu: csv ou fixed")
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        raise HTTPException(status_code=400, detail=f"Encodage inconnu: {encoding}")
+    
+    index = await load_product_code_index(tenant_id)
+    
+    # Lecture bloquante du fichier reçu: dans un thread, hors de la boucle d'événements
+    items, unmatched, total_amount = await asyncio.to_thread(parse_delivery_file, file.file, file_format, encoding, index)
+    
+    if not items:
+        raise HTTPException(status_code=400, detail={"message": "Aucune ligne reconnue dans le fichier", "unmatched": unmatched})
+    
+    # Un seul insert pour l'approvisionnement et toutes ses lignes
+    supply = Supply(
+        supply_date=supply_date or datetime.now(timezone.utc),
+        is_validated=False,
+        supplier_id=supplier_id,
+        total_amount=total_amount,
+        purchase_order_ref=purchase_order_ref,
+        delivery_note_number=delivery_note_number,
+        invoice_number=invoice_number,
+        notes=notes,
+        items=items,
+        tenant_id=tenant_id,
+        created_by=employee_code
+    )
+    doc = supply.model_dump()
+    doc["items"] = items
+    await db.supplies.insert_one(doc)
+    
+    enriched = await enrich_supply(doc, tenant_id)
+    return {
+        "supply": Supply(**enriched),
+        "imported_lines": len(items),
+        "unmatched_lines": len(unmatched),
+        "unmatched": unmatched
+    }
+
+
 @router.get("", response_model=List[Supply])
 async def get_supplies(
+    response: Response,
     status: Optional[str] = None,
+    limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    """Récupérer tous les approvisionnements - Triés: En attente d'abord, puis par date décroissante"""
+    """Récupérer les approvisionnements par page - Triés: En attente d'abord, puis par date décroissante"""
     tenant_id = current_user["tenant_id"]
     
     query = {"tenant_id": tenant_id}
@@ -154,19 +351,15 @@ async def get_supplies(
         query["is_validated"] = True
     
     # Trier par is_validated (False=0 en premier), puis par created_at décroissant
-    supplies = await db.supplies.find(query, {"_id": 0}).sort([
+    supplies, next_cursor = await fetch_page(db.supplies, query, [
         ("is_validated", 1),  # False (0) avant True (1)
         ("created_at", -1)    # Plus récent en premier
-    ]).to_list(1000)
+    ], limit, cursor)
+    set_next_cursor(response, next_cursor)
     
-    # Enrichir chaque approvisionnement
+    # Enrichir toute la page en une requête par collection
     enriched_supplies = []
-    for supply in supplies:
-        enriched = await enrich_supply(supply, tenant_id)
-        # Convertir les dates string en datetime
-        for field in ["supply_date", "created_at", "updated_at", "validated_at"]:
-            if enriched.get(field) and isinstance(enriched[field], str):
-                enriched[field] = datetime.fromisoformat(enriched[field])
+    for enriched in await enrich_supplies(supplies, tenant_id):
         enriched_supplies.append(Supply(**enriched))
     
     return enriched_supplies
@@ -182,9 +375,6 @@ async def get_supply(supply_id: str, current_user: dict = Depends(get_current_us
         raise HTTPException(status_code=404, detail="Approvisionnement non trouvé")
     
     enriched = await enrich_supply(supply, tenant_id)
-    for field in ["supply_date", "created_at", "updated_at", "validated_at"]:
-        if enriched.get(field) and isinstance(enriched[field], str):
-            enriched[field] = datetime.fromisoformat(enriched[field])
     
     return Supply(**enriched)
 
@@ -228,13 +418,13 @@ async def update_supply(
             "total_price": item_total
         }
         if item_data.date_peremption:
-            item_dict["date_peremption"] = item_data.date_peremption.isoformat()
+            item_dict["date_peremption"] = item_data.date_peremption
         
         items.append(item_dict)
     
     # Mettre à jour avec employee_code
     update_data = {
-        "supply_date": supply_data.supply_date.isoformat() if supply_data.supply_date else existing.get("supply_date"),
+        "supply_date": supply_data.supply_date or existing.get("supply_date"),
         "supplier_id": supply_data.supplier_id,
         "purchase_order_ref": supply_data.purchase_order_ref,
         "delivery_note_number": supply_data.delivery_note_number,
@@ -243,7 +433,7 @@ async def update_supply(
         "notes": supply_data.notes,
         "items": items,
         "total_amount": total_amount,
-        "updated_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": datetime.now(timezone.utc),
         "updated_by": employee_code  # Utiliser employee_code
     }
     
@@ -251,125 +441,300 @@ async def update_supply(
     
     updated = await db.supplies.find_one({"id": supply_id}, {"_id": 0})
     enriched = await enrich_supply(updated, tenant_id)
-    for field in ["supply_date", "created_at", "updated_at", "validated_at"]:
-        if enriched.get(field) and isinstance(enriched[field], str):
-            enriched[field] = datetime.fromisoformat(enriched[field])
     
     return Supply(**enriched)
 
 
-@router.post("/{supply_id}/validate", response_model=Supply)
-async def validate_supply(
-    supply_id: str,
-    current_user: dict = Depends(require_role(["admin"]))
-):
-    """Valider un approvisionnement et mettre à jour les stocks (Admin uniquement)"""
-    tenant_id = current_user["tenant_id"]
-    employee_code = current_user.get("employee_code", "N/A")
-    
-    # Vérifier que l'appro existe
-    supply = await db.supplies.find_one({"id": supply_id, "tenant_id": tenant_id})
-    if not supply:
-        raise HTTPException(status_code=404, detail="Approvisionnement non trouvé")
-    
-    if supply.get("is_validated"):
-        raise HTTPException(status_code=400, detail="Cet approvisionnement est déjà validé")
-    
-    if not supply.get("items") or len(supply.get("items", [])) == 0:
-        raise HTTPException(status_code=400, detail="Impossible de valider un approvisionnement sans produits")
-    
-    # Récupérer la date d'approvisionnement
-    supply_date = supply.get("supply_date")
-    if supply_date and isinstance(supply_date, str):
-        supply_date = datetime.fromisoformat(supply_date)
+async def load_supply_products(supply: dict, session=None) -> Dict[str, dict]:
+    """Charger en une requête ($in) tous les produits d'un approvisionnement"""
+    product_ids = list({item.get("product_id") for item in supply.get("items", [])})
+    products = await db.products.find(
+        {"id": {"$in": product_ids}, "tenant_id": supply["tenant_id"]},
+        {"_id": 0, "id": 1, "name": 1, "internal_reference": 1, "stock": 1, "min_stock": 1, "purchase_price": 1, "price": 1},
+        session=session
+    ).to_list(None)
+    return {p["id"]: p for p in products}
+
+
+def build_supply_validation(supply: dict, products_map: Dict[str, dict], employee_code: str, validated_at: datetime):
+    """Construire en mémoire les mouvements SUPPLY, les entrées d'historique de prix et
+    les mises à jour produit ($inc du stock, dernier prix d'achat) d'un approvisionnement.
+    Un produit présent sur plusieurs lignes enchaîne ses valeurs avant/après comme en saisie ligne à ligne.
+    """
+    supply_id = supply["id"]
+    tenant_id = supply["tenant_id"]
+    supply_date = as_datetime(supply.get("supply_date"))
+    state = {pid: {"stock": p.get("stock", 0), "purchase_price": p.get("purchase_price", 0)} for pid, p in products_map.items()}
+    stock_movements = []
+    price_entries = []
+    received = {}
     
-    # Mettre à jour les stocks des produits et créer l'historique
     for item in supply.get("items", []):
         product_id = item.get("product_id")
-        quantity = item.get("quantity", 0)
-        unit_price = item.get("unit_price", 0)
-        item_date_peremption = item.get("date_peremption")
-        
-        # Récupérer le produit actuel
-        product = await db.products.find_one({"id": product_id, "tenant_id": tenant_id})
+        product = products_map.get(product_id)
         if not product:
             continue
-        
-        stock_before = product.get("stock", 0)
-        stock_after = stock_before + quantity
-        purchase_price_before = product.get("purchase_price", 0)
+        quantity = item.get("quantity", 0)
+        unit_price = item.get("unit_price", 0)
+        current = state[product_id]
+        stock_before = current["stock"]
+        purchase_price_before = current["purchase_price"]
         selling_price_before = product.get("price", 0)
         
-        # 1. Créer l'entrée dans l'historique de STOCK avec employee_code
-        stock_movement = {
+        # 1. Entrée dans l'historique de STOCK avec employee_code
+        stock_movements.append({
             "id": str(uuid.uuid4()),
             "product_id": product_id,
             "product_name": product.get("name"),
             "movement_type": StockMovementType.SUPPLY.value,
             "movement_quantity": quantity,
             "stock_before": stock_before,
-            "stock_after": stock_after,
+            "stock_after": stock_before + quantity,
             "reference_type": "supply",
             "reference_id": supply_id,
+            "unit_cost": unit_price,
             "notes": f"Approvisionnement - BL: {supply.get('delivery_note_number') or 'N/A'}",
             "tenant_id": tenant_id,
-            "created_at": datetime.now(timezone.utc).isoformat(),
+            "created_at": validated_at,
             "created_by": employee_code  # Utiliser employee_code
-        }
-        await db.stock_movements.insert_one(stock_movement)
+        })
         
-        # 2. Créer l'entrée dans l'historique de PRIX avec les nouveaux champs
-        price_history = {
+        # 2. Entrée dans l'historique de PRIX
+        price_entries.append({
             "id": str(uuid.uuid4()),
             "product_id": product_id,
             "product_name": product.get("name"),
             "product_reference": product.get("internal_reference"),
-            # Nouveaux champs demandés
             "prix_appro": unit_price,
             "prix_vente_prod": selling_price_before,
             "prix_appro_avant": purchase_price_before,
             "prix_vente_avant": selling_price_before,
-            # Dates demandées
-            "date_maj_prix": datetime.now(timezone.utc).isoformat(),
-            "date_appro": supply_date.isoformat() if supply_date else None,
-            "date_peremption": item_date_peremption,
-            # Type et référence
+            "date_maj_prix": validated_at,
+            "date_appro": supply_date,
+            "date_peremption": item.get("date_peremption"),
             "change_type": PriceChangeType.SUPPLY.value,
             "reference_type": "supply",
             "reference_id": supply_id,
             "notes": f"Mise à jour via approvisionnement - Facture: {supply.get('invoice_number') or 'N/A'}",
             "tenant_id": tenant_id,
-            "created_at": datetime.now(timezone.utc).isoformat(),
+            "created_at": validated_at,
             "created_by": employee_code  # Utiliser employee_code uniquement
-        }
-        await db.price_history.insert_one(price_history)
+        })
         
-        # 3. Mettre à jour le produit
-        await db.products.update_one(
-            {"id": product_id, "tenant_id": tenant_id},
-            {"$set": {
-                "stock": stock_after,
-                "purchase_price": unit_price,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
+        current["stock"] = stock_before + quantity
+        current["purchase_price"] = unit_price
+        received[product_id] = received.get(product_id, 0) + quantity
+    
+    # 3. Une mise à jour par produit: $inc (pas d'écrasement d'une vente concurrente)
+    product_updates = {
+        product_id: {
+            "$inc": {"stock": quantity},
+            "$set": {"purchase_price": state[product_id]["purchase_price"], "updated_at": validated_at}
+        }
+        for product_id, quantity in received.items()
+    }
+    min_stocks = {pid: products_map[pid].get("min_stock", 10) for pid in received}
+    return stock_movements, price_entries, product_updates, min_stocks
+
+
+def validation_claim(supply: dict, employee_code: str, validated_at: datetime, pending: bool = False) -> Tuple[dict, dict]:
+    """Filtre/mise à jour qui marque l'appro validé, uniquement s'il ne l'est pas déjà.
+    pending: la validation reste provisoire (validation_pending) jusqu'à l'application du stock.
+    """
+    update = {
+        "is_validated": True,
+        "validated_at": validated_at,
+        "validated_by": employee_code  # Utiliser employee_code
+    }
+    if pending:
+        update["validation_pending"] = True
+    return (
+        {"id": supply["id"], "tenant_id": supply["tenant_id"], "is_validated": {"$ne": True}},
+        {"$set": update}
+    )
+
+
+async def commit_supply_validation_transaction(supply: dict, employee_code: str, validated_at: datetime):
+    """Valider l'appro dans une transaction: insert_many des historiques, un bulk_write produits"""
+    committed = {}
+    
+    async def callback(session):
+        claim_filter, claim_update = validation_claim(supply, employee_code, validated_at)
+        result = await db.supplies.update_one(claim_filter, claim_update, session=session)
+        if result.modified_count != 1:
+            raise HTTPException(status_code=400, detail="Cet approvisionnement est déjà validé")
+        products_map = await load_supply_products(supply, session=session)
+        stock_movements, price_entries, product_updates, min_stocks = build_supply_validation(
+            supply, products_map, employee_code, validated_at
+        )
+        if stock_movements:
+            await db.stock_movements.insert_many([dict(m) for m in stock_movements], session=session)
+            await db.price_history.insert_many([dict(e) for e in price_entries], session=session)
+            await db.products.bulk_write([
+                UpdateOne({"id": product_id, "tenant_id": supply["tenant_id"]}, update)
+                for product_id, update in product_updates.items()
+            ], ordered=False, session=session)
+        committed["movements"] = stock_movements
+        committed["min_stocks"] = min_stocks
+    
+    async with await client.start_session() as session:
+        await session.with_transaction(callback)
+    return committed["movements"], committed["min_stocks"]
+
+
+async def commit_supply_validation_compensated(supply: dict, employee_code: str, validated_at: datetime):
+    """Valider l'appro sans transaction (mongod standalone).
+    La validation est d'abord réservée (is_validated conditionnel, contre une double validation);
+    en cas d'erreur, historiques et stock sont annulés puis l'appro repasse en attente.
+    Les lignes produit portent un marqueur pending_supplies.<supply_id> pour une annulation idempotente.
+    La validation reste provisoire (validation_pending) jusqu'à l'application du stock:
+    recover_pending_supplies annule celles qu'un arrêt brutal a laissées en suspens.
+    """
+    supply_id = supply["id"]
+    tenant_id = supply["tenant_id"]
+    marker = f"pending_supplies.{supply_id}"
+    claim_filter, claim_update = validation_claim(supply, employee_code, validated_at, pending=True)
+    result = await db.supplies.update_one(claim_filter, claim_update)
+    if result.modified_count != 1:
+        raise HTTPException(status_code=400, detail="Cet approvisionnement est déjà validé")
+    
+    products_map = await load_supply_products(supply)
+    stock_movements, price_entries, product_updates, min_stocks = build_supply_validation(
+        supply, products_map, employee_code, validated_at
+    )
+    try:
+        if stock_movements:
+            await db.stock_movements.insert_many([dict(m) for m in stock_movements])
+            await db.price_history.insert_many([dict(e) for e in price_entries])
+            await db.products.bulk_write([
+                UpdateOne(
+                    {"id": product_id, "tenant_id": tenant_id, marker: {"$exists": False}},
+                    {**update, "$set": {**update["$set"], marker: update["$inc"]["stock"]}}
+                )
+                for product_id, update in product_updates.items()
+            ], ordered=False)
+        # Point de validation définitive: la reprise n'annule plus cet appro
+        confirmed = await db.supplies.update_one(
+            {"id": supply_id, "tenant_id": tenant_id, "validation_pending": True},
+            {"$unset": {"validation_pending": ""}}
         )
+        if confirmed.modified_count != 1:
+            # Validation déjà annulée par recover_pending_supplies (requête trop lente)
+            raise HTTPException(status_code=409, detail="Validation interrompue, veuillez réessayer")
+    except Exception:
+        if product_updates:
+            await db.products.bulk_write([
+                UpdateOne(
+                    {"id": product_id, "tenant_id": tenant_id, marker: {"$exists": True}},
+                    {"$inc": {"stock": -update["$inc"]["stock"]}, "$unset": {marker: ""}}
+                )
+                for product_id, update in product_updates.items()
+            ], ordered=False)
+        await db.stock_movements.delete_many({"reference_type": "supply", "reference_id": supply_id, "tenant_id": tenant_id})
+        await db.price_history.delete_many({"reference_type": "supply", "reference_id": supply_id, "tenant_id": tenant_id})
+        await db.supplies.update_one(
+            {"id": supply_id, "tenant_id": tenant_id},
+            {"$set": {"is_validated": False}, "$unset": {"validated_at": "", "validated_by": "", "validation_pending": ""}}
+        )
+        raise
     
-    # Marquer l'approvisionnement comme validé avec employee_code
-    await db.supplies.update_one(
-        {"id": supply_id},
-        {"$set": {
-            "is_validated": True,
-            "validated_at": datetime.now(timezone.utc).isoformat(),
-            "validated_by": employee_code  # Utiliser employee_code
-        }}
+    if product_updates:
+        await db.products.update_many(
+            {"id": {"$in": list(product_updates)}, "tenant_id": tenant_id},
+            {"$unset": {marker: ""}}
+        )
+    return stock_movements, min_stocks
+
+
+async def recover_pending_supplies(max_age_minutes: int = 5) -> int:
+    """Résoudre les validations d'appro interrompues (arrêt entre la réservation et le stock).
+    Une validation encore provisoire est annulée (historiques supprimés, appro en attente);
+    les marqueurs produit sont ensuite retirés (appro validé) ou leur stock annulé (appro en attente).
+    Exécutée périodiquement (server.recover_pending_operations): les validations
+    plus récentes que max_age_minutes peuvent appartenir à une requête en cours.
+    """
+    threshold = datetime.now(timezone.utc) - timedelta(minutes=max_age_minutes)
+    resolved = 0
+    supplies = db.supplies.find(
+        {"validation_pending": True, "validated_at": {"$lte": threshold}},
+        {"_id": 0, "id": 1, "tenant_id": 1}
     )
+    async for supply in supplies:
+        result = await db.supplies.update_one(
+            {"id": supply['id'], "tenant_id": supply['tenant_id'], "validation_pending": True},
+            {"$set": {"is_validated": False}, "$unset": {"validated_at": "", "validated_by": "", "validation_pending": ""}}
+        )
+        if result.modified_count:
+            reference = {"reference_type": "supply", "reference_id": supply['id'], "tenant_id": supply['tenant_id']}
+            await db.stock_movements.delete_many(reference)
+            await db.price_history.delete_many(reference)
+            resolved += 1
+    
+    products = db.products.find(
+        {"pending_supplies": {"$exists": True, "$ne": {}}},
+        {"_id": 0, "id": 1, "tenant_id": 1, "pending_supplies": 1}
+    )
+    async for product in products:
+        tenant_id = product['tenant_id']
+        for supply_id, quantity in (product.get('pending_supplies') or {}).items():
+            supply = await db.supplies.find_one(
+                {"id": supply_id, "tenant_id": tenant_id},
+                {"_id": 0, "is_validated": 1, "validation_pending": 1}
+            )
+            if supply and supply.get("validation_pending"):
+                # Validation en cours, ou annulée au passage suivant
+                continue
+            marker = f"pending_supplies.{supply_id}"
+            if supply and supply.get("is_validated"):
+                await db.products.update_one({"id": product['id'], "tenant_id": tenant_id}, {"$unset": {marker: ""}})
+            else:
+                async with tracked_changes(tenant_id, {"products": [product['id']]}) as changes:
+                    result = await db.products.update_one(
+                        {"id": product['id'], "tenant_id": tenant_id, marker: {"$exists": True}},
+                        {"$inc": {"stock": -quantity}, "$unset": {marker: ""}}
+                    )
+                    if not result.modified_count:
+                        changes.clear()
+            resolved += 1
+    return resolved
+
+
+@router.post("/{supply_id}/validate", response_model=Supply)
+async def validate_supply(
+    supply_id: str,
+    current_user: dict = Depends(require_role(["admin"]))
+):
+    """Valider un approvisionnement et mettre à jour les stocks (Admin uniquement)"""
+    tenant_id = current_user["tenant_id"]
+    employee_code = current_user.get("employee_code", "N/A")
+    
+    # Vérifier que l'appro existe
+    supply = await db.supplies.find_one({"id": supply_id, "tenant_id": tenant_id})
+    if not supply:
+        raise HTTPException(status_code=404, detail="Approvisionnement non trouvé")
+    
+    if supply.get("is_validated"):
+        raise HTTPException(status_code=400, detail="Cet approvisionnement est déjà validé")
+    
+    if not supply.get("items") or len(supply.get("items", [])) == 0:
+        raise HTTPException(status_code=400, detail="Impossible de valider un approvisionnement sans produits")
+    
+    # Stock, historiques et validation écrits ensemble
+    validated_at = datetime.now(timezone.utc)
+    async with tracked_changes(tenant_id, {"products": [item.get("product_id") for item in supply["items"]]}) as changes:
+        if await supports_transactions():
+            stock_movements, min_stocks = await commit_supply_validation_transaction(supply, employee_code, validated_at)
+        else:
+            stock_movements, min_stocks = await commit_supply_validation_compensated(supply, employee_code, validated_at)
+        changes["products"] = [m['product_id'] for m in stock_movements]
+    
+    # Ajouter les lots reçus aux couches de valorisation
+    await update_stock_layers(tenant_id, stock_movements)
+    await record_movement_stats(tenant_id, stock_movements, min_stocks)
     
     # Récupérer l'appro mis à jour
     updated = await db.supplies.find_one({"id": supply_id}, {"_id": 0})
     enriched = await enrich_supply(updated, tenant_id)
-    for field in ["supply_date", "created_at", "updated_at", "validated_at"]:
-        if enriched.get(field) and isinstance(enriched[field], str):
-            enriched[field] = datetime.fromisoformat(enriched[field])
     
     return Supply(**enriched)
 
@@ -425,7 +790,7 @@ async def add_item_to_supply(
         "total_price": item_total
     }
     if item_data.date_peremption:
-        new_item["date_peremption"] = item_data.date_peremption.isoformat()
+        new_item["date_peremption"] = item_data.date_peremption
     
     # Ajouter l'item et mettre à jour le total
     new_total = supply.get("total_amount", 0) + item_total
@@ -436,7 +801,7 @@ async def add_item_to_supply(
             "$push": {"items": new_item},
             "$set": {
                 "total_amount": new_total,
-                "updated_at": datetime.now(timezone.utc).isoformat(),
+                "updated_at": datetime.now(timezone.utc),
                 "updated_by": employee_code  # Utiliser employee_code
             }
         }
@@ -444,9 +809,6 @@ async def add_item_to_supply(
     
     updated = await db.supplies.find_one({"id": supply_id}, {"_id": 0})
     enriched = await enrich_supply(updated, tenant_id)
-    for field in ["supply_date", "created_at", "updated_at", "validated_at"]:
-        if enriched.get(field) and isinstance(enriched[field], str):
-            enriched[field] = datetime.fromisoformat(enriched[field])
     
     return Supply(**enriched)
 
@@ -484,7 +846,7 @@ async def remove_item_from_supply(
             "$pull": {"items": {"id": item_id}},
             "$set": {
                 "total_amount": max(0, new_total),
-                "updated_at": datetime.now(timezone.utc).isoformat(),
+                "updated_at": datetime.now(timezone.utc),
                 "updated_by": employee_code  # Utiliser employee_code
             }
         }
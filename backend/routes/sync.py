@@ -1,50 +1,618 @@
-from fastapi import APIRouter, Depends
-from typing import Optional
-from datetime import datetime, timezone
+from fastapi import APIRouter, HTTPException, Depends, Query
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timezone, timedelta
+import asyncio
+import logging
+import uuid
+from pydantic import ValidationError
+from pymongo import UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from database import db
+from dates import as_datetime
 from auth import get_current_user
-from models.sync import SyncData
+from pagination import MAX_PAGE_SIZE
+from models.sync import SyncData, SyncLog
+from models.product import Product
+from models.customer import Customer
+from models.sale import Sale
+from models.stock import StockMovement, StockMovementType
+from routes.sales import commit_sale, generate_sale_number, aggregate_item_quantities
+from routes.stock import update_stock_layers
+from change_log import record_changes, write_intent, clear_intent, read_delta, DELETE
+from tenant_stats import increment_tenant_stats
+from hlc import server_clock
+import product_search
 
 router = APIRouter(prefix="/sync", tags=["Synchronization"])
+logger = logging.getLogger(__name__)
+
+# Nombre maximal de modifications par push
+SYNC_MAX_CHANGES = 5000
+# Ventes hors ligne enregistrées simultanément
+SYNC_SALE_CONCURRENCY = 8
+# Au-delà, une modification réservée mais jamais finalisée (envoi interrompu) est reprise
+SYNC_CLAIM_STALE = timedelta(minutes=5)
+
+# Type de modification -> (collection, modèle)
+SYNC_TYPES = {
+    "customer": ("customers", Customer),
+    "product": ("products", Product),
+    "sale": ("sales", Sale),
+}
+SYNC_ACTIONS = ("create", "update", "delete")
+
+# Statuts renvoyés pour chaque modification
+APPLIED = "applied"
+DUPLICATE = "duplicate"
+NOT_FOUND = "not_found"
+REJECTED = "rejected"
+CONFLICT = "conflict"  # Aucun champ appliqué: le serveur a une version plus récente de chacun
+PENDING = "pending"  # Déjà en cours de traitement par un autre envoi: renvoyer plus tard
+ERROR = "error"  # Erreur serveur: la réservation est conservée, la modification est reprise au renvoi
+
+# Champs jamais modifiables par un client
+_PROTECTED_FIELDS = ("_id", "id", "tenant_id", "created_at")
+# Champs gérés par le serveur, jamais versionnés
+_UNVERSIONED_FIELDS = _PROTECTED_FIELDS + ("field_versions", "name_key", "updated_at", "stock")
+# Champ dérivé -> champ source (suit la version de sa source)
+_DERIVED_FIELDS = {"name_key": "name"}
+
+
+def _result(change: dict, status: str, error: Optional[str] = None, conflicts: Optional[list] = None) -> dict:
+    result = {"id": change.get('id'), "status": status}
+    if error:
+        result["error"] = error
+    if conflicts:
+        result["conflicts"] = conflicts
+    return result
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(p) for p in e['loc'])}: {e['msg']}" for e in error.errors())
+
+
+def _change_stamp(change: dict) -> str:
+    """Horodatage HLC de la modification (celui du client, sinon l'heure du serveur).
+    ValueError si l'horodatage du client est invalide.
+    """
+    if change.get('hlc') is None:
+        return server_clock.now()
+    server_clock.observe(change['hlc'])
+    return change['hlc']
+
+
+def _stock_delta(change: dict, current: dict) -> Tuple[int, Optional[dict]]:
+    """Variation de stock d'une modification produit: (delta, conflit éventuel).
+    Le stock est un compteur: le client envoie stock_delta, ou le stock absolu avec
+    la valeur sur laquelle il s'est basé (base.stock). Un stock absolu sans base
+    écraserait les ventes des autres caisses: il est signalé en conflit.
+    """
+    payload = change['payload']
+    if 'stock_delta' in payload:
+        return int(payload['stock_delta']), None
+    if 'stock' not in payload:
+        return 0, None
+    base = (change.get('base') or {}).get('stock')
+    if base is None:
+        return 0, {
+            "field": "stock",
+            "server_value": current.get('stock', 0),
+            "client_value": payload['stock'],
+            "error": "Stock absolu sans base.stock: envoyer stock_delta",
+        }
+    return int(payload['stock']) - int(base), None
+
+
+def _guarded_update(after: dict, stamps: Dict[str, str], plain_fields, stock_changes: List[Tuple[Optional[str], int]]) -> list:
+    """Mise à jour (pipeline) qui ne remplace un champ que si sa version en base est plus ancienne:
+    une écriture concurrente plus récente (autre worker, autre caisse) n'est jamais écrasée.
+    Le stock est incrémenté, jamais remplacé: chaque variation est marquée dans pending_sync
+    (identifiant de la modification) par la même écriture et n'est jamais ajoutée deux fois.
+    sync_stock_before conserve le stock lu par cette écriture (mouvement d'ajustement).
+    """
+    stage = {field: after[field] for field in plain_fields}
+    for field, stamp in stamps.items():
+        newer = {"$lt": [{"$ifNull": [f"$field_versions.{field}", ""]}, stamp]}
+        stage[field] = {"$cond": [newer, {"$literal": after.get(field)}, f"${field}"]}
+        stage[f"field_versions.{field}"] = {"$cond": [newer, stamp, f"$field_versions.{field}"]}
+        for derived, source in _DERIVED_FIELDS.items():
+            if source == field and derived in after:
+                stage[derived] = {"$cond": [newer, {"$literal": after[derived]}, f"${derived}"]}
+    if stock_changes:
+        marks = {"$ifNull": ["$pending_sync", []]}
+        added = [
+            {"$cond": [{"$in": [{"$literal": change_id}, marks]}, 0, delta]} if change_id else delta
+            for change_id, delta in stock_changes
+        ]
+        stage["stock"] = {"$max": [0, {"$add": [{"$ifNull": ["$stock", 0]}, *added]}]}
+        stage["sync_stock_before"] = {"$ifNull": ["$stock", 0]}
+        change_ids = [change_id for change_id, _ in stock_changes if change_id]
+        if change_ids:
+            stage["pending_sync"] = {"$setUnion": [marks, {"$literal": change_ids}]}
+    return [{"$set": stage}]
+
+
+async def apply_document_changes(tenant_id: str, collection: str, model, changes: List[Tuple[int, dict]], results: list, current_user: dict):
+    """Appliquer les créations / modifications / suppressions d'une collection en un bulk_write.
+    L'état courant est lu en une requête, les modifications sont rejouées en mémoire
+    puis une opération par document est écrite (filtrée par tenant).
+
+    Résolution des conflits champ par champ: chaque champ porte la version HLC de
+    sa dernière écriture (field_versions); une modification ne remplace un champ
+    que si elle est plus récente, les champs refusés sont renvoyés dans "conflicts".
+    Le stock des produits est appliqué en variation ($add), ce qui rend commutatives
+    les modifications de stock de plusieurs caisses hors ligne.
+    """
+    if not changes:
+        return
+    ids = list({change['payload']['id'] for _, change in changes})
+    state = {d['id']: d for d in await db[collection].find({"tenant_id": tenant_id, "id": {"$in": ids}}, {"_id": 0}).to_list(None)}
+    # Un produit déjà vendu ne peut pas être supprimé (historique des ventes)
+    sold = set()
+    if collection == "products":
+        deleted_ids = [change['payload']['id'] for _, change in changes if change['action'] == 'delete']
+        if deleted_ids:
+            sold = set(await db.sales.distinct("items.product_id", {"tenant_id": tenant_id, "items.product_id": {"$in": deleted_ids}}))
+
+    # Validation et résolution en mémoire, dans l'ordre du client; chaque document est
+    # ensuite écrit une seule fois depuis son état final (pas de dépendance à l'ordre du bulk_write)
+    initial = dict(state)
+    stamps: Dict[str, Dict[str, str]] = {}
+    stock_changes: Dict[str, List[Tuple[Optional[str], int]]] = {}
+    conflicts: Dict[int, list] = {}
+    adjustments: Dict[str, List[Tuple[dict, int]]] = {}  # id -> [(modification, variation)], dans l'ordre
+    positions: Dict[str, List[Tuple[int, dict]]] = {}
+    now = datetime.now(timezone.utc)
+    for position, change in changes:
+        payload, action = change['payload'], change['action']
+        doc_id = payload['id']
+        current = state.get(doc_id)
+        try:
+            if action == 'create':
+                if current is not None:
+                    results[position] = _result(change, DUPLICATE)
+                    continue
+                stamp = _change_stamp(change)
+                doc = model(**{**payload, "tenant_id": tenant_id}).model_dump()
+                doc['field_versions'] = {f: stamp for f in doc if f not in _UNVERSIONED_FIELDS}
+                state[doc_id] = doc
+            elif action == 'update':
+                if current is None:
+                    results[position] = _result(change, NOT_FOUND)
+                    continue
+                stamp = _change_stamp(change)
+                versions = dict(current.get('field_versions') or {})
+                accepted, refused = {}, []
+                for field, value in payload.items():
+                    if field not in model.model_fields or field in _UNVERSIONED_FIELDS:
+                        continue
+                    if versions.get(field, "") < stamp:
+                        accepted[field] = value
+                        versions[field] = stamp
+                    elif current.get(field) != value:
+                        refused.append({
+                            "field": field,
+                            "server_value": current.get(field),
+                            "client_value": value,
+                            "server_version": versions.get(field),
+                            "client_version": stamp,
+                        })
+                delta = 0
+                if collection == "products":
+                    delta, stock_conflict = _stock_delta(change, current)
+                    if stock_conflict:
+                        refused.append(stock_conflict)
+                    if change.get('id') in ((initial.get(doc_id) or {}).get('pending_sync') or []):
+                        # Variation déjà appliquée par un envoi interrompu (reprise)
+                        delta = 0
+                if refused:
+                    conflicts[position] = refused
+                if refused and not accepted and not delta:
+                    results[position] = _result(change, CONFLICT, conflicts=refused)
+                    continue
+                doc = model(**{
+                    **current, **accepted,
+                    "field_versions": versions, "id": doc_id, "tenant_id": tenant_id,
+                }).model_dump()
+                if delta:
+                    doc['stock'] = max(0, current.get('stock', 0) + delta)
+                    adjustments.setdefault(doc_id, []).append((change, delta))
+                if 'updated_at' in doc:
+                    doc['updated_at'] = now
+                state[doc_id] = doc
+                stamps.setdefault(doc_id, {}).update({field: stamp for field in accepted})
+                if delta:
+                    change_id = change.get('id') if isinstance(change.get('id'), str) else None
+                    stock_changes.setdefault(doc_id, []).append((change_id, delta))
+            else:
+                if current is None:
+                    results[position] = _result(change, NOT_FOUND)
+                    continue
+                if doc_id in sold:
+                    results[position] = _result(change, REJECTED, "Produit déjà vendu: il peut être désactivé mais pas supprimé")
+                    continue
+                state[doc_id] = None
+        except ValidationError as e:
+            results[position] = _result(change, REJECTED, _validation_message(e))
+            continue
+        except (TypeError, ValueError) as e:
+            # Horodatage HLC invalide ou en avance, stock_delta non entier
+            results[position] = _result(change, REJECTED, str(e))
+            continue
+        positions.setdefault(doc_id, []).append((position, change))
+
+    # operation_ids: document de chaque opération du bulk_write (même index)
+    operations, operation_ids, doc_ids, creations = [], [], [], set()
+    stock_updates: Dict[str, list] = {}
+    for doc_id in positions:
+        before, after = initial.get(doc_id), state.get(doc_id)
+        if before is None and after is None:
+            continue
+        if after is None:
+            operations.append(DeleteOne({"id": doc_id, "tenant_id": tenant_id}))
+        elif before is None:
+            # $setOnInsert: rejouer une création ne remplace jamais le document
+            creations.add(len(operations))
+            operations.append(UpdateOne({"id": doc_id, "tenant_id": tenant_id}, {"$setOnInsert": after}, upsert=True))
+        else:
+            plain = ["updated_at"] if "updated_at" in after else []
+            update = _guarded_update(after, stamps.get(doc_id, {}), plain, stock_changes.get(doc_id, []))
+            if doc_id in stock_changes:
+                # Écrit à part: le stock réel avant/après est relu du résultat de l'écriture
+                stock_updates[doc_id] = update
+            else:
+                operations.append(UpdateOne({"id": doc_id, "tenant_id": tenant_id}, update))
+        if doc_id not in stock_updates:
+            operation_ids.append(doc_id)
+        doc_ids.append(doc_id)
+
+    # Annoncée avant toute écriture: reprise par recover_pending_changes si l'envoi s'interrompt
+    intent_id = await write_intent(tenant_id, {collection: doc_ids})
+    failed, inserted = {}, set()
+    if operations:
+        try:
+            result = await db[collection].bulk_write(operations, ordered=False)
+            inserted = set(result.upserted_ids)
+        except BulkWriteError as e:
+            # Ex: nom ou code-barres déjà utilisé (index uniques)
+            failed = {operation_ids[error['index']]: error.get('errmsg', "Erreur d'écriture") for error in e.details.get('writeErrors', [])}
+            inserted = {upsert['index'] for upsert in e.details.get('upserted', [])}
+    # Création concurrente (autre envoi, autre worker): $setOnInsert n'a rien écrit
+    preexisting = {operation_ids[index] for index in creations - inserted} - set(failed)
+
+    async def write_stock(doc_id: str, update: list):
+        try:
+            return doc_id, await db[collection].find_one_and_update(
+                {"id": doc_id, "tenant_id": tenant_id}, update,
+                projection={"_id": 0, "stock": 1, "sync_stock_before": 1},
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError as e:
+            return doc_id, e
+
+    # doc_id -> (stock avant, stock après) de l'écriture
+    stock_levels: Dict[str, Tuple[int, int]] = {}
+    for doc_id, written in await asyncio.gather(*(write_stock(d, u) for d, u in stock_updates.items())):
+        if isinstance(written, DuplicateKeyError):
+            failed[doc_id] = str(written)
+        elif written is None:
+            failed[doc_id] = "Document supprimé entre-temps"
+        else:
+            stock_levels[doc_id] = (written.get('sync_stock_before', 0), written.get('stock', 0))
+
+    upserted, deleted = [], []
+    stats = {"products_count": 0, "low_stock_count": 0}
+    for doc_id, doc_changes in positions.items():
+        for position, change in doc_changes:
+            if doc_id in failed:
+                results[position] = _result(change, REJECTED, failed[doc_id])
+            elif doc_id in preexisting:
+                if change['action'] == 'create':
+                    results[position] = _result(change, DUPLICATE)
+                else:
+                    # Écrite sur un document qui n'existait pas: reprise au renvoi
+                    results[position] = _result(change, ERROR, "Document créé simultanément par un autre envoi")
+            else:
+                results[position] = _result(change, APPLIED, conflicts=conflicts.get(position))
+        if doc_id in failed or doc_id in preexisting or doc_id not in doc_ids:
+            continue
+        before, after = initial.get(doc_id), state.get(doc_id)
+        (deleted if after is None else upserted).append(doc_id)
+        if collection == "products":
+            stock_before, stock_after = stock_levels.get(doc_id, (
+                before.get('stock', 0) if before is not None else 0,
+                after.get('stock', 0) if after is not None else 0,
+            ))
+            stats['products_count'] += (after is not None) - (before is not None)
+            stats['low_stock_count'] += (
+                int(after is not None and stock_after <= after.get('min_stock', 10))
+                - int(before is not None and stock_before <= before.get('min_stock', 10))
+            )
+
+    # Variations de stock hors ligne: mouvements d'ajustement (historique, valorisation).
+    # Les valeurs avant/après viennent de l'écriture (stock_levels), pas de la lecture préalable;
+    # la dernière modification d'un produit absorbe l'éventuel plancher à 0.
+    movements = []
+    for doc_id, (stock_before, stock_after) in stock_levels.items():
+        product = state.get(doc_id)
+        if product is None or doc_id in failed:
+            continue
+        doc_adjustments = adjustments.get(doc_id, [])
+        level = stock_before
+        for rank, (change, delta) in enumerate(doc_adjustments):
+            next_level = stock_after if rank == len(doc_adjustments) - 1 else level + delta
+            if next_level == level:
+                continue
+            movement = StockMovement(
+                product_id=doc_id,
+                product_name=product.get('name'),
+                movement_type=StockMovementType.ADJUSTMENT,
+                movement_quantity=next_level - level,
+                stock_before=level,
+                stock_after=next_level,
+                reference_type="sync",
+                reference_id=change.get('id'),
+                notes="Ajustement hors ligne",
+                tenant_id=tenant_id,
+                created_by=current_user.get('employee_code', 'N/A'),
+            ).model_dump()
+            movement['movement_type'] = movement['movement_type'].value
+            movements.append(movement)
+            level = next_level
+    if movements:
+        await db.stock_movements.insert_many(movements)
+        await update_stock_layers(tenant_id, movements)
+
+    await record_changes(tenant_id, collection, upserted)
+    await record_changes(tenant_id, collection, deleted, op=DELETE)
+    await clear_intent(intent_id)
+    if collection == "products":
+        await increment_tenant_stats(tenant_id, daily={
+            "stock_entries": sum(m["movement_quantity"] for m in movements if m["movement_quantity"] > 0),
+            "stock_exits": sum(-m["movement_quantity"] for m in movements if m["movement_quantity"] < 0),
+        }, totals=stats)
+        if upserted or deleted:
+            product_search.invalidate(tenant_id)
+
+
+async def apply_offline_sales(current_user: dict, changes: List[Tuple[int, dict]], results: list):
+    """Enregistrer les ventes hors ligne par le même chemin que POST /sales (stock, mouvements, compteurs).
+    Une vente déjà présente (même id) n'est jamais enregistrée deux fois.
+    Le vendeur est l'utilisateur authentifié; le code employé envoyé par le poste n'est
+    conservé qu'à titre indicatif (client_employee_code), jamais utilisé pour l'attribution.
+    """
+    if not changes:
+        return
+    tenant_id = current_user['tenant_id']
+    sale_ids = [change['payload']['id'] for _, change in changes]
+    existing = set(await db.sales.distinct("id", {"tenant_id": tenant_id, "id": {"$in": sale_ids}}))
+    semaphore = asyncio.Semaphore(SYNC_SALE_CONCURRENCY)
+    seen = set()
+
+    async def apply(position: int, change: dict):
+        payload = change['payload']
+        if change['action'] != 'create':
+            results[position] = _result(change, REJECTED, "Une vente ne peut être ni modifiée ni supprimée")
+            return
+        if payload['id'] in existing or payload['id'] in seen:
+            results[position] = _result(change, DUPLICATE)
+            return
+        seen.add(payload['id'])
+        try:
+            sale = Sale(**{
+                **payload,
+                "tenant_id": tenant_id,
+                "user_id": current_user['user_id'],
+                "employee_code": current_user.get('employee_code', 'N/A'),
+                "client_employee_code": payload.get('employee_code') if isinstance(payload.get('employee_code'), str) else None,
+                "sale_number": payload.get('sale_number') or await generate_sale_number(tenant_id),
+                "returned_quantities": {},
+            })
+            sale.total = round(sale.total, 2)
+            quantities = aggregate_item_quantities(sale.items)
+            async with semaphore:
+                await commit_sale(sale.model_dump(), quantities, sale.employee_code)
+            results[position] = _result(change, APPLIED)
+        except ValidationError as e:
+            results[position] = _result(change, REJECTED, _validation_message(e))
+        except HTTPException as e:
+            # Ex: stock insuffisant au moment de la synchronisation
+            results[position] = _result(change, REJECTED, e.detail)
+        except DuplicateKeyError:
+            results[position] = _result(change, DUPLICATE)
+        except Exception as e:
+            # Vente malformée ou erreur base: les autres modifications de l'envoi sont traitées
+            logger.error(f"Vente hors ligne {payload.get('id')} non enregistrée: {e!r}")
+            results[position] = _result(change, ERROR, "Erreur serveur lors de l'enregistrement de la vente")
+
+    await asyncio.gather(*(apply(position, change) for position, change in changes))
+
+
+def _sync_log(change: dict, current_user: dict, timestamp: datetime, status: str, result: Optional[dict] = None, claim_token: Optional[str] = None) -> dict:
+    result = result or {}
+    return SyncLog(
+        change_id=change.get('id'),
+        type=str(change.get('type')),
+        action=str(change.get('action')),
+        payload=change.get('payload') if isinstance(change.get('payload'), dict) else {},
+        tenant_id=current_user['tenant_id'],
+        user_id=current_user['user_id'],
+        timestamp=timestamp,
+        synced=status == APPLIED,
+        status=status,
+        error=result.get('error'),
+        conflicts=result.get('conflicts', []),
+        claim_token=claim_token,
+    ).model_dump()
+
+
+async def claim_changes(current_user: dict, candidates: List[Tuple[int, dict]], results: list, token: str, timestamp: datetime) -> set:
+    """Réserver les change_id avant toute écriture: un journal "pending" par modification,
+    inséré sous l'index unique (tenant_id, change_id). Un rejeu (même concurrent) se heurte
+    à la réservation: déjà finalisée -> DUPLICATE, en cours -> PENDING. Une réservation
+    plus ancienne que SYNC_CLAIM_STALE (envoi interrompu) est reprise par cet envoi.
+    Retourne les positions réservées.
+    """
+    tenant_id = current_user['tenant_id']
+    claimable = [(position, change) for position, change in candidates if isinstance(change.get('id'), str)]
+    if not claimable:
+        return set()
+    taken = set()
+    try:
+        await db.sync_logs.insert_many(
+            [_sync_log(change, current_user, timestamp, PENDING, claim_token=token) for _, change in claimable],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != 11000 for error in errors):
+            raise
+        taken = {error['index'] for error in errors}
+
+    claimed = {position for index, (position, _) in enumerate(claimable) if index not in taken}
+    if taken:
+        change_ids = [claimable[index][1]['id'] for index in taken]
+        existing = {
+            log['change_id']: log
+            async for log in db.sync_logs.find(
+                {"tenant_id": tenant_id, "change_id": {"$in": change_ids}},
+                {"_id": 0, "change_id": 1, "status": 1, "timestamp": 1, "claim_token": 1}
+            )
+        }
+        stale_before = timestamp - SYNC_CLAIM_STALE
+        for index in taken:
+            position, change = claimable[index]
+            log = existing.get(change['id'])
+            if log is not None and log.get('status') != PENDING:
+                results[position] = _result(change, DUPLICATE)
+                continue
+            if log is not None and as_datetime(log['timestamp']) <= stale_before:
+                takeover = await db.sync_logs.update_one(
+                    {"tenant_id": tenant_id, "change_id": change['id'], "status": PENDING, "claim_token": log.get('claim_token')},
+                    {"$set": {"claim_token": token, "timestamp": timestamp}}
+                )
+                if takeover.modified_count:
+                    claimed.add(position)
+                    continue
+            results[position] = _result(change, PENDING, "Modification en cours de traitement par un autre envoi")
+    return claimed
+
+
+async def finalize_claims(current_user: dict, changes: List[dict], results: list, claimed: set, token: str, timestamp: datetime):
+    """Écrire le statut final des modifications réservées, journaliser les autres,
+    puis retirer les marqueurs de stock (pending_sync) des modifications finalisées.
+    Une modification en ERROR garde sa réservation: elle sera reprise après SYNC_CLAIM_STALE.
+    """
+    tenant_id = current_user['tenant_id']
+    operations, logs, finalized = [], [], []
+    for position, (change, result) in enumerate(zip(changes, results)):
+        status = result['status']
+        if position in claimed:
+            if status == ERROR:
+                continue
+            log = _sync_log(change, current_user, timestamp, status, result)
+            operations.append(UpdateOne(
+                {"tenant_id": tenant_id, "change_id": change['id'], "claim_token": token},
+                {"$set": {k: log[k] for k in ("status", "synced", "error", "conflicts", "timestamp")}, "$unset": {"claim_token": ""}}
+            ))
+            finalized.append(change['id'])
+        elif status not in (DUPLICATE, PENDING):
+            logs.append(_sync_log(change, current_user, timestamp, status, result))
+    if operations:
+        await db.sync_logs.bulk_write(operations, ordered=False)
+    if logs:
+        try:
+            await db.sync_logs.insert_many(logs, ordered=False)
+        except BulkWriteError:
+            pass
+    if finalized:
+        await db.products.update_many(
+            {"tenant_id": tenant_id, "pending_sync": {"$in": finalized}},
+            {"$pull": {"pending_sync": {"$in": finalized}}}
+        )
+
+
+def _fail_unresolved(changes: List[Tuple[int, dict]], results: list, error: str):
+    for position, change in changes:
+        if results[position] is None:
+            results[position] = _result(change, ERROR, error)
+
 
 @router.post("/push")
 async def sync_push(sync_data: SyncData, current_user: dict = Depends(get_current_user)):
-    """Push changes to server"""
-    for change in sync_data.changes:
-        change['tenant_id'] = current_user['tenant_id']
-        change['user_id'] = current_user['user_id']
-        change['synced'] = True
-        change['timestamp'] = datetime.now(timezone.utc).isoformat()
-        
-        if change['type'] == 'product':
-            if change['action'] == 'create':
-                await db.products.insert_one(change['payload'])
-            elif change['action'] == 'update':
-                await db.products.update_one({"id": change['payload']['id']}, {"$set": change['payload']})
-            elif change['action'] == 'delete':
-                await db.products.delete_one({"id": change['payload']['id']})
-        
-        elif change['type'] == 'sale':
-            if change['action'] == 'create':
-                await db.sales.insert_one(change['payload'])
-        
-        await db.sync_logs.insert_one(change)
-    
-    return {"message": f"Synced {len(sync_data.changes)} changes"}
+    """Push offline changes to server.
+    Each change: {id (client-generated, for deduplication), type, action, payload,
+    hlc (optional hybrid logical clock of the edit), base (optional, e.g. {"stock": n})}.
+    Changes are grouped per collection and written in batches; offline sales go
+    through the regular sale path. Product/customer updates are merged per field
+    (newest hlc wins) and product stock is applied as a delta (payload.stock_delta).
+    Each change id is claimed before anything is written, so a replay is never applied twice.
+    Returns a status per change, in order, with the fields refused in "conflicts";
+    "pending" and "error" changes should be sent again later.
+    """
+    tenant_id = current_user['tenant_id']
+    changes = sync_data.changes
+    if len(changes) > SYNC_MAX_CHANGES:
+        raise HTTPException(status_code=400, detail=f"Trop de modifications ({len(changes)}), maximum {SYNC_MAX_CHANGES} par envoi")
 
-@router.get("/pull")
-async def sync_pull(since: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    """Pull changes from server"""
-    query = {"tenant_id": current_user['tenant_id']}
-    if since:
-        query['updated_at'] = {"$gt": since}
-    
-    products = await db.products.find(query, {"_id": 0}).to_list(1000)
-    sales = await db.sales.find(query, {"_id": 0}).to_list(1000)
-    customers = await db.customers.find({"tenant_id": current_user['tenant_id']}, {"_id": 0}).to_list(1000)
-    
+    results: List[Optional[dict]] = [None] * len(changes)
+    valid: List[Tuple[int, dict]] = []
+    seen = set()
+    for position, change in enumerate(changes):
+        change_id = change.get('id')
+        if change_id is not None and change_id in seen:
+            results[position] = _result(change, DUPLICATE)
+            continue
+        seen.add(change_id)
+        payload = change.get('payload')
+        if change.get('type') not in SYNC_TYPES or change.get('action') not in SYNC_ACTIONS \
+                or not isinstance(payload, dict) or not isinstance(payload.get('id'), str) or not payload['id']:
+            results[position] = _result(change, REJECTED, "Modification invalide: type, action ou payload.id manquant")
+            continue
+        valid.append((position, change))
+
+    # Réservation des modifications (rejeu après coupure, envois simultanés)
+    token = str(uuid.uuid4())
+    timestamp = datetime.now(timezone.utc)
+    claimed = await claim_changes(current_user, valid, results, token, timestamp)
+    grouped: Dict[str, List[Tuple[int, dict]]] = {t: [] for t in SYNC_TYPES}
+    for position, change in valid:
+        if results[position] is None:
+            grouped[change['type']].append((position, change))
+
+    # Clients et produits d'abord: une vente hors ligne peut référencer un produit créé hors ligne
+    for change_type in ("customer", "product"):
+        collection, model = SYNC_TYPES[change_type]
+        try:
+            await apply_document_changes(tenant_id, collection, model, grouped[change_type], results, current_user)
+        except Exception as e:
+            logger.error(f"Synchronisation {collection} ({tenant_id}) en échec: {e!r}")
+            _fail_unresolved(grouped[change_type], results, "Erreur serveur lors de l'application")
+    try:
+        await apply_offline_sales(current_user, grouped["sale"], results)
+    except Exception as e:
+        logger.error(f"Synchronisation des ventes ({tenant_id}) en échec: {e!r}")
+        _fail_unresolved(grouped["sale"], results, "Erreur serveur lors de l'enregistrement de la vente")
+
+    await finalize_claims(current_user, changes, results, claimed, token, datetime.now(timezone.utc))
+
+    counts = {status: sum(1 for r in results if r['status'] == status) for status in (APPLIED, DUPLICATE, NOT_FOUND, REJECTED, CONFLICT, PENDING, ERROR)}
     return {
-        "products": products,
-        "sales": sales,
-        "customers": customers
+        "message": f"Synced {counts[APPLIED]} changes",
+        **counts,
+        "results": results
     }
+
+
+@router.get("/pull")
+async def sync_pull(
+    checkpoint: int = Query(default=0, ge=0, description="next_checkpoint de la réponse précédente (0: tout)"),
+    limit: int = Query(default=500, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """Pull changes since a checkpoint (products, sales, customers).
+    Returns {upserts, deletes, next_checkpoint, has_more, reset_required}; call again with
+    next_checkpoint while has_more is true. reset_required: the history after the
+    checkpoint was compacted away, drop local data and pull again from checkpoint 0.
+    """
+    return await read_delta(current_user['tenant_id'], checkpoint, limit)
@@ -1,7 +1,7 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from typing import List, Optional
 from database import db
+from pagination import fetch_page, set_next_cursor, BY_NAME, MAX_PAGE_SIZE
 from auth import require_role, get_current_user
 from models.unit import Unit, UnitCreate
 
@@ -23,18 +23,20 @@ async def create_unit(unit_data: UnitCreate, current_user: dict = Depends(requir
     unit_obj = Unit(**unit_dict)
     
     doc = unit_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.units.insert_one(doc)
     return unit_obj
 
 @router.get("", response_model=List[Unit])
-async def get_units(current_user: dict = Depends(get_current_user)):
-    """Get all product units"""
-    units = await db.units.find({"tenant_id": current_user['tenant_id']}, {"_id": 0}).to_list(1000)
-    for unit in units:
-        if isinstance(unit.get('created_at'), str):
-            unit['created_at'] = datetime.fromisoformat(unit['created_at'])
+async def get_units(
+    response: Response,
+    limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get product units page by page (sorted by name)"""
+    units, next_cursor = await fetch_page(db.units, {"tenant_id": current_user['tenant_id']}, BY_NAME, limit, cursor)
+    set_next_cursor(response, next_cursor)
     return units
 
 @router.get("/{unit_id}", response_model=Unit)
@@ -43,8 +45,6 @@ async def get_unit(unit_id: str, current_user: dict = Depends(get_current_user))
     unit = await db.units.find_one({"id": unit_id, "tenant_id": current_user['tenant_id']}, {"_id": 0})
     if not unit:
         raise HTTPException(status_code=404, detail="Unit not found")
-    if isinstance(unit.get('created_at'), str):
-        unit['created_at'] = datetime.fromisoformat(unit['created_at'])
     return Unit(**unit)
 
 @router.put("/{unit_id}", response_model=Unit)
@@ -67,8 +67,6 @@ async def update_unit(unit_id: str, unit_data: UnitCreate, current_user: dict =
     await db.units.update_one({"id": unit_id}, {"$set": update_data})
     
     updated_unit = await db.units.find_one({"id": unit_id}, {"_id": 0})
-    if isinstance(updated_unit.get('created_at'), str):
-        updated_unit['created_at'] = datetime.fromisoformat(updated_unit['created_at'])
     return Unit(**updated_unit)
 
 @router.delete("/{unit_id}")
@@ -1,21 +1,28 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
-from datetime import datetime
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from typing import List, Optional
 from database import db
-from auth import hash_password, require_admin
+from pagination import fetch_page, set_next_cursor, NEWEST_FIRST, MAX_PAGE_SIZE
+from auth import hash_password, require_admin, invalidate_user_sessions
 from models.user import User, UserCreate, UserUpdate, UserResponse
 from routes.auth import normalize_user_data
 
 router = APIRouter(prefix="/users", tags=["User Management"])
 
 @router.get("")
-async def get_users(current_user: dict = Depends(require_admin)):
-    """Get all users (Admin only)"""
-    users = await db.users.find({"tenant_id": current_user['tenant_id']}, {"_id": 0, "password": 0}).to_list(1000)
+async def get_users(
+    response: Response,
+    limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(require_admin)
+):
+    """Get users page by page, newest first (Admin only)"""
+    users, next_cursor = await fetch_page(
+        db.users, {"tenant_id": current_user['tenant_id']}, NEWEST_FIRST, limit, cursor,
+        projection={"_id": 0, "password": 0}
+    )
+    set_next_cursor(response, next_cursor)
     result = []
     for user in users:
-        if isinstance(user.get('created_at'), str):
-            user['created_at'] = datetime.fromisoformat(user['created_at'])
         if 'is_active' not in user:
             user['is_active'] = True
         # Normaliser les données
@@ -29,8 +36,6 @@ async def get_user(user_id: str, current_user: dict = Depends(require_admin)):
     user = await db.users.find_one({"id": user_id, "tenant_id": current_user['tenant_id']}, {"_id": 0, "password": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    if isinstance(user.get('created_at'), str):
-        user['created_at'] = datetime.fromisoformat(user['created_at'])
     if 'is_active' not in user:
         user['is_active'] = True
     # Normaliser les données
@@ -53,12 +58,11 @@ async def create_user_admin(user_data: UserCreate, current_user: dict = Depends(
         raise HTTPException(status_code=400, detail="Invalid role. Must be: admin, pharmacien, or caissier")
     
     user_dict = user_data.model_dump()
-    hashed_password = hash_password(user_dict.pop("password"))
+    hashed_password = await hash_password(user_dict.pop("password"))
     user_obj = User(**user_dict)
     
     doc = user_obj.model_dump()
     doc['password'] = hashed_password
-    doc['created_at'] = doc['created_at'].isoformat()
     doc['is_active'] = True
     
     await db.users.insert_one(doc)
@@ -104,10 +108,10 @@ async def update_user(user_id: str, user_update: UserUpdate, current_user: dict
     
     if update_data:
         await db.users.update_one({"id": user_id}, {"$set": update_data})
+        # Rôle / statut actif pris en compte dès la requête suivante
+        invalidate_user_sessions(user_id)
     
     updated_user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
-    if isinstance(updated_user.get('created_at'), str):
-        updated_user['created_at'] = datetime.fromisoformat(updated_user['created_at'])
     if 'is_active' not in updated_user:
         updated_user['is_active'] = True
     
@@ -124,6 +128,7 @@ async def delete_user(user_id: str, current_user: dict = Depends(require_admin))
     result = await db.users.delete_one({"id": user_id, "tenant_id": current_user['tenant_id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    invalidate_user_sessions(user_id)
     return {"message": "User deleted successfully"}
 
 @router.put("/{user_id}/password")
@@ -133,7 +138,8 @@ async def change_user_password(user_id: str, new_password: str, current_user: di
     if not existing:
         raise HTTPException(status_code=404, detail="User not found")
     
-    hashed_password = hash_password(new_password)
-    await db.users.update_one({"id": user_id}, {"$set": {"password": hashed_password}})
+    hashed_password = await hash_password(new_password)
+    await db.users.update_one({"id": user_id}, {"$set": {"password": hashed_password}, "$inc": {"token_version": 1}})
+    invalidate_user_sessions(user_id)
     
     return {"message": "Password updated successfully"}
@@ -4,10 +4,20 @@ A modular FastAPI application for pharmacy management.
 """
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
+import asyncio
 import logging
 
 from config import CORS_ORIGINS
-from database import close_db_connection
+from database import db, close_db_connection
+from indexes import ensure_indexes
+from pagination import NEXT_CURSOR_HEADER
+from dates import migrate_string_dates
+from change_log import seed_change_log, compact_change_log_periodically, recover_pending_changes
+from routes.sales import recover_pending_sales
+from routes.returns import recover_pending_returns
+from routes.supplies import recover_pending_supplies
+from routes.stock import rebuild_stale_stock_layers
+from routes.products import backfill_product_keys
 
 # Import all routers
 from routes.auth import router as auth_router
@@ -26,6 +36,7 @@ from routes.returns import router as returns_router
 from routes.units import router as units_router
 from routes.supplies import router as supplies_router
 from routes.prices import router as prices_router
+from routes.exports import router as exports_router
 
 # Configure logging
 logging.basicConfig(
@@ -48,6 +59,7 @@ app.add_middleware(
     allow_origins=CORS_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 # Include all routers with /api prefix
@@ -67,10 +79,66 @@ app.include_router(returns_router, prefix="/api")
 app.include_router(units_router, prefix="/api")
 app.include_router(supplies_router, prefix="/api")
 app.include_router(prices_router, prefix="/api")
+app.include_router(exports_router, prefix="/api")
+
+# Tâches de fond lancées au démarrage (référence conservée jusqu'à leur fin)
+background_tasks = set()
+
+# Intervalle de reprise des opérations interrompues (secondes)
+PENDING_RECOVERY_INTERVAL = 60
+# Reprises des opérations interrompues: (fonction, libellé du journal)
+PENDING_RECOVERIES = (
+    (recover_pending_sales, "réservation(s) de stock orpheline(s) résolue(s)"),
+    (recover_pending_returns, "réintégration(s) de retour orpheline(s) résolue(s)"),
+    (recover_pending_supplies, "validation(s) d'approvisionnement interrompue(s) résolue(s)"),
+    (rebuild_stale_stock_layers, "tenant(s) aux couches de valorisation reconstruites"),
+    (recover_pending_changes, "modification(s) interrompue(s) inscrite(s) au journal de synchronisation"),
+)
+
+
+async def recover_pending_operations():
+    """Reprendre périodiquement les réservations, réintégrations et validations orphelines,
+    reconstruire les couches de valorisation marquées périmées et inscrire au journal
+    les modifications dont l'inscription a été interrompue.
+    Une réservation récente peut appartenir à une requête encore en cours sur un
+    autre worker: elle n'est reprise qu'une fois plus ancienne que le délai de
+    grâce, au passage suivant, sans attendre un nouveau redémarrage.
+    """
+    while True:
+        for recover, label in PENDING_RECOVERIES:
+            try:
+                recovered = await recover()
+                if recovered:
+                    logger.warning(f"{recovered} {label}")
+            except Exception as e:
+                logger.error(f"Reprise {recover.__name__} en échec: {e!r}")
+        await asyncio.sleep(PENDING_RECOVERY_INTERVAL)
+
+
+def _log_task_failure(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Tâche de fond {task.get_name()} en échec: {task.exception()!r}")
+
+
+@app.on_event("startup")
+async def startup_event():
+    """Reconcile MongoDB indexes, resolve interrupted sales, migrate legacy dates and seed the sync change log"""
+    backfilled = await backfill_product_keys()
+    if backfilled:
+        logger.info(f"{backfilled} produit(s) mis à niveau (name_key, code-barres vide)")
+    await ensure_indexes(db)
+    logger.info("Database indexes reconciled")
+    for job in (recover_pending_operations, migrate_string_dates, seed_change_log, compact_change_log_periodically):
+        task = asyncio.create_task(job(), name=job.__name__)
+        background_tasks.add(task)
+        task.add_done_callback(_log_task_failure)
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Clean up resources on shutdown"""
+    for task in list(background_tasks):
+        task.cancel()
     await close_db_connection()
     logger.info("Database connection closed")
 
@@ -0,0 +1,54 @@
+"""
+Cache mémoire des paramètres par tenant (collection settings).
+
+Les paramètres sont lus à presque chaque requête (délai de retour, alerte de
+péremption, méthode de valorisation...) et ne changent que rarement. Chaque
+processus garde une copie par tenant:
+- une écriture via routes/settings.py incrémente le champ "version" du document
+  ($inc) et retire l'entrée du cache local (invalidate_tenant_settings),
+- une entrée lue depuis plus de VERSION_CHECK_INTERVAL secondes est revalidée
+  par la lecture de la seule version du tenant demandé (index unique sur
+  tenant_id): une écriture d'un autre worker est vue sous une seconde, sans
+  relire les versions de tous les tenants,
+- en dernier recours (modification directe en base), une entrée expire après
+  SETTINGS_TTL secondes.
+"""
+import time
+from typing import Dict, Optional, Tuple
+from database import db
+
+# Durée de vie maximale d'une entrée (secondes)
+SETTINGS_TTL = 300.0
+# Intervalle minimal entre deux revalidations de la version d'un tenant (secondes)
+VERSION_CHECK_INTERVAL = 1.0
+
+# tenant_id -> (document ou {}, version, instant de lecture, instant de la dernière revalidation)
+_cache: Dict[str, Tuple[dict, Optional[int], float, float]] = {}
+
+
+async def _version_unchanged(tenant_id: str, version: Optional[int]) -> bool:
+    """La version en base est-elle toujours celle de l'entrée (écriture d'un autre worker)?"""
+    current = await db.settings.find_one({"tenant_id": tenant_id}, {"_id": 0, "version": 1})
+    return (current.get('version', 0) if current else None) == version
+
+
+async def get_tenant_settings(tenant_id: str) -> dict:
+    """Paramètres du tenant (copie), {} si aucun document n'existe encore"""
+    now = time.monotonic()
+    entry = _cache.get(tenant_id)
+    if entry is not None and now - entry[2] < SETTINGS_TTL:
+        settings, version, loaded_at, checked_at = entry
+        if now - checked_at < VERSION_CHECK_INTERVAL:
+            return dict(settings)
+        if await _version_unchanged(tenant_id, version):
+            _cache[tenant_id] = (settings, version, loaded_at, time.monotonic())
+            return dict(settings)
+    settings = await db.settings.find_one({"tenant_id": tenant_id}, {"_id": 0}) or {}
+    now = time.monotonic()
+    _cache[tenant_id] = (settings, settings.get('version', 0) if settings else None, now, now)
+    return dict(settings)
+
+
+def invalidate_tenant_settings(tenant_id: str):
+    """Vider l'entrée locale après une écriture (qui doit aussi incrémenter "version")"""
+    _cache.pop(tenant_id, None)
@@ -0,0 +1,208 @@
+"""
+Compteurs matérialisés du tableau de bord (collection tenant_stats).
+
+Un document par tenant et par jour (UTC) porte les compteurs journaliers
+(ventes, chiffre d'affaires, retours, entrées/sorties de stock), et un document
+"total" par tenant porte les jauges globales (produits, stock bas, ordonnances
+en attente). Les routes les mettent à jour avec $inc à chaque écriture.
+
+Les $inc créent le document "total" s'il n'existe pas: seul le champ
+initialized_at, posé par rebuild_tenant_stats(), indique que les compteurs
+couvrent aussi l'historique antérieur.
+
+Un recalcul prend un verrou par tenant (collection tenant_stats_rebuilds). Chaque
+$inc arrivé pendant le verrou le marque "dirty" et le recalcul refait une passe:
+un $inc écrasé par le $set, ou compté deux fois (source déjà agrégée), est corrigé
+par la passe suivante. Le verrou est conservé REBUILD_SETTLE_SECONDS après
+l'écriture; seul un $inc arrivé plus tard encore pour une écriture déjà agrégée
+reste compté deux fois, jusqu'au recalcul suivant.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from database import db
+
+logger = logging.getLogger(__name__)
+
+
+# Document de compteurs globaux du tenant (les autres documents sont journaliers)
+TOTALS_DAY = "total"
+# Compteurs des documents journaliers
+DAILY_COUNTERS = ("sales_count", "revenue", "returns_count", "refund_total", "stock_entries", "stock_exits")
+
+# Verrou de recalcul (un document par tenant) et passes tentées tant que des $inc arrivent
+REBUILD_LOCK_TTL = timedelta(minutes=10)
+REBUILD_MAX_PASSES = 5
+# Délai de garde du verrou après l'écriture d'une passe (secondes)
+REBUILD_SETTLE_SECONDS = 2
+
+# Recalculs lancés en tâche de fond (référence conservée jusqu'à leur fin)
+rebuild_tasks = set()
+
+# Jour UTC d'un created_at (datetime BSON ou ancienne chaîne ISO)
+_DAY_EXPR = {"$dateToString": {"format": "%Y-%m-%d", "date": {"$toDate": "$created_at"}}}
+
+
+def stats_day(at=None) -> str:
+    """Clé journalière (UTC) des compteurs: YYYY-MM-DD"""
+    if isinstance(at, str):
+        return at[:10]
+    return (at or datetime.now(timezone.utc)).astimezone(timezone.utc).date().isoformat()
+
+
+def low_stock_delta(stock_before: int, stock_after: int, min_stock_before: int, min_stock_after: int = None) -> int:
+    """Variation du nombre de produits en stock bas (-1, 0 ou +1)"""
+    if min_stock_after is None:
+        min_stock_after = min_stock_before
+    return int(stock_after <= min_stock_after) - int(stock_before <= min_stock_before)
+
+
+async def increment_tenant_stats(tenant_id: str, daily: dict = None, totals: dict = None, at=None) -> None:
+    """Incrémenter les compteurs matérialisés du tableau de bord ($inc, upsert)"""
+    daily = {k: v for k, v in (daily or {}).items() if v}
+    totals = {k: v for k, v in (totals or {}).items() if v}
+    now = datetime.now(timezone.utc)
+    if daily:
+        await db.tenant_stats.update_one(
+            {"tenant_id": tenant_id, "day": stats_day(at)},
+            {"$inc": daily, "$set": {"updated_at": now}},
+            upsert=True
+        )
+    if totals:
+        await db.tenant_stats.update_one(
+            {"tenant_id": tenant_id, "day": TOTALS_DAY},
+            {"$inc": totals, "$set": {"updated_at": now}},
+            upsert=True
+        )
+    if daily or totals:
+        # Recalcul en cours: sa passe est refaite, après cet $inc
+        await db.tenant_stats_rebuilds.update_one(
+            {"_id": tenant_id, "expires_at": {"$gt": now}}, {"$set": {"dirty": True}}
+        )
+
+
+def stats_initialized(totals: dict) -> bool:
+    """Les compteurs globaux ont-ils été initialisés depuis l'historique?"""
+    return bool(totals and totals.get("initialized_at"))
+
+
+async def acquire_stats_rebuild(tenant_id: str) -> Optional[str]:
+    """Prendre le verrou de recalcul du tenant; None si un recalcul est déjà en cours"""
+    now = datetime.now(timezone.utc)
+    token = str(uuid.uuid4())
+    lock = {"token": token, "dirty": False, "expires_at": now + REBUILD_LOCK_TTL}
+    try:
+        await db.tenant_stats_rebuilds.insert_one({"_id": tenant_id, **lock})
+        return token
+    except DuplicateKeyError:
+        pass
+    # Verrou expiré (processus interrompu): repris
+    result = await db.tenant_stats_rebuilds.update_one({"_id": tenant_id, "expires_at": {"$lte": now}}, {"$set": lock})
+    return token if result.matched_count else None
+
+
+async def rebuild_tenant_stats(tenant_id: str, token: str = None) -> Optional[dict]:
+    """Recalculer tous les compteurs d'un tenant depuis les collections sources.
+    Sous le verrou du tenant (token déjà acquis, ou pris ici): retourne None si un
+    autre recalcul est en cours. Les passes sont refaites tant que des $inc arrivent
+    pendant la passe ou le délai de garde qui la suit.
+    """
+    token = token or await acquire_stats_rebuild(tenant_id)
+    if token is None:
+        return None
+    try:
+        for _ in range(REBUILD_MAX_PASSES):
+            await db.tenant_stats_rebuilds.update_one(
+                {"_id": tenant_id, "token": token},
+                {"$set": {"dirty": False, "expires_at": datetime.now(timezone.utc) + REBUILD_LOCK_TTL}}
+            )
+            totals = await _rebuild_pass(tenant_id)
+            await asyncio.sleep(REBUILD_SETTLE_SECONDS)
+            released = await db.tenant_stats_rebuilds.delete_one({"_id": tenant_id, "token": token, "dirty": False})
+            if released.deleted_count:
+                return totals
+        logger.warning(f"Compteurs du tenant {tenant_id}: écritures trop fréquentes pendant le recalcul")
+        return totals
+    finally:
+        await db.tenant_stats_rebuilds.delete_one({"_id": tenant_id, "token": token})
+
+
+async def start_tenant_stats_rebuild(tenant_id: str) -> bool:
+    """Lancer le recalcul en tâche de fond s'il n'est pas déjà en cours (hors du chemin des requêtes)"""
+    token = await acquire_stats_rebuild(tenant_id)
+    if token is None:
+        return False
+    task = asyncio.create_task(_run_stats_rebuild(tenant_id, token), name=f"tenant-stats-{tenant_id}")
+    rebuild_tasks.add(task)
+    task.add_done_callback(rebuild_tasks.discard)
+    return True
+
+
+async def _run_stats_rebuild(tenant_id: str, token: str) -> None:
+    try:
+        await rebuild_tenant_stats(tenant_id, token)
+    except Exception as e:
+        logger.error(f"Recalcul des compteurs du tenant {tenant_id} en échec: {e!r}")
+
+
+async def _rebuild_pass(tenant_id: str) -> dict:
+    """Une passe de recalcul: agrégation des sources puis $set upsert de chaque document"""
+    now = datetime.now(timezone.utc)
+    days = {}
+    
+    async for row in db.sales.aggregate([
+        {"$match": {"tenant_id": tenant_id}},
+        {"$group": {"_id": _DAY_EXPR, "sales_count": {"$sum": 1}, "revenue": {"$sum": "$total"}}}
+    ]):
+        days.setdefault(row["_id"], {}).update(sales_count=row["sales_count"], revenue=row["revenue"])
+    
+    async for row in db.returns.aggregate([
+        {"$match": {"tenant_id": tenant_id}},
+        {"$group": {"_id": _DAY_EXPR, "returns_count": {"$sum": 1}, "refund_total": {"$sum": "$total_refund"}}}
+    ]):
+        days.setdefault(row["_id"], {}).update(returns_count=row["returns_count"], refund_total=row["refund_total"])
+    
+    async for row in db.stock_movements.aggregate([
+        {"$match": {"tenant_id": tenant_id}},
+        {"$group": {
+            "_id": _DAY_EXPR,
+            "stock_entries": {"$sum": {"$cond": [{"$gt": ["$movement_quantity", 0]}, "$movement_quantity", 0]}},
+            "stock_exits": {"$sum": {"$cond": [{"$lt": ["$movement_quantity", 0]}, {"$abs": "$movement_quantity"}, 0]}},
+        }}
+    ]):
+        days.setdefault(row["_id"], {}).update(stock_entries=row["stock_entries"], stock_exits=row["stock_exits"])
+    
+    products_count = await db.products.count_documents({"tenant_id": tenant_id})
+    low_stock_count = await db.products.count_documents({
+        "tenant_id": tenant_id,
+        "$expr": {"$lte": ["$stock", {"$ifNull": ["$min_stock", 10]}]}
+    })
+    pending_prescriptions = await db.prescriptions.count_documents({"tenant_id": tenant_id, "status": "pending"})
+    totals = {
+        "products_count": products_count,
+        "low_stock_count": low_stock_count,
+        "pending_prescriptions": pending_prescriptions,
+    }
+    
+    operations = [
+        UpdateOne(
+            {"tenant_id": tenant_id, "day": day},
+            {"$set": {**{c: counters.get(c, 0) for c in DAILY_COUNTERS}, "updated_at": now}},
+            upsert=True
+        )
+        for day, counters in days.items()
+    ]
+    operations.append(UpdateOne(
+        {"tenant_id": tenant_id, "day": TOTALS_DAY},
+        {"$set": {**totals, "initialized_at": now, "updated_at": now}},
+        upsert=True
+    ))
+    for i in range(0, len(operations), 1000):
+        await db.tenant_stats.bulk_write(operations[i:i + 1000], ordered=False)
+    # Jours sans plus aucune activité dans les sources
+    await db.tenant_stats.delete_many({"tenant_id": tenant_id, "day": {"$nin": [*days, TOTALS_DAY]}})
+    return totals
@@ -0,0 +1,12 @@
+"""
+pytest configuration for the unit tests of the backend's pure helpers.
+The API test scripts (*Tester classes) are run directly with python.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# database creates its Motor client at import time without connecting
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "pharmaflow_test")
@@ -0,0 +1,189 @@
+"""
+Unit tests for the change log helpers: gap detection (change_log._stale_gaps, _contiguous),
+the compaction rule (_obsolete_entries) and the intents that make an entry survive a crash
+between a mutation and its recording (tracked_changes, recover_pending_changes)
+Run with: python -m pytest tests/test_change_log.py
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+import pytest
+from fastapi import HTTPException
+import change_log
+from change_log import (
+    _contiguous, _obsolete_entries, _stale_gaps, recover_pending_changes, tracked_changes,
+    DELETE, SKIP, UPSERT,
+)
+
+
+def entries(*seqs, age=timedelta(0)):
+    at = datetime.now(timezone.utc) - age
+    return [{"seq": seq, "at": at} for seq in seqs]
+
+
+OLD = change_log.GAP_GRACE * 2
+
+
+def test_contiguous_stops_at_first_gap():
+    assert [e["seq"] for e in _contiguous(entries(4, 5, 7, 8), 3)] == [4, 5]
+
+
+def test_contiguous_gap_right_after_checkpoint_returns_nothing():
+    assert _contiguous(entries(5, 6), 3) == []
+
+
+def test_contiguous_crosses_gaps_in_compacted_range():
+    assert [e["seq"] for e in _contiguous(entries(2, 5, 9, 11), 0, compacted_through=9)] == [2, 5, 9]
+
+
+def test_recent_gap_is_not_fenced():
+    assert _stale_gaps(entries(1, 4), 0, 0) == []
+
+
+def test_old_gap_is_fenced():
+    assert _stale_gaps(entries(1, 4, 5, 8, age=OLD), 0, 0) == [2, 3, 6, 7]
+
+
+def test_gap_before_first_entry_is_fenced():
+    assert _stale_gaps(entries(3, age=OLD), 0, 0) == [1, 2]
+
+
+def test_fencing_stops_at_first_recent_gap():
+    found = entries(1, 3, age=OLD) + entries(6)
+    found += entries(9, age=OLD)
+    assert _stale_gaps(found, 0, 0) == [2]
+
+
+def test_compacted_range_is_never_fenced():
+    assert _stale_gaps(entries(3, 7, 9, age=OLD), 0, compacted_through=7) == [8]
+
+
+def test_compaction_keeps_last_upsert():
+    assert _obsolete_entries([2, 5, 9], UPSERT) == ([2, 5], 0)
+
+
+def test_compaction_keeps_single_upsert():
+    assert _obsolete_entries([4], UPSERT) == ([], 0)
+
+
+def test_compaction_drops_deleted_document_and_sets_reset_threshold():
+    assert _obsolete_entries([2, 5, 9], DELETE) == ([2, 5, 9], 10)
+
+
+def test_compaction_drops_skip_without_reset():
+    assert _obsolete_entries([7], SKIP) == ([7], 0)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+class FakeCollection:
+    """Just enough of a Motor collection for change_log"""
+
+    def __init__(self):
+        self.docs = []
+
+    async def insert_one(self, doc):
+        self.docs.append(dict(doc))
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs.extend(dict(doc) for doc in docs)
+
+    async def delete_one(self, query):
+        self.docs = [doc for doc in self.docs if doc["_id"] != query["_id"]]
+
+    async def distinct(self, field, query):
+        return [doc[field] for doc in self.docs if doc["tenant_id"] == query["tenant_id"] and doc[field] in query["id"]["$in"]]
+
+    def find(self, query):
+        return FakeCursor([doc for doc in self.docs if doc["at"] < query["at"]["$lt"]])
+
+    async def find_one_and_update(self, query, update, upsert, return_document):
+        counter = next((doc for doc in self.docs if doc["_id"] == query["_id"]), None)
+        if counter is None:
+            counter = {"_id": query["_id"], "seq": 0}
+            self.docs.append(counter)
+        counter["seq"] += update["$inc"]["seq"]
+        return dict(counter)
+
+
+class FakeDb:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDb()
+    monkeypatch.setattr(change_log, "db", db)
+    return db
+
+
+def logged(db):
+    return [(e["collection"], e["doc_id"], e["op"]) for e in sorted(db.change_log.docs, key=lambda e: e["seq"])]
+
+
+def test_intent_is_written_before_the_mutation_and_cleared_after(db):
+    async def run():
+        async with tracked_changes("t-1", {"products": ["p-1", "p-2"]}):
+            assert db.change_intents.docs[0]["changes"] == {"products": ["p-1", "p-2"]}
+            assert db.change_log.docs == []
+    asyncio.run(run())
+    assert logged(db) == [("products", "p-1", UPSERT), ("products", "p-2", UPSERT)]
+    assert db.change_intents.docs == []
+
+
+def test_block_can_narrow_recorded_documents(db):
+    async def run():
+        async with tracked_changes("t-1", {"customers": ["c-1", "c-2"]}, op=DELETE) as changes:
+            changes["customers"] = ["c-2"]
+    asyncio.run(run())
+    assert logged(db) == [("customers", "c-2", DELETE)]
+
+
+def test_refusal_clears_intent_without_recording(db):
+    async def run():
+        async with tracked_changes("t-1", {"products": ["p-1"]}):
+            raise HTTPException(status_code=400, detail="Stock insuffisant")
+    with pytest.raises(HTTPException):
+        asyncio.run(run())
+    assert db.change_intents.docs == []
+    assert db.change_log.docs == []
+
+
+def test_interrupted_mutation_leaves_intent_for_recovery(db):
+    async def run():
+        async with tracked_changes("t-1", {"products": ["p-1"]}):
+            raise RuntimeError("connexion perdue")
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+    assert len(db.change_intents.docs) == 1
+    assert db.change_log.docs == []
+
+
+def test_recovery_records_existing_as_upsert_and_missing_as_delete(db):
+    db.products.docs = [{"id": "p-1", "tenant_id": "t-1"}]
+    db.change_intents.docs = [
+        {"_id": "i-1", "tenant_id": "t-1", "changes": {"products": ["p-1", "p-2"]},
+         "at": datetime.now(timezone.utc) - timedelta(minutes=10)},
+        {"_id": "i-2", "tenant_id": "t-1", "changes": {"products": ["p-3"]},
+         "at": datetime.now(timezone.utc)},
+    ]
+    assert asyncio.run(recover_pending_changes()) == 1
+    assert logged(db) == [("products", "p-1", UPSERT), ("products", "p-2", DELETE)]
+    # A recent intent may belong to a request still running
+    assert [intent["_id"] for intent in db.change_intents.docs] == ["i-2"]
@@ -0,0 +1,99 @@
+"""
+Unit tests for the hybrid logical clock used to resolve sync conflicts (hlc)
+Run with: python -m pytest tests/test_hlc.py
+"""
+import pytest
+import hlc
+from hlc import HybridLogicalClock, MAX_CLOCK_DRIFT_MS, encode, field_version_updates, parse
+
+
+@pytest.fixture
+def wall(monkeypatch):
+    """Frozen wall clock (ms), moved by the tests"""
+    clock = {"ms": 1_718_000_000_000}
+    monkeypatch.setattr(hlc.time, "time", lambda: clock["ms"] / 1000)
+    return clock
+
+
+def test_encode_parse_round_trip():
+    assert parse(encode(1_718_000_000_000, 3, "till-2")) == (1_718_000_000_000, 3, "till-2")
+
+
+def test_node_may_contain_colons():
+    assert parse(encode(5, 0, "till:a"))[2] == "till:a"
+
+
+@pytest.mark.parametrize("timestamp", [
+    None, 42, "", "1718000000000:000000:till",
+    "000001718000000000:0:till", "000001718000000000:000000:",
+    "00000171800000000x:000000:till", "000001718000000000-000000-till",
+])
+def test_parse_rejects_malformed_timestamps(timestamp):
+    assert parse(timestamp) is None
+
+
+def test_string_order_is_causal_order():
+    stamps = [encode(9, 0, "a"), encode(10, 0, "a"), encode(10, 1, "a"), encode(10, 12, "a"), encode(100, 0, "a")]
+    assert sorted(stamps) == stamps
+
+
+def test_now_is_strictly_increasing_within_a_millisecond(wall):
+    clock = HybridLogicalClock("server-1")
+    stamps = [clock.now() for _ in range(3)]
+    assert [parse(s)[:2] for s in stamps] == [(wall["ms"], 0), (wall["ms"], 1), (wall["ms"], 2)]
+
+
+def test_now_resets_counter_when_wall_clock_advances(wall):
+    clock = HybridLogicalClock("server-1")
+    clock.now()
+    clock.now()
+    wall["ms"] += 1
+    assert parse(clock.now())[:2] == (wall["ms"], 0)
+
+
+def test_now_never_goes_back_with_the_wall_clock(wall):
+    clock = HybridLogicalClock("server-1")
+    first = clock.now()
+    wall["ms"] -= 5000
+    assert clock.now() > first
+
+
+def test_observe_moves_past_a_remote_timestamp_ahead(wall):
+    clock = HybridLogicalClock("server-1")
+    remote = encode(wall["ms"] + 1000, 4, "till-1")
+    observed = clock.observe(remote)
+    assert observed > remote
+    assert parse(observed)[:2] == (wall["ms"] + 1000, 5)
+    assert clock.now() > observed
+
+
+def test_observe_an_older_timestamp_keeps_local_time(wall):
+    clock = HybridLogicalClock("server-1")
+    local = clock.now()
+    observed = clock.observe(encode(wall["ms"] - 1000, 7, "till-1"))
+    assert observed > local
+    assert parse(observed)[:2] == (wall["ms"], 1)
+
+
+def test_observe_same_millisecond_takes_the_highest_counter(wall):
+    clock = HybridLogicalClock("server-1")
+    clock.now()
+    assert parse(clock.observe(encode(wall["ms"], 9, "till-1")))[:2] == (wall["ms"], 10)
+
+
+def test_observe_rejects_invalid_timestamp(wall):
+    with pytest.raises(ValueError):
+        HybridLogicalClock("server-1").observe("not-a-timestamp")
+
+
+def test_observe_rejects_clock_too_far_ahead(wall):
+    clock = HybridLogicalClock("server-1")
+    with pytest.raises(ValueError):
+        clock.observe(encode(wall["ms"] + MAX_CLOCK_DRIFT_MS + 1, 0, "till-1"))
+    # The refused timestamp does not move the clock
+    assert parse(clock.now())[0] == wall["ms"]
+
+
+def test_field_version_updates():
+    assert field_version_updates(["price", "name"], "s") == {"field_versions.price": "s", "field_versions.name": "s"}
+    assert field_version_updates([], "s") == {}
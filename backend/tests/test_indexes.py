@@ -0,0 +1,61 @@
+"""
+Unit tests for index drift detection (indexes._spec_differs)
+Run with: python -m pytest tests/test_indexes.py
+"""
+from pymongo import ASCENDING, DESCENDING
+from indexes import INDEXES, _index, _spec_differs
+
+
+def existing(keys, **options):
+    """Index as returned by collection.index_information()"""
+    return {"v": 2, "key": keys, **options}
+
+
+def test_same_keys_and_options_do_not_differ():
+    declared = _index("tenant_created_at", [("tenant_id", ASCENDING), ("created_at", DESCENDING)])
+    assert not _spec_differs(declared, existing([("tenant_id", 1), ("created_at", -1)]))
+
+
+def test_float_directions_are_normalized():
+    # Indexes created by other tools may report 1.0 / -1.0 directions
+    declared = _index("tenant_created_at", [("tenant_id", ASCENDING), ("created_at", DESCENDING)])
+    assert not _spec_differs(declared, existing([("tenant_id", 1.0), ("created_at", -1.0)]))
+
+
+def test_key_order_and_direction_differ():
+    declared = _index("tenant_name", [("tenant_id", ASCENDING), ("name", ASCENDING)])
+    assert _spec_differs(declared, existing([("name", 1), ("tenant_id", 1)]))
+    assert _spec_differs(declared, existing([("tenant_id", 1), ("name", -1)]))
+    assert _spec_differs(declared, existing([("tenant_id", 1)]))
+
+
+def test_missing_unique_or_sparse_equals_false():
+    declared = _index("email", [("email", ASCENDING)])
+    assert not _spec_differs(declared, existing([("email", 1)], unique=False))
+    assert not _spec_differs(_index("email", [("email", ASCENDING)], sparse=False), existing([("email", 1)]))
+
+
+def test_unique_added_or_removed_differs():
+    assert _spec_differs(_index("email", [("email", ASCENDING)], unique=True), existing([("email", 1)]))
+    assert _spec_differs(_index("email", [("email", ASCENDING)]), existing([("email", 1)], unique=True))
+
+
+def test_partial_filter_change_differs():
+    declared = _index("tenant_barcode", [("tenant_id", ASCENDING), ("barcode", ASCENDING)],
+                      unique=True, partialFilterExpression={"barcode": {"$type": "string"}})
+    keys = [("tenant_id", 1), ("barcode", 1)]
+    assert not _spec_differs(declared, existing(keys, unique=True, partialFilterExpression={"barcode": {"$type": "string"}}))
+    assert _spec_differs(declared, existing(keys, unique=True))
+    assert _spec_differs(declared, existing(keys, unique=True, partialFilterExpression={"barcode": {"$exists": True}}))
+
+
+def test_ignored_options_do_not_differ():
+    # background, ns... are not compared
+    declared = _index("tenant_id_id", [("tenant_id", ASCENDING), ("id", ASCENDING)])
+    assert not _spec_differs(declared, existing([("tenant_id", 1), ("id", 1)], background=True, ns="db.products"))
+
+
+def test_declared_index_names_are_unique_per_collection():
+    for collection_name, declared_indexes in INDEXES.items():
+        names = [declared["name"] for declared in declared_indexes]
+        assert len(names) == len(set(names)), collection_name
@@ -0,0 +1,118 @@
+"""
+Unit tests for keyset pagination (pagination.keyset_filter, cursors)
+and the product priority sort keys
+Run with: python -m pytest tests/test_pagination.py
+"""
+from datetime import datetime, timezone, timedelta
+import pytest
+from fastapi import HTTPException
+import dates
+from pagination import (
+    keyset_filter, encode_cursor, decode_cursor, cursor_values, sort_spec, after_cursor, NEWEST_FIRST, BY_NAME
+)
+from routes.products import product_priority_pipeline, PRIORITY_SORT
+
+
+def matches(doc, query):
+    """Evaluate the subset of MongoDB query operators produced by keyset_filter"""
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+        elif field == "$and":
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = doc.get(field)
+            for operator, bound in condition.items():
+                if operator == "$gt" and not (type(value) is type(bound) and value > bound):
+                    return False
+                if operator == "$lt" and not (type(value) is type(bound) and value < bound):
+                    return False
+                if operator == "$type" and not (bound == "string" and isinstance(value, str)):
+                    return False
+        elif doc.get(field) != condition:
+            return False
+    return True
+
+
+def walk(docs, sort, limit):
+    """Page through docs in memory the way fetch_page does"""
+    fields = list(sort_spec(sort).items())
+    ordered = list(docs)
+    for field, direction in reversed(fields):
+        ordered.sort(key=lambda d: d[field], reverse=direction < 0)
+    seen, cursor = [], None
+    while True:
+        query = after_cursor({}, sort, cursor)
+        page = [d for d in ordered if matches(d, query)][:limit + 1]
+        seen.extend(d["id"] for d in page[:limit])
+        if len(page) <= limit:
+            return seen, [d["id"] for d in ordered]
+        cursor = encode_cursor(cursor_values(page[limit - 1], sort))
+
+
+@pytest.fixture
+def migrated_dates(monkeypatch):
+    monkeypatch.setattr(dates, "legacy_string_dates", False)
+
+
+def test_id_is_appended_as_tie_breaker():
+    assert sort_spec(BY_NAME) == {"name": 1, "id": 1}
+    assert sort_spec(NEWEST_FIRST) == {"created_at": -1, "id": -1}
+    assert sort_spec([("name", 1), ("id", 1)]) == {"name": 1, "id": 1}
+
+
+def test_keyset_filter_clauses(migrated_dates):
+    assert keyset_filter(BY_NAME, ["Doliprane", "p-2"]) == {"$or": [
+        {"name": {"$gt": "Doliprane"}},
+        {"name": "Doliprane", "id": {"$gt": "p-2"}},
+    ]}
+    at = datetime(2025, 1, 2, tzinfo=timezone.utc)
+    assert keyset_filter(NEWEST_FIRST, [at, "s-9"]) == {"$or": [
+        {"created_at": {"$lt": at}},
+        {"created_at": at, "id": {"$lt": "s-9"}},
+    ]}
+
+
+def test_legacy_string_dates_stay_reachable(monkeypatch):
+    monkeypatch.setattr(dates, "legacy_string_dates", True)
+    at = datetime(2025, 1, 2, tzinfo=timezone.utc)
+    clauses = keyset_filter(NEWEST_FIRST, [at, "s-9"])["$or"]
+    assert {"created_at": {"$type": "string"}} in clauses
+
+
+def test_pages_cover_every_document_once_with_ties(migrated_dates):
+    # Many equal names: the id tie-breaker must still split pages exactly
+    docs = [{"id": f"p-{i:03d}", "name": ["Amoxicilline", "Doliprane", "Zinc"][i % 3]} for i in range(50)]
+    for limit in (1, 2, 7, 50):
+        seen, expected = walk(docs, BY_NAME, limit)
+        assert seen == expected
+
+
+def test_pages_newest_first(migrated_dates):
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    docs = [{"id": f"s-{i:03d}", "created_at": start + timedelta(hours=i // 4)} for i in range(40)]
+    seen, expected = walk(docs, NEWEST_FIRST, 6)
+    assert seen == expected
+    assert len(set(seen)) == 40
+
+
+def test_cursor_round_trip_keeps_datetimes():
+    at = datetime(2025, 3, 4, 5, 6, 7, tzinfo=timezone.utc)
+    values = [0, at, "doliprane", "p-1"]
+    assert decode_cursor(encode_cursor(values), 4) == values
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", encode_cursor(["a"]), encode_cursor({"a": 1})])
+def test_invalid_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor, 2)
+    assert error.value.status_code == 400
+
+
+def test_priority_keys_do_not_depend_on_request_time():
+    # A cursor built on one page must mean the same thing on the next request
+    cursor = encode_cursor([0, datetime(2025, 6, 1, tzinfo=timezone.utc), "doliprane", "p-1"])
+    assert product_priority_pipeline("t-1", 10, cursor) == product_priority_pipeline("t-1", 10, cursor)
+    assert [field for field, _ in PRIORITY_SORT] == ["_needs_restock", "_expiration", "_name_lower"]
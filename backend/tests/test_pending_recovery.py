@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Test Pending Operations Recovery
+Tests the recovery of interrupted compensated writes (mongod without transactions):
+orphaned sale reservations, interrupted returns and supply validations.
+Runs against the database configured in backend/.env (MONGO_URL, DB_NAME),
+on a dedicated tenant that is removed at the end.
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+from datetime import datetime, timezone, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db, close_db_connection
+from routes.sales import recover_pending_sales
+from routes.returns import recover_pending_returns
+from routes.supplies import recover_pending_supplies
+
+
+class PendingRecoveryTester:
+    def __init__(self):
+        self.tenant_id = f"test-recovery-{uuid.uuid4().hex[:8]}"
+        self.tests_run = 0
+        self.tests_passed = 0
+        # Markers older than the recovery grace period
+        self.old = datetime.now(timezone.utc) - timedelta(minutes=10)
+
+    def check(self, name, condition, detail=""):
+        """Record a single assertion"""
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        if condition:
+            self.tests_passed += 1
+            print("✅ Passed")
+            return True
+        print(f"❌ Failed {detail}")
+        return False
+
+    async def create_product(self, stock, **markers):
+        product_id = str(uuid.uuid4())
+        await db.products.insert_one({
+            "id": product_id,
+            "name": f"Test Recovery {product_id[:8]}",
+            "name_key": f"test recovery {product_id[:8]}",
+            "price": 10.0,
+            "stock": stock,
+            "min_stock": 1,
+            "tenant_id": self.tenant_id,
+            **markers,
+        })
+        return product_id
+
+    async def get_product(self, product_id):
+        return await db.products.find_one({"id": product_id, "tenant_id": self.tenant_id}, {"_id": 0})
+
+    async def test_orphaned_sale_reservation(self):
+        """Test 1: A reservation without sale gives its stock back"""
+        print("\n=== TEST 1: ORPHANED SALE RESERVATION ===")
+        sale_id = str(uuid.uuid4())
+        # Stock already decremented by 3 by the reservation, sale never inserted
+        product_id = await self.create_product(7, pending_sales={
+            sale_id: {"quantity": 3, "reserved_at": self.old, "stock_before": 10}
+        })
+        await recover_pending_sales(max_age_minutes=5)
+        product = await self.get_product(product_id)
+        return self.check(
+            "Stock restored and marker removed",
+            product['stock'] == 10 and sale_id not in (product.get('pending_sales') or {}),
+            f"stock={product['stock']} markers={product.get('pending_sales')}"
+        )
+
+    async def test_committed_sale_reservation(self):
+        """Test 2: A reservation whose sale exists only loses its marker"""
+        print("\n=== TEST 2: COMMITTED SALE RESERVATION ===")
+        sale_id = str(uuid.uuid4())
+        product_id = await self.create_product(7, pending_sales={
+            sale_id: {"quantity": 3, "reserved_at": self.old, "stock_before": 10}
+        })
+        await db.sales.insert_one({"id": sale_id, "tenant_id": self.tenant_id, "items": [], "total": 30.0})
+        await recover_pending_sales(max_age_minutes=5)
+        product = await self.get_product(product_id)
+        return self.check(
+            "Stock kept and marker removed",
+            product['stock'] == 7 and sale_id not in (product.get('pending_sales') or {}),
+            f"stock={product['stock']} markers={product.get('pending_sales')}"
+        )
+
+    async def test_recent_reservation_untouched(self):
+        """Test 3: A reservation younger than the grace period belongs to a running sale"""
+        print("\n=== TEST 3: RECENT RESERVATION ===")
+        sale_id = str(uuid.uuid4())
+        product_id = await self.create_product(7, pending_sales={
+            sale_id: {"quantity": 3, "reserved_at": datetime.now(timezone.utc), "stock_before": 10}
+        })
+        await recover_pending_sales(max_age_minutes=5)
+        product = await self.get_product(product_id)
+        return self.check(
+            "Recent reservation left as is",
+            product['stock'] == 7 and sale_id in (product.get('pending_sales') or {}),
+            f"stock={product['stock']} markers={product.get('pending_sales')}"
+        )
+
+    async def create_returned_sale(self, product_id, returned, return_id=None):
+        """Sale of 5 units whose ledger already reserves `returned` units, with its return marker"""
+        sale_id = str(uuid.uuid4())
+        sale = {
+            "id": sale_id, "tenant_id": self.tenant_id, "total": 50.0,
+            "items": [{"product_id": product_id, "name": "Test Recovery", "price": 10.0, "quantity": 5}],
+            "returned_quantities": {product_id: returned},
+        }
+        if return_id:
+            sale["pending_returns"] = {return_id: {"quantities": {product_id: returned}, "reserved_at": self.old}}
+        await db.sales.insert_one(sale)
+        return sale_id
+
+    async def insert_return_movement(self, product_id, return_id, quantity):
+        await db.stock_movements.insert_one({
+            "id": str(uuid.uuid4()), "tenant_id": self.tenant_id, "product_id": product_id,
+            "movement_type": "return", "reference_type": "return", "reference_id": return_id,
+            "movement_quantity": quantity,
+        })
+
+    async def return_state(self, sale_id, product_id, return_id):
+        sale = await db.sales.find_one({"id": sale_id}, {"_id": 0})
+        product = await self.get_product(product_id)
+        movements = await db.stock_movements.count_documents({"reference_id": return_id, "tenant_id": self.tenant_id})
+        return sale, product, movements
+
+    async def test_return_never_restocked(self):
+        """Test 4: A return interrupted after its ledger reservation is cancelled"""
+        print("\n=== TEST 4: RETURN INTERRUPTED BEFORE RESTOCK ===")
+        return_id = str(uuid.uuid4())
+        product_id = await self.create_product(10)
+        # Ledger reserved and RETURN movement written, stock never restocked, no return document
+        sale_id = await self.create_returned_sale(product_id, 2, return_id)
+        await self.insert_return_movement(product_id, return_id, 2)
+        await recover_pending_returns(max_age_minutes=5)
+        sale, product, movements = await self.return_state(sale_id, product_id, return_id)
+        return all([
+            self.check("Ledger released", sale['returned_quantities'][product_id] == 0, f"{sale['returned_quantities']}"),
+            self.check("Sale marker removed", return_id not in (sale.get('pending_returns') or {}), f"{sale.get('pending_returns')}"),
+            self.check("Orphan movements removed", movements == 0, f"movements={movements}"),
+            self.check("Stock untouched", product['stock'] == 10, f"stock={product['stock']}"),
+        ])
+
+    async def test_return_restocked_not_committed(self):
+        """Test 5: A restocked return without return document is fully cancelled"""
+        print("\n=== TEST 5: RETURN RESTOCKED BUT NOT COMMITTED ===")
+        return_id = str(uuid.uuid4())
+        product_id = await self.create_product(12)
+        sale_id = await self.create_returned_sale(product_id, 2, return_id)
+        await db.products.update_one({"id": product_id}, {"$set": {f"pending_returns.{return_id}": {
+            "quantity": 2, "sale_id": sale_id, "reserved_at": self.old
+        }}})
+        await self.insert_return_movement(product_id, return_id, 2)
+        await recover_pending_returns(max_age_minutes=5)
+        sale, product, movements = await self.return_state(sale_id, product_id, return_id)
+        return all([
+            self.check("Stock removed and marker cleared", product['stock'] == 10 and not product.get('pending_returns'),
+                       f"stock={product['stock']} markers={product.get('pending_returns')}"),
+            self.check("Ledger released once", sale['returned_quantities'][product_id] == 0, f"{sale['returned_quantities']}"),
+            self.check("Sale marker removed", not sale.get('pending_returns'), f"{sale.get('pending_returns')}"),
+            self.check("Movements removed", movements == 0, f"movements={movements}"),
+        ])
+
+    async def test_committed_return(self):
+        """Test 6: A committed return only loses its markers"""
+        print("\n=== TEST 6: COMMITTED RETURN ===")
+        return_id = str(uuid.uuid4())
+        product_id = await self.create_product(12)
+        sale_id = await self.create_returned_sale(product_id, 2, return_id)
+        await db.products.update_one({"id": product_id}, {"$set": {f"pending_returns.{return_id}": {
+            "quantity": 2, "sale_id": sale_id, "reserved_at": self.old
+        }}})
+        await self.insert_return_movement(product_id, return_id, 2)
+        await db.returns.insert_one({"id": return_id, "tenant_id": self.tenant_id, "sale_id": sale_id, "items": []})
+        await recover_pending_returns(max_age_minutes=5)
+        sale, product, movements = await self.return_state(sale_id, product_id, return_id)
+        return all([
+            self.check("Stock kept and marker removed", product['stock'] == 12 and not product.get('pending_returns'),
+                       f"stock={product['stock']} markers={product.get('pending_returns')}"),
+            self.check("Ledger kept", sale['returned_quantities'][product_id] == 2, f"{sale['returned_quantities']}"),
+            self.check("Sale marker removed", not sale.get('pending_returns'), f"{sale.get('pending_returns')}"),
+            self.check("Movements kept", movements == 1, f"movements={movements}"),
+        ])
+
+    async def test_interrupted_supply_validation(self):
+        """Test 7: A provisional validation is rolled back with its stock"""
+        print("\n=== TEST 7: INTERRUPTED SUPPLY VALIDATION ===")
+        supply_id = str(uuid.uuid4())
+        marker = {supply_id: 4}
+        # Stock already increased by 4, validation never confirmed
+        product_id = await self.create_product(14, pending_supplies=marker)
+        await db.supplies.insert_one({
+            "id": supply_id, "tenant_id": self.tenant_id, "items": [{"product_id": product_id, "quantity": 4}],
+            "is_validated": True, "validation_pending": True, "validated_at": self.old, "validated_by": "TEST",
+        })
+        await db.stock_movements.insert_one({
+            "id": str(uuid.uuid4()), "tenant_id": self.tenant_id, "product_id": product_id,
+            "reference_type": "supply", "reference_id": supply_id, "movement_quantity": 4,
+        })
+        await recover_pending_supplies(max_age_minutes=5)
+        product = await self.get_product(product_id)
+        supply = await db.supplies.find_one({"id": supply_id}, {"_id": 0})
+        movements = await db.stock_movements.count_documents({"reference_id": supply_id, "tenant_id": self.tenant_id})
+        return all([
+            self.check("Supply back to pending", not supply['is_validated'] and 'validation_pending' not in supply, f"{supply}"),
+            self.check("Stock removed and marker cleared", product['stock'] == 10 and not product.get('pending_supplies'),
+                       f"stock={product['stock']} markers={product.get('pending_supplies')}"),
+            self.check("Supply movements removed", movements == 0, f"movements={movements}"),
+        ])
+
+    async def test_confirmed_supply_markers(self):
+        """Test 8: Markers of a confirmed validation are only cleared"""
+        print("\n=== TEST 8: CONFIRMED SUPPLY MARKERS ===")
+        supply_id = str(uuid.uuid4())
+        product_id = await self.create_product(14, pending_supplies={supply_id: 4})
+        await db.supplies.insert_one({
+            "id": supply_id, "tenant_id": self.tenant_id, "items": [],
+            "is_validated": True, "validated_at": self.old, "validated_by": "TEST",
+        })
+        await recover_pending_supplies(max_age_minutes=5)
+        product = await self.get_product(product_id)
+        return self.check(
+            "Stock kept and marker removed",
+            product['stock'] == 14 and not product.get('pending_supplies'),
+            f"stock={product['stock']} markers={product.get('pending_supplies')}"
+        )
+
+    async def cleanup(self):
+        """Remove the test tenant data"""
+        print("\n=== CLEANUP ===")
+        for collection in ("products", "sales", "returns", "supplies", "stock_movements", "price_history", "change_log"):
+            await db[collection].delete_many({"tenant_id": self.tenant_id})
+
+    async def run_all_tests(self):
+        """Run all pending operations recovery tests"""
+        print("🚀 Starting Pending Operations Recovery Tests")
+        print("🏥 DynSoft Pharma - Compensated Writes Recovery Testing")
+        print(f"Tenant: {self.tenant_id}")
+
+        tests = [
+            self.test_orphaned_sale_reservation,
+            self.test_committed_sale_reservation,
+            self.test_recent_reservation_untouched,
+            self.test_return_never_restocked,
+            self.test_return_restocked_not_committed,
+            self.test_committed_return,
+            self.test_interrupted_supply_validation,
+            self.test_confirmed_supply_markers
+        ]
+
+        test_results = []
+        try:
+            for test in tests:
+                try:
+                    test_results.append(await test())
+                except Exception as e:
+                    print(f"❌ Test failed with exception: {e}")
+                    test_results.append(False)
+        finally:
+            await self.cleanup()
+            await close_db_connection()
+
+        passed_tests = sum(test_results)
+        total_tests = len(test_results)
+
+        print(f"\n📊 Test Results: {self.tests_passed}/{self.tests_run} checks passed")
+        print(f"📊 Feature Tests: {passed_tests}/{total_tests} test suites passed")
+        success_rate = (passed_tests / total_tests * 100) if total_tests > 0 else 0
+        print(f"Success rate: {success_rate:.1f}%")
+
+        if passed_tests == total_tests:
+            print("✅ All pending operations are recovered correctly")
+        else:
+            print("❌ Some features failed testing")
+
+        return passed_tests == total_tests
+
+
+if __name__ == "__main__":
+    tester = PendingRecoveryTester()
+    success = asyncio.run(tester.run_all_tests())
+    sys.exit(0 if success else 1)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Test Product List Pagination
+Tests the keyset pagination of the product list (X-Next-Cursor) in priority
+order and in alphabetical order: every product once, in a consistent order
+"""
+
+import requests
+import sys
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+class ProductPaginationTester:
+    def __init__(self):
+        # Get backend URL from environment
+        self.base_url = os.getenv('REACT_APP_BACKEND_URL', 'https://pharmflow-3.preview.emergentagent.com')
+        self.token = None
+        self.tests_run = 0
+        self.tests_passed = 0
+        self.created_items = {
+            'products': []
+        }
+
+    def run_test(self, name, method, endpoint, expected_status, data=None, headers=None):
+        """Run a single API test"""
+        url = f"{self.base_url}/api/{endpoint}"
+        test_headers = {'Content-Type': 'application/json'}
+
+        if self.token:
+            test_headers['Authorization'] = f'Bearer {self.token}'
+
+        if headers:
+            test_headers.update(headers)
+
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        print(f"   URL: {url}")
+
+        try:
+            response = None
+            if method == 'GET':
+                response = requests.get(url, headers=test_headers, timeout=30)
+            elif method == 'POST':
+                response = requests.post(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'PUT':
+                response = requests.put(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'DELETE':
+                response = requests.delete(url, headers=test_headers, timeout=30)
+
+            success = response.status_code == expected_status
+            if success:
+                self.tests_passed += 1
+                print(f"✅ Passed - Status: {response.status_code}")
+                try:
+                    return True, response.json() if response.content else {}
+                except:
+                    return True, {}
+            else:
+                print(f"❌ Failed - Expected {expected_status}, got {response.status_code}")
+                try:
+                    error_detail = response.json()
+                    print(f"   Error: {error_detail}")
+                except:
+                    print(f"   Response: {response.text}")
+                return False, {}
+
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, {}
+
+    def login(self):
+        """Login with admin credentials"""
+        print("\n=== AUTHENTICATION ===")
+        success, response = self.run_test(
+            "Login with admin credentials",
+            "POST",
+            "auth/login",
+            200,
+            data={"email": "admin@pharmaflow.com", "password": "admin123"}
+        )
+        if success and 'access_token' in response:
+            self.token = response['access_token']
+            print(f"   Token obtained: {self.token[:20]}...")
+            return True
+        return False
+
+    def create_product(self, label, stock, expiration_days=None):
+        """Create a uniquely named product with the given stock and expiration"""
+        suffix = uuid.uuid4().hex[:8]
+        success, product = self.run_test(
+            f"Create product '{label}' (stock {stock})",
+            "POST",
+            "products",
+            200,
+            data={
+                "name": f"Test Pages {label} {suffix}",
+                "barcode": f"PAG{suffix}",
+                "price": 10.00,
+                "stock": stock,
+                "min_stock": 1,
+                "expiration_date": (
+                    (datetime.now(timezone.utc) + timedelta(days=expiration_days)).isoformat()
+                    if expiration_days is not None else None
+                )
+            }
+        )
+        if success and 'id' in product:
+            self.created_items['products'].append(product['id'])
+            return product
+        return None
+
+    def fetch_all_pages(self, sort_by, limit=2):
+        """Follow X-Next-Cursor until the last page; returns the products in page order"""
+        headers = {'Authorization': f'Bearer {self.token}'}
+        seen, cursor, pages = [], None, 0
+        while True:
+            params = {"limit": limit, "sort_by": sort_by}
+            if cursor:
+                params["cursor"] = cursor
+            response = requests.get(f"{self.base_url}/api/products", params=params, headers=headers, timeout=30)
+            self.tests_run += 1
+            if response.status_code != 200:
+                print(f"❌ Failed - page {pages + 1}: {response.status_code}")
+                return None
+            self.tests_passed += 1
+            seen.extend(response.json())
+            pages += 1
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor or pages > 1000:
+                break
+        print(f"   {len(seen)} products over {pages} pages")
+        return seen
+
+    def check_pages(self, products):
+        ids = [p['id'] for p in products]
+        if len(ids) != len(set(ids)):
+            print("   ❌ A product was returned on two pages")
+            return False
+        missing = [p for p in self.created_items['products'] if p not in ids]
+        if missing:
+            print(f"   ❌ Products missing from the pages: {missing}")
+            return False
+        return True
+
+    def test_priority_pages(self):
+        """Test 1: Priority pages: low stock first, then nearest expiration, each product once"""
+        print("\n=== TEST 1: PRIORITY ORDER PAGES ===")
+        created = [
+            self.create_product("stock bas", 0, expiration_days=200),
+            self.create_product("expire bientot", 50, expiration_days=3),
+            self.create_product("expire plus tard", 50, expiration_days=10),
+            self.create_product("sans date", 50),
+        ]
+        if not all(created):
+            return False
+        products = self.fetch_all_pages("priority")
+        if products is None or not self.check_pages(products):
+            return False
+        position = {p['id']: i for i, p in enumerate(products)}
+        low, soon, later, undated = (position[p['id']] for p in created)
+        if not (soon < later < undated):
+            print("   ❌ Nearest expiration should come first, undated products last")
+            return False
+        restock = [i for i, p in enumerate(products) if p.get('stock', 0) <= p.get('min_stock', 10)]
+        if restock and max(restock) > min(i for i, p in enumerate(products) if i not in restock):
+            print("   ❌ Products to restock should precede the others")
+            return False
+        if low not in restock:
+            print("   ❌ The out-of-stock product should be in the restock group")
+            return False
+        print("   ✅ Priority order kept across pages")
+        return True
+
+    def test_name_pages(self):
+        """Test 2: Alphabetical pages: sorted by name, each product once"""
+        print("\n=== TEST 2: ALPHABETICAL PAGES ===")
+        products = self.fetch_all_pages("name", limit=3)
+        if products is None or not self.check_pages(products):
+            return False
+        names = [p['name'] for p in products]
+        if names != sorted(names):
+            print("   ❌ Products should be sorted by name")
+            return False
+        print("   ✅ Alphabetical order kept across pages")
+        return True
+
+    def test_invalid_cursor(self):
+        """Test 3: A malformed cursor is refused"""
+        print("\n=== TEST 3: INVALID CURSOR ===")
+        success, _ = self.run_test("Products with a malformed cursor", "GET", "products?cursor=not-a-cursor", 400)
+        return success
+
+    def cleanup(self):
+        """Clean up created test data"""
+        print("\n=== CLEANUP ===")
+        for product_id in self.created_items['products']:
+            self.run_test(f"Delete test product {product_id}", "DELETE", f"products/{product_id}", 200)
+
+    def run_all_tests(self):
+        """Run all product pagination tests"""
+        print("🚀 Starting Product Pagination Tests")
+        print("🏥 DynSoft Pharma - Product List Testing")
+        print(f"Base URL: {self.base_url}")
+
+        # Authentication is required
+        if not self.login():
+            print("❌ Login failed, stopping tests")
+            return False
+
+        # Run all tests
+        tests = [
+            self.test_priority_pages,
+            self.test_name_pages,
+            self.test_invalid_cursor
+        ]
+
+        test_results = []
+        for test in tests:
+            try:
+                result = test()
+                test_results.append(result)
+            except Exception as e:
+                print(f"❌ Test failed with exception: {e}")
+                test_results.append(False)
+
+        # Cleanup
+        self.cleanup()
+
+        # Print results
+        passed_tests = sum(test_results)
+        total_tests = len(test_results)
+
+        print(f"\n📊 Test Results: {self.tests_passed}/{self.tests_run} API calls passed")
+        print(f"📊 Feature Tests: {passed_tests}/{total_tests} test suites passed")
+        success_rate = (passed_tests / total_tests * 100) if total_tests > 0 else 0
+        print(f"Success rate: {success_rate:.1f}%")
+
+        if passed_tests == total_tests:
+            print("✅ Product list pagination working correctly")
+        else:
+            print("❌ Some features failed testing")
+
+        return passed_tests == total_tests
+
+
+if __name__ == "__main__":
+    tester = ProductPaginationTester()
+    success = tester.run_all_tests()
+    sys.exit(0 if success else 1)
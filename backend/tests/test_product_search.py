@@ -0,0 +1,134 @@
+"""
+Unit tests for the in-memory POS product search index (product_search.TenantSearchIndex)
+and the bounds on the number of tenant indexes kept in memory
+Run with: python -m pytest tests/test_product_search.py
+"""
+import pytest
+import product_search
+from product_search import TenantSearchIndex, trigrams
+
+
+CATALOGUE = [
+    {"id": "p-1", "name": "Doliprane 1000 mg", "barcode": "3400930000011"},
+    {"id": "p-2", "name": "Doliprane paracétamol 500", "barcode": "3400930000028"},
+    {"id": "p-3", "name": "Amoxicilline 500 mg", "barcode": "3400930000035"},
+    {"id": "p-4", "name": "Paracétamol Biogaran 1 g", "barcode": None},
+    {"id": "p-5", "name": "Efferalgan", "barcode": "  "},
+]
+
+
+@pytest.fixture
+def index():
+    index = TenantSearchIndex()
+    index.load(CATALOGUE)
+    return index
+
+
+def test_trigrams_are_padded():
+    assert trigrams("dol") == {"  d", " do", "dol", "ol "}
+
+
+def test_exact_barcode_returns_only_that_product(index):
+    assert index.search("3400930000035", 10) == ["p-3"]
+    assert index.search(" 3400930000035 ", 10) == ["p-3"]
+
+
+def test_name_prefix_is_case_and_accent_insensitive(index):
+    assert index.search("DOLI", 10) == ["p-1", "p-2"]
+    assert index.search("paracetamol", 10)[:2] == ["p-4", "p-2"]
+
+
+def test_full_name_prefix_ranks_before_word_prefix(index):
+    # "para" starts p-4's name but only a later word of p-2
+    assert index.search("para", 10)[:2] == ["p-4", "p-2"]
+
+
+def test_partial_barcode_matches_after_names(index):
+    assert index.search("340093000002", 10) == ["p-2"]
+
+
+def test_limit_is_respected(index):
+    assert index.search("doliprane", 1) == ["p-1"]
+
+
+def test_typo_is_found_by_trigrams(index):
+    assert index.search("amoxiciline", 10)[0] == "p-3"
+    assert index.search("eferalgan", 10)[0] == "p-5"
+
+
+def test_unrelated_query_finds_nothing(index):
+    assert index.search("zzzz", 10) == []
+    assert index.search("   ", 10) == []
+
+
+def test_blank_barcode_is_not_indexed(index):
+    assert "p-5" not in index.barcode_of
+    assert "" not in index.barcodes
+
+
+def test_rename_replaces_old_entries(index):
+    index.upsert({"id": "p-1", "name": "Dafalgan 1 g", "barcode": "3400930000011"})
+    assert index.search("doliprane", 10) == ["p-2"]
+    assert index.search("dafal", 10) == ["p-1"]
+    assert index.search("3400930000011", 10) == ["p-1"]
+    assert not any(product_id == "p-1" and text.startswith("doliprane") for text, _, product_id in index.prefixes)
+
+
+def test_remove_cleans_every_structure(index):
+    index.remove("p-3")
+    assert index.search("amox", 10) == []
+    assert index.search("3400930000035", 10) == []
+    assert all("p-3" not in ids for ids in index.postings.values())
+    assert all(product_id != "p-3" for _, _, product_id in index.prefixes)
+    # Removing twice is harmless
+    index.remove("p-3")
+
+
+def test_load_matches_incremental_upserts(index):
+    incremental = TenantSearchIndex()
+    for product in reversed(CATALOGUE):
+        incremental.upsert(product)
+    assert incremental.prefixes == index.prefixes
+    assert incremental.postings == index.postings
+    assert incremental.barcodes == index.barcodes
+
+
+def test_unchanged_name_and_barcode_skip_reindexing(index):
+    prefixes = list(index.prefixes)
+    index.upsert({"id": "p-1", "name": "doliprane  1000 MG", "barcode": "3400930000011", "stock": 3})
+    assert index.prefixes == prefixes
+
+
+@pytest.fixture
+def tenant_indexes(monkeypatch):
+    monkeypatch.setattr(product_search, "_indexes", product_search.OrderedDict())
+    monkeypatch.setattr(product_search, "_locks", {})
+    clock = {"now": 1000.0}
+    monkeypatch.setattr(product_search.time, "monotonic", lambda: clock["now"])
+    return clock
+
+
+def test_least_recently_used_index_is_evicted(tenant_indexes, monkeypatch):
+    monkeypatch.setattr(product_search, "MAX_TENANT_INDEXES", 2)
+    for tenant_id in ("t-1", "t-2", "t-3"):
+        product_search._indexes[tenant_id] = TenantSearchIndex()
+        product_search._touch(tenant_id, product_search._indexes[tenant_id])
+    product_search._touch("t-1", product_search._indexes["t-1"])
+    product_search._evict()
+    assert list(product_search._indexes) == ["t-3", "t-1"]
+
+
+def test_idle_index_is_released(tenant_indexes):
+    product_search._indexes["t-1"] = TenantSearchIndex()
+    product_search._touch("t-1", product_search._indexes["t-1"])
+    product_search._locks["t-1"] = product_search.asyncio.Lock()
+    tenant_indexes["now"] += product_search.INDEX_IDLE_TTL
+    product_search._evict()
+    assert "t-1" not in product_search._indexes
+    assert "t-1" not in product_search._locks
+
+
+def test_writes_ignore_tenants_without_index(tenant_indexes):
+    product_search.upsert_product("t-9", CATALOGUE[0])
+    product_search.remove_product("t-9", "p-1")
+    assert "t-9" not in product_search._indexes
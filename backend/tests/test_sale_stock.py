@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Test Sale Stock Concurrency
+Tests concurrent sales (no overselling, exact stock_before), sale quantities
+and manual stock adjustments racing with sales
+"""
+
+import requests
+import sys
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+class SaleStockTester:
+    def __init__(self):
+        # Get backend URL from environment
+        self.base_url = os.getenv('REACT_APP_BACKEND_URL', 'https://pharmflow-3.preview.emergentagent.com')
+        self.token = None
+        self.tests_run = 0
+        self.tests_passed = 0
+        self.created_items = {
+            'products': []
+        }
+
+    def run_test(self, name, method, endpoint, expected_status, data=None, headers=None):
+        """Run a single API test"""
+        url = f"{self.base_url}/api/{endpoint}"
+        test_headers = {'Content-Type': 'application/json'}
+
+        if self.token:
+            test_headers['Authorization'] = f'Bearer {self.token}'
+
+        if headers:
+            test_headers.update(headers)
+
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        print(f"   URL: {url}")
+
+        try:
+            response = None
+            if method == 'GET':
+                response = requests.get(url, headers=test_headers, timeout=30)
+            elif method == 'POST':
+                response = requests.post(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'PUT':
+                response = requests.put(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'DELETE':
+                response = requests.delete(url, headers=test_headers, timeout=30)
+
+            success = response.status_code == expected_status
+            if success:
+                self.tests_passed += 1
+                print(f"✅ Passed - Status: {response.status_code}")
+                try:
+                    return True, response.json() if response.content else {}
+                except:
+                    return True, {}
+            else:
+                print(f"❌ Failed - Expected {expected_status}, got {response.status_code}")
+                try:
+                    error_detail = response.json()
+                    print(f"   Error: {error_detail}")
+                except:
+                    print(f"   Response: {response.text}")
+                return False, {}
+
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, {}
+
+    def raw_post(self, endpoint, data):
+        """POST without counting as a test (used for concurrent requests)"""
+        return requests.post(
+            f"{self.base_url}/api/{endpoint}",
+            json=data,
+            headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {self.token}'},
+            timeout=60
+        )
+
+    def login(self):
+        """Login with admin credentials"""
+        print("\n=== AUTHENTICATION ===")
+        success, response = self.run_test(
+            "Login with admin credentials",
+            "POST",
+            "auth/login",
+            200,
+            data={"email": "admin@pharmaflow.com", "password": "admin123"}
+        )
+        if success and 'access_token' in response:
+            self.token = response['access_token']
+            print(f"   Token obtained: {self.token[:20]}...")
+            return True
+        return False
+
+    def create_product(self, label, stock):
+        """Create a uniquely named product with the given stock"""
+        suffix = uuid.uuid4().hex[:8]
+        success, product = self.run_test(
+            f"Create product '{label}' (stock {stock})",
+            "POST",
+            "products",
+            200,
+            data={
+                "name": f"Test Stock {label} {suffix}",
+                "barcode": f"STK{suffix}",
+                "price": 10.00,
+                "stock": stock,
+                "min_stock": 1
+            }
+        )
+        if success and 'id' in product:
+            self.created_items['products'].append(product['id'])
+            return product
+        return None
+
+    def get_stock(self, product_id):
+        success, product = self.run_test(f"Get product {product_id}", "GET", f"products/{product_id}", 200)
+        return product.get('stock') if success else None
+
+    def sale_payload(self, product_id, quantity):
+        return {
+            "items": [{"product_id": product_id, "name": "Test Stock", "price": 10.00, "quantity": quantity}],
+            "total": 10.00 * quantity,
+            "payment_method": "cash"
+        }
+
+    def test_concurrent_sales(self):
+        """Test 1: Concurrent sales never oversell and record exact stock_before"""
+        print("\n=== TEST 1: CONCURRENT SALES ===")
+        product = self.create_product("concurrence", 5)
+        if not product:
+            return False
+
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            responses = list(pool.map(lambda _: self.raw_post("sales", self.sale_payload(product['id'], 1)), range(10)))
+        accepted = [r for r in responses if r.status_code == 200]
+        refused = [r for r in responses if r.status_code == 400]
+        print(f"   Accepted: {len(accepted)}, refused: {len(refused)}")
+        if len(accepted) != 5 or len(refused) != 5:
+            print("   ❌ Expected exactly 5 accepted and 5 refused sales")
+            return False
+
+        if self.get_stock(product['id']) != 0:
+            print("   ❌ Final stock should be 0")
+            return False
+
+        success, movements = self.run_test(
+            "Get sale movements of the product",
+            "GET",
+            f"stock/movements/{product['id']}",
+            200
+        )
+        if not success:
+            return False
+        sale_movements = [m for m in movements if m.get('movement_type') == 'sale']
+        before_values = sorted(m['stock_before'] for m in sale_movements)
+        print(f"   stock_before values: {before_values}")
+        if before_values != [1, 2, 3, 4, 5]:
+            print("   ❌ Each sale must record the stock it actually reserved from")
+            return False
+        if any(m['stock_after'] != m['stock_before'] - 1 for m in sale_movements):
+            print("   ❌ stock_after must equal stock_before - quantity")
+            return False
+        print("   ✅ No overselling, exact stock_before on every movement")
+        return True
+
+    def test_sale_quantities(self):
+        """Test 2: Integral floats accepted, fractional quantities and missing product_id refused"""
+        print("\n=== TEST 2: SALE QUANTITIES ===")
+        product = self.create_product("quantites", 10)
+        if not product:
+            return False
+
+        ok_float, _ = self.run_test(
+            "Sale with quantity 2.0 is accepted",
+            "POST", "sales", 200,
+            data=self.sale_payload(product['id'], 2.0)
+        )
+        ok_fraction, _ = self.run_test(
+            "Sale with quantity 1.5 is refused",
+            "POST", "sales", 400,
+            data=self.sale_payload(product['id'], 1.5)
+        )
+        ok_missing, _ = self.run_test(
+            "Sale item without product_id is refused",
+            "POST", "sales", 400,
+            data={"items": [{"name": "Sans produit", "price": 10.00, "quantity": 1}], "total": 10.00, "payment_method": "cash"}
+        )
+        stock_ok = self.get_stock(product['id']) == 8
+        if not stock_ok:
+            print("   ❌ Only the 2.0 sale should have changed the stock")
+        return ok_float and ok_fraction and ok_missing and stock_ok
+
+    def test_adjustments_race_sales(self):
+        """Test 3: Manual adjustments never overwrite concurrent sales"""
+        print("\n=== TEST 3: ADJUSTMENTS RACING SALES ===")
+        product = self.create_product("ajustements", 20)
+        if not product:
+            return False
+
+        requests_to_send = (
+            [("sales", self.sale_payload(product['id'], 1))] * 5 +
+            [("stock/adjustment", {"product_id": product['id'], "movement_type": "adjustment",
+                                   "movement_quantity": 2, "notes": "Test concurrence"})] * 5
+        )
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            responses = list(pool.map(lambda r: self.raw_post(*r), requests_to_send))
+        if any(r.status_code != 200 for r in responses):
+            print(f"   ❌ Every request should succeed: {[r.status_code for r in responses]}")
+            return False
+
+        if self.get_stock(product['id']) != 25:
+            print("   ❌ Final stock should be 25 (20 - 5 + 10)")
+            return False
+
+        success, movements = self.run_test(
+            "Get movements of the product",
+            "GET",
+            f"stock/movements/{product['id']}",
+            200
+        )
+        if not success:
+            return False
+        recorded = [m for m in movements if m.get('movement_type') in ('sale', 'adjustment')]
+        if len(recorded) != 10:
+            print(f"   ❌ Expected 10 movements, got {len(recorded)}")
+            return False
+        if any(m['stock_after'] - m['stock_before'] != m['movement_quantity'] for m in recorded):
+            print("   ❌ Each movement must record the stock change it actually made")
+            return False
+        print("   ✅ Sales and adjustments all applied, exact stock_before on every movement")
+        return True
+
+    def test_sale_exceeding_adjusted_stock(self):
+        """Test 4: A negative adjustment is floored at zero, sales beyond stock are refused"""
+        print("\n=== TEST 4: NEGATIVE ADJUSTMENT ===")
+        product = self.create_product("plancher", 3)
+        if not product:
+            return False
+
+        success, movement = self.run_test(
+            "Adjustment of -5 on stock 3",
+            "POST", "stock/adjustment", 200,
+            data={"product_id": product['id'], "movement_type": "adjustment", "movement_quantity": -5}
+        )
+        if not success or movement.get('stock_before') != 3 or movement.get('stock_after') != 0:
+            print(f"   ❌ Expected 3 -> 0, got {movement}")
+            return False
+        refused, _ = self.run_test(
+            "Sale on empty stock is refused",
+            "POST", "sales", 400,
+            data=self.sale_payload(product['id'], 1)
+        )
+        return refused and self.get_stock(product['id']) == 0
+
+    def cleanup(self):
+        """Clean up created test data"""
+        print("\n=== CLEANUP ===")
+        # Products that were sold cannot be deleted: deactivation is enough
+        for product_id in self.created_items['products']:
+            self.run_test(f"Deactivate test product {product_id}", "PATCH", f"products/{product_id}/toggle-status", 200)
+
+    def run_all_tests(self):
+        """Run all sale stock concurrency tests"""
+        print("🚀 Starting Sale Stock Concurrency Tests")
+        print("🏥 DynSoft Pharma - Sale Stock Testing")
+        print(f"Base URL: {self.base_url}")
+
+        # Authentication is required
+        if not self.login():
+            print("❌ Login failed, stopping tests")
+            return False
+
+        # Run all tests
+        tests = [
+            self.test_concurrent_sales,
+            self.test_sale_quantities,
+            self.test_adjustments_race_sales,
+            self.test_sale_exceeding_adjusted_stock
+        ]
+
+        test_results = []
+        for test in tests:
+            try:
+                result = test()
+                test_results.append(result)
+            except Exception as e:
+                print(f"❌ Test failed with exception: {e}")
+                test_results.append(False)
+
+        # Cleanup
+        self.cleanup()
+
+        # Print results
+        passed_tests = sum(test_results)
+        total_tests = len(test_results)
+
+        print(f"\n📊 Test Results: {self.tests_passed}/{self.tests_run} API calls passed")
+        print(f"📊 Feature Tests: {passed_tests}/{total_tests} test suites passed")
+        success_rate = (passed_tests / total_tests * 100) if total_tests > 0 else 0
+        print(f"Success rate: {success_rate:.1f}%")
+
+        if passed_tests == total_tests:
+            print("✅ All sale stock features working correctly")
+        else:
+            print("❌ Some features failed testing")
+
+        return passed_tests == total_tests
+
+
+if __name__ == "__main__":
+    tester = SaleStockTester()
+    success = tester.run_all_tests()
+    sys.exit(0 if success else 1)
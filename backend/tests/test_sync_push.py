@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Test Offline Sync Push
+Tests idempotent sync push (replays, concurrent pushes, stock_delta), malformed
+changes, duplicate creates, the attribution of offline sales and HLC
+field versions (newest edit wins, unchanged fields keep their version)
+"""
+
+import requests
+import sys
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+class SyncPushTester:
+    def __init__(self):
+        # Get backend URL from environment
+        self.base_url = os.getenv('REACT_APP_BACKEND_URL', 'https://pharmflow-3.preview.emergentagent.com')
+        self.token = None
+        self.tests_run = 0
+        self.tests_passed = 0
+        self.created_items = {
+            'products': [],
+            'customers': []
+        }
+
+    def run_test(self, name, method, endpoint, expected_status, data=None, headers=None):
+        """Run a single API test"""
+        url = f"{self.base_url}/api/{endpoint}"
+        test_headers = {'Content-Type': 'application/json'}
+
+        if self.token:
+            test_headers['Authorization'] = f'Bearer {self.token}'
+
+        if headers:
+            test_headers.update(headers)
+
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        print(f"   URL: {url}")
+
+        try:
+            response = None
+            if method == 'GET':
+                response = requests.get(url, headers=test_headers, timeout=30)
+            elif method == 'POST':
+                response = requests.post(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'PUT':
+                response = requests.put(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=test_headers, timeout=30)
+            elif method == 'DELETE':
+                response = requests.delete(url, headers=test_headers, timeout=30)
+
+            success = response.status_code == expected_status
+            if success:
+                self.tests_passed += 1
+                print(f"✅ Passed - Status: {response.status_code}")
+                try:
+                    return True, response.json() if response.content else {}
+                except:
+                    return True, {}
+            else:
+                print(f"❌ Failed - Expected {expected_status}, got {response.status_code}")
+                try:
+                    error_detail = response.json()
+                    print(f"   Error: {error_detail}")
+                except:
+                    print(f"   Response: {response.text}")
+                return False, {}
+
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, {}
+
+    def raw_post(self, endpoint, data):
+        """POST without counting as a test (used for concurrent requests)"""
+        return requests.post(
+            f"{self.base_url}/api/{endpoint}",
+            json=data,
+            headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {self.token}'},
+            timeout=60
+        )
+
+    def login(self):
+        """Login with admin credentials"""
+        print("\n=== AUTHENTICATION ===")
+        success, response = self.run_test(
+            "Login with admin credentials",
+            "POST",
+            "auth/login",
+            200,
+            data={"email": "admin@pharmaflow.com", "password": "admin123"}
+        )
+        if success and 'access_token' in response:
+            self.token = response['access_token']
+            print(f"   Token obtained: {self.token[:20]}...")
+            return True
+        return False
+
+    def create_product(self, label, stock):
+        """Create a uniquely named product with the given stock"""
+        suffix = uuid.uuid4().hex[:8]
+        success, product = self.run_test(
+            f"Create product '{label}' (stock {stock})",
+            "POST",
+            "products",
+            200,
+            data={
+                "name": f"Test Sync {label} {suffix}",
+                "barcode": f"SYNC{suffix}",
+                "price": 10.00,
+                "stock": stock,
+                "min_stock": 1
+            }
+        )
+        if success and 'id' in product:
+            self.created_items['products'].append(product['id'])
+            return product
+        return None
+
+    def get_stock(self, product_id):
+        success, product = self.run_test(f"Get product {product_id}", "GET", f"products/{product_id}", 200)
+        return product.get('stock') if success else None
+
+    def stock_delta_change(self, product_id, delta, change_id=None):
+        return {
+            "id": change_id or str(uuid.uuid4()),
+            "type": "product",
+            "action": "update",
+            "payload": {"id": product_id, "stock_delta": delta}
+        }
+
+    def test_sync_replay_is_idempotent(self):
+        """Test 1: Replaying a push never applies a stock_delta twice"""
+        print("\n=== TEST 1: SYNC PUSH REPLAY ===")
+        product = self.create_product("rejeu", 10)
+        if not product:
+            return False
+        change = self.stock_delta_change(product['id'], 3)
+
+        success, first = self.run_test("First push (+3)", "POST", "sync/push", 200, data={"changes": [change]})
+        if not success or first['results'][0]['status'] != 'applied':
+            print(f"   ❌ First push should be applied: {first.get('results')}")
+            return False
+        success, second = self.run_test("Replayed push (+3)", "POST", "sync/push", 200, data={"changes": [change]})
+        if not success or second['results'][0]['status'] != 'duplicate':
+            print(f"   ❌ Replay should be reported as duplicate: {second.get('results')}")
+            return False
+        if self.get_stock(product['id']) != 13:
+            print("   ❌ Stock should be 13 (delta applied once)")
+            return False
+
+        success, movements = self.run_test("Get adjustment movements", "GET", f"stock/movements/{product['id']}", 200)
+        adjustments = [m for m in movements if m.get('movement_type') == 'adjustment']
+        if len(adjustments) != 1 or adjustments[0]['stock_before'] != 10 or adjustments[0]['stock_after'] != 13:
+            print(f"   ❌ Expected one adjustment 10 -> 13, got {adjustments}")
+            return False
+        print("   ✅ Replay reported as duplicate, stock and movement written once")
+        return True
+
+    def test_sync_concurrent_pushes(self):
+        """Test 2: The same change pushed concurrently is applied exactly once"""
+        print("\n=== TEST 2: CONCURRENT SYNC PUSHES ===")
+        product = self.create_product("envois simultanes", 10)
+        if not product:
+            return False
+        change = self.stock_delta_change(product['id'], 5)
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            responses = list(pool.map(lambda _: self.raw_post("sync/push", {"changes": [change]}), range(6)))
+        statuses = [r.json()['results'][0]['status'] for r in responses if r.status_code == 200]
+        print(f"   Statuses: {statuses}")
+        if len(statuses) != 6 or statuses.count('applied') != 1:
+            print("   ❌ Exactly one push should apply the change, without server errors")
+            return False
+        if any(status not in ('applied', 'duplicate', 'pending') for status in statuses):
+            print("   ❌ Other pushes should be duplicate or pending")
+            return False
+        if self.get_stock(product['id']) != 15:
+            print("   ❌ Stock should be 15 (delta applied once)")
+            return False
+        print("   ✅ Change applied once across concurrent pushes")
+        return True
+
+    def test_sync_malformed_changes(self):
+        """Test 3: A malformed change is rejected without failing the rest of the push"""
+        print("\n=== TEST 3: SYNC MALFORMED CHANGES ===")
+        product = self.create_product("malformee", 10)
+        if not product:
+            return False
+        changes = [
+            {"id": str(uuid.uuid4()), "type": "sale", "action": "create",
+             "payload": {"id": str(uuid.uuid4()), "items": [{"name": "Sans produit", "price": 5.0, "quantity": 1}],
+                         "total": 5.0, "payment_method": "cash"}},
+            {"id": str(uuid.uuid4()), "type": "product", "action": "update"},
+            self.stock_delta_change(product['id'], 2),
+        ]
+        success, result = self.run_test("Push with malformed changes", "POST", "sync/push", 200, data={"changes": changes})
+        if not success:
+            return False
+        statuses = [r['status'] for r in result['results']]
+        print(f"   Statuses: {statuses}")
+        if statuses[0] not in ('rejected', 'error') or statuses[1] != 'rejected' or statuses[2] != 'applied':
+            print("   ❌ Malformed changes should be rejected, the valid one applied")
+            return False
+        if self.get_stock(product['id']) != 12:
+            print("   ❌ Valid stock_delta should have been applied")
+            return False
+        print("   ✅ Malformed changes isolated")
+        return True
+
+    def test_sync_duplicate_create(self):
+        """Test 4: Creating an existing document is reported as duplicate, not applied"""
+        print("\n=== TEST 4: SYNC DUPLICATE CREATE ===")
+        customer_id = str(uuid.uuid4())
+        payload = {"id": customer_id, "name": f"Client Sync {customer_id[:8]}", "phone": "600000000"}
+        success, first = self.run_test(
+            "Create customer through sync",
+            "POST", "sync/push", 200,
+            data={"changes": [{"id": str(uuid.uuid4()), "type": "customer", "action": "create", "payload": payload}]}
+        )
+        if not success or first['results'][0]['status'] != 'applied':
+            return False
+        self.created_items['customers'].append(customer_id)
+        success, second = self.run_test(
+            "Create same customer with another change id",
+            "POST", "sync/push", 200,
+            data={"changes": [{"id": str(uuid.uuid4()), "type": "customer", "action": "create", "payload": payload}]}
+        )
+        if not success or second['results'][0]['status'] != 'duplicate':
+            print(f"   ❌ Second create should be duplicate: {second.get('results')}")
+            return False
+        print("   ✅ Existing document not reported as applied")
+        return True
+
+    def test_offline_sale_attribution(self):
+        """Test 5: An offline sale is attributed to the authenticated user, not to the pushed cashier"""
+        print("\n=== TEST 5: OFFLINE SALE ATTRIBUTION ===")
+        product = self.create_product("attribution", 10)
+        if not product:
+            return False
+        success, me = self.run_test("Get authenticated user", "GET", "auth/me", 200)
+        if not success:
+            return False
+        sale_id = str(uuid.uuid4())
+        payload = {
+            "id": sale_id,
+            "items": [{"product_id": product['id'], "name": "Test Sync", "price": 10.00, "quantity": 1}],
+            "total": 10.00,
+            "payment_method": "cash",
+            "user_id": str(uuid.uuid4()),
+            "employee_code": "EMP-FORGED",
+        }
+        success, result = self.run_test(
+            "Push an offline sale claiming another cashier",
+            "POST", "sync/push", 200,
+            data={"changes": [{"id": str(uuid.uuid4()), "type": "sale", "action": "create", "payload": payload}]}
+        )
+        if not success or result['results'][0]['status'] != 'applied':
+            print(f"   ❌ Offline sale should be applied: {result.get('results')}")
+            return False
+        success, sale = self.run_test("Get the synced sale", "GET", f"sales/{sale_id}", 200)
+        if not success:
+            return False
+        if sale.get('user_id') != me['id'] or sale.get('employee_code') != me['employee_code']:
+            print(f"   ❌ Sale attributed to {sale.get('user_id')}/{sale.get('employee_code')}, expected the authenticated user")
+            return False
+        if sale.get('client_employee_code') != "EMP-FORGED":
+            print("   ❌ The pushed cashier code should be kept apart as client_employee_code")
+            return False
+        success, movements = self.run_test("Get sale movements of the product", "GET", f"stock/movements/{product['id']}", 200)
+        sale_movements = [m for m in movements if m.get('reference_id') == sale_id]
+        if not success or not sale_movements or any(m.get('created_by') != me['employee_code'] for m in sale_movements):
+            print(f"   ❌ Stock movements should be created by the authenticated user: {sale_movements}")
+            return False
+        print("   ✅ Sale and movements attributed to the authenticated user")
+        return True
+
+    def test_sync_hlc_conflict(self):
+        """Test 6: An older HLC edit does not overwrite a newer field version"""
+        print("\n=== TEST 6: SYNC HLC CONFLICT ===")
+        product = self.create_product("hlc", 10)
+        if not product:
+            return False
+        now_ms = int(time.time() * 1000)
+        newer = f"{now_ms + 1000:018d}:000000:till-a"
+        older = f"{now_ms - 60000:018d}:000000:till-b"
+
+        success, result = self.run_test(
+            "Push a newer price edit",
+            "POST", "sync/push", 200,
+            data={"changes": [{"id": str(uuid.uuid4()), "type": "product", "action": "update", "hlc": newer,
+                               "payload": {"id": product['id'], "price": 12.00}}]}
+        )
+        if not success or result['results'][0]['status'] != 'applied':
+            return False
+        success, result = self.run_test(
+            "Push an older price edit",
+            "POST", "sync/push", 200,
+            data={"changes": [{"id": str(uuid.uuid4()), "type": "product", "action": "update", "hlc": older,
+                               "payload": {"id": product['id'], "price": 9.00}}]}
+        )
+        if not success or result['results'][0]['status'] != 'conflict':
+            print(f"   ❌ Older edit should be a conflict: {result.get('results')}")
+            return False
+        success, current = self.run_test("Get product after conflict", "GET", f"products/{product['id']}", 200)
+        if not success or current.get('price') != 12.00:
+            print("   ❌ Newer price should be kept")
+            return False
+        print("   ✅ Newest edit kept, older one reported in conflict")
+        return True
+
+    def test_unchanged_field_keeps_its_version(self):
+        """Test 7: A server edit only versions the fields it changes"""
+        print("\n=== TEST 7: UNCHANGED FIELDS KEEP THEIR VERSION ===")
+        product = self.create_product("versions", 10)
+        if not product:
+            return False
+        time.sleep(0.01)
+        offline = f"{int(time.time() * 1000):018d}:000000:till-a"
+        time.sleep(0.01)
+        success, _ = self.run_test(
+            "Server edit of the price only (same name resent)",
+            "PUT", f"products/{product['id']}", 200,
+            data={"name": product['name'], "barcode": product['barcode'], "price": 11.00, "stock": 10, "min_stock": 1}
+        )
+        if not success:
+            return False
+        renamed = f"{product['name']} renamed"
+        success, result = self.run_test(
+            "Push an earlier offline rename and price edit",
+            "POST", "sync/push", 200,
+            data={"changes": [{"id": str(uuid.uuid4()), "type": "product", "action": "update", "hlc": offline,
+                               "payload": {"id": product['id'], "name": renamed, "price": 8.00}}]}
+        )
+        if not success or result['results'][0]['status'] != 'applied':
+            print(f"   ❌ The rename should be applied: {result.get('results')}")
+            return False
+        refused = [c['field'] for c in result['results'][0].get('conflicts') or []]
+        if refused != ['price']:
+            print(f"   ❌ Only the price should conflict, got {refused}")
+            return False
+        success, current = self.run_test("Get product after the push", "GET", f"products/{product['id']}", 200)
+        if not success or current.get('name') != renamed or current.get('price') != 11.00:
+            print(f"   ❌ Expected the offline name and the server price: {current}")
+            return False
+        print("   ✅ Resending an unchanged name did not override the offline rename")
+        return True
+
+    def cleanup(self):
+        """Clean up created test data"""
+        print("\n=== CLEANUP ===")
+        # Products that were sold cannot be deleted: deactivation is enough
+        for product_id in self.created_items['products']:
+            self.run_test(f"Deactivate test product {product_id}", "PATCH", f"products/{product_id}/toggle-status", 200)
+        for customer_id in self.created_items['customers']:
+            self.run_test(f"Delete test customer {customer_id}", "DELETE", f"customers/{customer_id}", 200)
+
+    def run_all_tests(self):
+        """Run all sync push tests"""
+        print("🚀 Starting Sync Push Tests")
+        print("🏥 DynSoft Pharma - Offline Sync Testing")
+        print(f"Base URL: {self.base_url}")
+
+        # Authentication is required
+        if not self.login():
+            print("❌ Login failed, stopping tests")
+            return False
+
+        # Run all tests
+        tests = [
+            self.test_sync_replay_is_idempotent,
+            self.test_sync_concurrent_pushes,
+            self.test_sync_malformed_changes,
+            self.test_sync_duplicate_create,
+            self.test_offline_sale_attribution,
+            self.test_sync_hlc_conflict,
+            self.test_unchanged_field_keeps_its_version
+        ]
+
+        test_results = []
+        for test in tests:
+            try:
+                result = test()
+                test_results.append(result)
+            except Exception as e:
+                print(f"❌ Test failed with exception: {e}")
+                test_results.append(False)
+
+        # Cleanup
+        self.cleanup()
+
+        # Print results
+        passed_tests = sum(test_results)
+        total_tests = len(test_results)
+
+        print(f"\n📊 Test Results: {self.tests_passed}/{self.tests_run} API calls passed")
+        print(f"📊 Feature Tests: {passed_tests}/{total_tests} test suites passed")
+        success_rate = (passed_tests / total_tests * 100) if total_tests > 0 else 0
+        print(f"Success rate: {success_rate:.1f}%")
+
+        if passed_tests == total_tests:
+            print("✅ All sync push features working correctly")
+        else:
+            print("❌ Some features failed testing")
+
+        return passed_tests == total_tests
+
+
+if __name__ == "__main__":
+    tester = SyncPushTester()
+    success = tester.run_all_tests()
+    sys.exit(0 if success else 1)
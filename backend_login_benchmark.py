@@ -0,0 +1,117 @@
+"""
+Benchmark: tempête de connexions (changement d'équipe) et latence des autres endpoints.
+
+Mesure la latence d'un endpoint courant (GET /api/products/search par défaut)
+d'abord au repos, puis pendant que N clients enchaînent des POST /api/auth/login.
+Avec bcrypt exécuté hors de la boucle d'événements, le p99 de l'endpoint sondé
+doit rester du même ordre pendant la tempête.
+
+Usage:
+    python backend_login_benchmark.py --url http://localhost:8001 \\
+        --email admin@pharmaflow.com --password admin123 --logins 200 --concurrency 20
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class LoginStormBenchmark:
+    def __init__(self, base_url, email, password, probe_path):
+        self.base_url = base_url.rstrip("/")
+        self.email = email
+        self.password = password
+        self.probe_path = probe_path
+        self.token = None
+
+    def login(self):
+        start = time.perf_counter()
+        response = requests.post(
+            f"{self.base_url}/api/auth/login",
+            json={"email": self.email, "password": self.password},
+            timeout=60
+        )
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"Connexion refusée ({response.status_code}): {response.text}")
+        return response.json()["access_token"], elapsed
+
+    def probe(self, stop_event, latencies):
+        """Interroger l'endpoint sondé en boucle jusqu'à stop_event"""
+        headers = {"Authorization": f"Bearer {self.token}"}
+        session = requests.Session()
+        while not stop_event.is_set():
+            start = time.perf_counter()
+            session.get(f"{self.base_url}{self.probe_path}", headers=headers, timeout=60)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    def measure_probe(self, duration):
+        latencies = []
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self.probe, args=(stop_event, latencies))
+        thread.start()
+        time.sleep(duration)
+        stop_event.set()
+        thread.join()
+        return latencies
+
+    def run(self, logins, concurrency, idle_duration):
+        self.token, _ = self.login()
+
+        print(f"Sonde {self.probe_path} au repos pendant {idle_duration}s...")
+        idle = self.measure_probe(idle_duration)
+
+        print(f"Tempête: {logins} connexions, {concurrency} clients simultanés...")
+        storm = []
+        login_times = []
+        stop_event = threading.Event()
+        probe_thread = threading.Thread(target=self.probe, args=(stop_event, storm))
+        probe_thread.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for _, elapsed in pool.map(lambda _: self.login(), range(logins)):
+                login_times.append(elapsed * 1000)
+        storm_duration = time.perf_counter() - start
+        stop_event.set()
+        probe_thread.join()
+
+        print("\n=== RÉSULTATS ===")
+        print(f"Connexions: {logins} en {storm_duration:.2f}s ({logins / storm_duration:.1f}/s), "
+              f"p50 {percentile(login_times, 50):.0f} ms, p99 {percentile(login_times, 99):.0f} ms")
+        for label, values in (("Au repos", idle), ("Pendant la tempête", storm)):
+            print(f"{label:<20} {len(values):>5} requêtes  p50 {percentile(values, 50):7.1f} ms  "
+                  f"p99 {percentile(values, 99):7.1f} ms  moyenne {statistics.mean(values) if values else 0:7.1f} ms")
+        ratio = percentile(storm, 99) / max(percentile(idle, 99), 0.001)
+        print(f"p99 tempête / repos: x{ratio:.1f}")
+        return ratio
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de connexions simultanées")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--email", default="admin@pharmaflow.com")
+    parser.add_argument("--password", default="admin123")
+    parser.add_argument("--probe", default="/api/products/search?q=dol", help="Endpoint sondé pendant la tempête")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--idle", type=float, default=5.0, help="Durée de la mesure au repos (s)")
+    parser.add_argument("--max-ratio", type=float, default=3.0, help="Échec si le p99 est multiplié au-delà")
+    args = parser.parse_args()
+
+    benchmark = LoginStormBenchmark(args.url, args.email, args.password, args.probe)
+    ratio = benchmark.run(args.logins, args.concurrency, args.idle)
+    return 0 if ratio <= args.max_ratio else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,7 +4,7 @@
  */
 
 import { useQuery, useMutation, useQueryClient } from '@tanstack/react-query';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { queryKeys } from '../lib/queryClient';
 import { toast } from 'sonner';
 
@@ -19,7 +19,7 @@ export const useCategories = (options = {}) => {
   return useQuery({
     queryKey: queryKeys.categories,
     queryFn: async () => {
-      const response = await api.get('/categories');
+      const response = await getAllPages('/categories');
       return response.data;
     },
     staleTime: 10 * 60 * 1000, // 10 minutes (les catégories changent rarement)
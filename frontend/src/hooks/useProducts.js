@@ -4,7 +4,7 @@
  */
 
 import { useQuery, useMutation, useQueryClient } from '@tanstack/react-query';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { queryKeys } from '../lib/queryClient';
 import { toast } from 'sonner';
 
@@ -19,7 +19,7 @@ export const useProducts = (options = {}) => {
   return useQuery({
     queryKey: queryKeys.products,
     queryFn: async () => {
-      const response = await api.get('/products');
+      const response = await getAllPages('/products');
       return response.data;
     },
     staleTime: 5 * 60 * 1000, // 5 minutes
@@ -6,7 +6,7 @@ import { Label } from '../components/ui/label';
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from '../components/ui/dialog';
 import { AlertDialog, AlertDialogAction, AlertDialogCancel, AlertDialogContent, AlertDialogDescription, AlertDialogFooter, AlertDialogHeader, AlertDialogTitle } from '../components/ui/alert-dialog';
 import { Plus, Users, Edit, Trash2, Search, Phone, Mail, MapPin } from 'lucide-react';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { addItem, getAllItems, updateItem, deleteItem as deleteFromDB, addLocalChange, getDB } from '../services/indexedDB';
 import { useOffline } from '../contexts/OfflineContext';
 import { toast } from 'sonner';
@@ -30,7 +30,7 @@ const Customers = () => {
     try {
       if (isOnline) {
         const headers = forceRefresh ? { 'Cache-Control': 'no-cache' } : {};
-        const response = await api.get('/customers', { headers });
+        const response = await getAllPages('/customers', { headers });
         setCustomers(response.data);
         
         if (forceRefresh) {
@@ -7,7 +7,7 @@ import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from
 import { AlertDialog, AlertDialogAction, AlertDialogCancel, AlertDialogContent, AlertDialogDescription, AlertDialogFooter, AlertDialogHeader, AlertDialogTitle, AlertDialogTrigger } from '../components/ui/alert-dialog';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '../components/ui/select';
 import { Plus, FileText, CheckCircle, Edit, Trash2, X } from 'lucide-react';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { addItem, getAllItems, updateItem, deleteItem as deleteFromDB, addLocalChange, getDB } from '../services/indexedDB';
 import { useOffline } from '../contexts/OfflineContext';
 import { toast } from 'sonner';
@@ -64,8 +64,8 @@ const Prescriptions = () => {
         const headers = forceRefresh ? { 'Cache-Control': 'no-cache' } : {};
         
         const [prescriptionsRes, customersRes] = await Promise.all([
-          api.get('/prescriptions', { headers }),
-          api.get('/customers', { headers }),
+          getAllPages('/prescriptions', { headers }),
+          getAllPages('/customers', { headers }),
         ]);
         
         // Vider IndexedDB avant de mettre à jour
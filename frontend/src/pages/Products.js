@@ -8,7 +8,7 @@ import { AlertDialog, AlertDialogAction, AlertDialogCancel, AlertDialogContent,
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '../components/ui/select';
 import { Pagination, PaginationContent, PaginationItem, PaginationLink, PaginationNext, PaginationPrevious, PaginationEllipsis } from '../components/ui/pagination';
 import { Plus, Search, Edit, Trash2, Package, Tag, Settings, Power, PowerOff, AlertTriangle, Calculator, TrendingUp, Box, Hash, Calendar, Clock } from 'lucide-react';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { addItem, getAllItems, updateItem, deleteItem as deleteFromDB, addLocalChange, getDB } from '../services/indexedDB';
 import { useOffline } from '../contexts/OfflineContext';
 import { useAuth } from '../contexts/AuthContext';
@@ -89,7 +89,7 @@ const Products = () => {
       if (isOnline) {
         const timestamp = Date.now();
         const headers = forceRefresh ? { 'Cache-Control': 'no-cache', 'Pragma': 'no-cache' } : {};
-        const response = await api.get(`/categories?_t=${timestamp}`, { headers });
+        const response = await getAllPages(`/categories?_t=${timestamp}`, { headers });
         setCategories(response.data);
       }
     } catch (error) {
@@ -102,7 +102,7 @@ const Products = () => {
       if (isOnline) {
         const timestamp = Date.now();
         const headers = forceRefresh ? { 'Cache-Control': 'no-cache', 'Pragma': 'no-cache' } : {};
-        const response = await api.get(`/units?_t=${timestamp}`, { headers });
+        const response = await getAllPages(`/units?_t=${timestamp}`, { headers });
         setUnits(response.data);
       }
     } catch (error) {
@@ -114,7 +114,7 @@ const Products = () => {
     try {
       if (isOnline) {
         const headers = forceRefresh ? { 'Cache-Control': 'no-cache' } : {};
-        const response = await api.get('/products', { headers });
+        const response = await getAllPages('/products', { headers });
         setProducts(response.data);
         
         if (forceRefresh) {
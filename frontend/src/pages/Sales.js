@@ -6,7 +6,7 @@ import { Label } from '../components/ui/label';
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger, DialogFooter } from '../components/ui/dialog';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '../components/ui/select';
 import { Plus, Search, ShoppingCart, X, Eye, CreditCard, Banknote, FileCheck, FileText, RotateCcw, History, Filter, Calendar } from 'lucide-react';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { addItem, getAllItems, addLocalChange, getDB } from '../services/indexedDB';
 import { useOffline } from '../contexts/OfflineContext';
 import { toast } from 'sonner';
@@ -44,8 +44,8 @@ const Sales = () => {
         const headers = forceRefresh ? { 'Cache-Control': 'no-cache' } : {};
         const [salesRes, productsRes, customersRes, settingsRes] = await Promise.all([
           api.get('/sales', { headers }),
-          api.get('/products', { headers }).catch(() => ({ data: [] })),
-          api.get('/customers', { headers }),
+          getAllPages('/products', { headers }).catch(() => ({ data: [] })),
+          getAllPages('/customers', { headers }),
           api.get('/settings', { headers }).catch(() => ({ data: { currency: 'EUR' } })),
         ]);
         setSales(salesRes.data);
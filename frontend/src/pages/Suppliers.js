@@ -8,7 +8,7 @@ import { Switch } from '../components/ui/switch';
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from '../components/ui/dialog';
 import { AlertDialog, AlertDialogAction, AlertDialogCancel, AlertDialogContent, AlertDialogDescription, AlertDialogFooter, AlertDialogHeader, AlertDialogTitle } from '../components/ui/alert-dialog';
 import { Plus, Truck, Edit, Trash2, Search, Phone, Mail, MapPin, Power, PowerOff, Filter, Eye, EyeOff } from 'lucide-react';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { addItem, getAllItems, updateItem, deleteItem as deleteFromDB, addLocalChange, getDB } from '../services/indexedDB';
 import { useOffline } from '../contexts/OfflineContext';
 import { useAuth } from '../contexts/AuthContext';
@@ -36,7 +36,7 @@ const Suppliers = () => {
     try {
       if (isOnline) {
         const headers = forceRefresh ? { 'Cache-Control': 'no-cache' } : {};
-        const response = await api.get('/suppliers', { headers });
+        const response = await getAllPages('/suppliers', { headers });
         setSuppliers(response.data);
         
         // Clear IndexedDB before updating if forced refresh
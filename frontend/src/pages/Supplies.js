@@ -25,7 +25,7 @@ import {
   RefreshCw,
   PlusCircle
 } from 'lucide-react';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { useAuth } from '../contexts/AuthContext';
 import { toast } from 'sonner';
 
@@ -128,7 +128,7 @@ const Supplies = () => {
 
   const loadSuppliers = useCallback(async () => {
     try {
-      const response = await api.get('/suppliers');
+      const response = await getAllPages('/suppliers');
       setSuppliers(response.data);
     } catch (error) {
       console.error('Error loading suppliers:', error);
@@ -137,7 +137,7 @@ const Supplies = () => {
 
   const loadProducts = useCallback(async () => {
     try {
-      const response = await api.get('/products');
+      const response = await getAllPages('/products');
       setProducts(response.data.filter(p => p.is_active !== false));
     } catch (error) {
       console.error('Error loading products:', error);
@@ -23,7 +23,7 @@ import {
   Eye,
   EyeOff
 } from 'lucide-react';
-import api from '../services/api';
+import api, { getAllPages } from '../services/api';
 import { useAuth } from '../contexts/AuthContext';
 import { toast } from 'sonner';
 import { Navigate } from 'react-router-dom';
@@ -94,7 +94,7 @@ const Users = () => {
   const loadUsers = async () => {
     try {
       setLoading(true);
-      const response = await api.get('/users');
+      const response = await getAllPages('/users');
       setUsers(response.data);
     } catch (error) {
       console.error('Error loading users:', error);
@@ -39,4 +39,26 @@ api.interceptors.response.use(
   }
 );
 
+// Pagination par curseur: la page suivante d'une liste est indiquée par l'en-tête X-Next-Cursor
+const NEXT_CURSOR_HEADER = 'x-next-cursor';
+
+/**
+ * Charger toutes les pages d'une liste en suivant l'en-tête X-Next-Cursor.
+ * Renvoie une réponse de même forme que api.get ({ data }) pour remplacer un appel existant.
+ */
+export const getAllPages = async (url, config = {}) => {
+  let response = await api.get(url, config);
+  if (!Array.isArray(response.data)) {
+    return response;
+  }
+  const items = [...response.data];
+  let cursor = response.headers?.[NEXT_CURSOR_HEADER];
+  while (cursor) {
+    response = await api.get(url, { ...config, params: { ...(config.params || {}), cursor } });
+    items.push(...response.data);
+    cursor = response.headers?.[NEXT_CURSOR_HEADER];
+  }
+  return { ...response, data: items };
+};
+
 export default api;
\ No newline at end of file
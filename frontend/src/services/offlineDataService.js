@@ -3,7 +3,7 @@
  * Ce service encapsule la logique de synchronisation pour toutes les pages
  */
 
-import api from './api';
+import api, { getAllPages } from './api';
 import {
   addItem,
   addItemLocal,
@@ -27,6 +27,9 @@ const API_ENDPOINTS = {
   sales: '/sales',
 };
 
+// Historiques: seule la page la plus récente est mise en cache (comme avant la pagination)
+const HISTORY_STORES = new Set(['sales']);
+
 /**
  * Load data from server or local IndexedDB
  * @param {string} storeName - Name of the store (products, customers, etc.)
@@ -43,7 +46,9 @@ export const loadData = async (storeName, isOnline, forceRefresh = false) => {
       }
 
       const headers = forceRefresh ? { 'Cache-Control': 'no-cache', 'Pragma': 'no-cache' } : {};
-      const response = await api.get(endpoint, { headers });
+      const response = HISTORY_STORES.has(storeName)
+        ? await api.get(endpoint, { headers })
+        : await getAllPages(endpoint, { headers });
       const serverData = response.data;
 
       // Clear local store if force refresh
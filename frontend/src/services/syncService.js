@@ -1,4 +1,4 @@
-import api from './api';
+import api, { getAllPages } from './api';
 import {
   getLocalChanges,
   getPendingChanges,
@@ -56,6 +56,9 @@ const API_ENDPOINTS = {
   settings: '/settings'
 };
 
+// Historiques: seule la page la plus récente est mise en cache (comme avant la pagination)
+const HISTORY_STORES = new Set(['sales', 'supplies', 'returns']);
+
 // ============================================
 // Push Local Changes to Server
 // ============================================
@@ -150,7 +153,9 @@ const pullCollection = async (storeName, forceFullSync = false) => {
   }
   
   try {
-    const response = await api.get(endpoint);
+    const response = HISTORY_STORES.has(storeName)
+      ? await api.get(endpoint)
+      : await getAllPages(endpoint);
     const serverData = response.data;
     
     if (Array.isArray(serverData)) {